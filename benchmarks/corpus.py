@@ -0,0 +1,74 @@
+"""Documents the benchmarks inline.
+
+Each entry of CORPUS builds one HTML document with its CSS in a <style>
+element. The documents are generated rather than stored so that the large
+ones do not bloat the repository; they are the same on every run.
+"""
+
+from collections import OrderedDict
+
+EMAIL_CSS = u"""
+body { margin: 0; padding: 0; background: #f4f4f4; font-family: Helvetica, Arial, sans-serif; }
+table { border-collapse: collapse; }
+.wrapper { width: 100%; background: #f4f4f4; }
+.container { width: 600px; margin: 0 auto; background: #ffffff; }
+.header td { padding: 24px; background: #1a73e8; color: #ffffff; }
+.header h1 { margin: 0; font-size: 24px; line-height: 32px; }
+.item td { padding: 12px 24px; border-bottom: 1px solid #eeeeee; }
+.item h2 { margin: 0 0 4px 0; font-size: 18px; color: #202124; }
+.item p { margin: 0; font-size: 14px; line-height: 20px; color: #5f6368; }
+.item a { color: #1a73e8; text-decoration: none; }
+.item .price { font-weight: bold; color: #188038; }
+.item:nth-child(even) td { background: #fafafa; }
+.item td:first-child { width: 96px; }
+.item img { display: block; border: 0; width: 96px; height: 96px; }
+.footer td { padding: 24px; font-size: 12px; color: #9aa0a6; text-align: center; }
+.footer a { color: #9aa0a6; }
+@media only screen and (max-width: 600px) { .container { width: 100% !important; } }
+"""
+
+_ITEM = u"""<tr class="item">
+  <td><img src="https://example.com/img/%(n)d.png" alt="Item %(n)d"></td>
+  <td>
+    <h2><a href="https://example.com/items/%(n)d">Item number %(n)d</a></h2>
+    <p>A short description of item %(n)d, long enough to wrap onto a second
+    line in most mail clients. <span class="price">$%(n)d.99</span></p>
+  </td>
+</tr>
+"""
+
+
+def _email(title, items):
+    rows = u''.join(_ITEM % {'n': n} for n in xrange(items))
+    return u"""<html><head><title>%(title)s</title>
+<style type="text/css">%(css)s</style></head>
+<body><table class="wrapper"><tr><td>
+<table class="container">
+<tr class="header"><td colspan="2"><h1>%(title)s</h1></td></tr>
+%(rows)s
+<tr class="footer"><td colspan="2">You are receiving this email because you
+subscribed. <a href="https://example.com/unsubscribe">Unsubscribe</a></td></tr>
+</table>
+</td></tr></table></body></html>""" % {'title': title, 'css': EMAIL_CSS, 'rows': rows}
+
+
+def receipt():
+    """A short transactional email"""
+    return _email(u'Your receipt', 3)
+
+
+def newsletter():
+    """A typical newsletter"""
+    return _email(u'This week', 40)
+
+
+def digest():
+    """A large digest email, the kind that runs workers out of memory"""
+    return _email(u'Your daily digest', 1500)
+
+
+CORPUS = OrderedDict([
+    ('receipt', receipt),
+    ('newsletter', newsletter),
+    ('digest', digest),
+])
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+"""Peak memory of every phase of Pynliner.run() on the benchmark corpus.
+
+    python benchmarks/memory.py              # report
+    python benchmarks/memory.py --check      # fail when a phase is over budget
+    python benchmarks/memory.py --update     # store current peaks as budgets
+
+Each document is inlined in a fresh process. Before every phase the peak
+resident set size of the process is reset through /proc/self/clear_refs, so
+the peak of a phase is the high water mark it reached minus the resident
+size it started from. Where that is not available the peak of the whole
+process so far is used, which only shows phases that set a new peak.
+
+Python 2 has no tracemalloc, so allocations are reported as the change in
+the number of live objects of each type that the garbage collector tracks.
+"""
+
+import argparse
+import gc
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from collections import Counter, OrderedDict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from corpus import CORPUS
+
+BUDGETS_PATH = os.path.join(HERE, 'memory_budgets.json')
+# budgets written by --update leave this much room over the measured peak
+HEADROOM = 1.25
+
+
+def _apply_styles(inliner):
+    # run() serializes declarations compactly
+    import cssutils
+    previous_spacer = cssutils.ser.prefs.propertyNameSpacer
+    cssutils.ser.prefs.propertyNameSpacer = u''
+    try:
+        inliner._apply_styles()
+    finally:
+        cssutils.ser.prefs.propertyNameSpacer = previous_spacer
+
+
+def _output(inliner):
+    inliner._get_output()
+    inliner._clean_output()
+
+
+# the phases of Pynliner.run(), in order
+PHASES = (
+    ('parse', lambda inliner: inliner._get_soup()),
+    ('styles', lambda inliner: inliner._get_styles()),
+    ('apply', _apply_styles),
+    ('output', _output),
+)
+
+
+def _status_kb(field):
+    with open('/proc/self/status') as f:
+        return int(re.search(r'%s:\s+(\d+) kB' % field, f.read()).group(1))
+
+
+def _reset_peak():
+    """Resets the peak resident size of the process, returns False if the
+    platform does not support it
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _resident_kb():
+    try:
+        return _status_kb('VmRSS')
+    except (IOError, OSError):
+        return _max_resident_kb()
+
+
+def _peak_kb():
+    try:
+        return _status_kb('VmHWM')
+    except (IOError, OSError):
+        return _max_resident_kb()
+
+
+def _max_resident_kb():
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _object_counts():
+    return Counter(type(obj).__name__ for obj in gc.get_objects())
+
+
+def measure(name):
+    """Inlines a corpus document in this process and returns the peak and
+    retained memory, duration and top allocations of every phase
+    """
+    import pynliner
+    html = CORPUS[name]()
+    inliner = pynliner.Pynliner().from_string(html)
+    del html
+    gc.collect()
+
+    results = OrderedDict()
+    for phase, function in PHASES:
+        counts = _object_counts()
+        _reset_peak()
+        start_kb = _resident_kb()
+        start = time.time()
+        function(inliner)
+        seconds = time.time() - start
+        peak_kb = _peak_kb()
+        end_kb = _resident_kb()
+        allocations = _object_counts()
+        allocations.subtract(counts)
+        # the counts taken before the phase
+        allocations.subtract({'Counter': 1})
+        results[phase] = {
+            'peak_kb': max(peak_kb - start_kb, 0),
+            'retained_kb': end_kb - start_kb,
+            'seconds': round(seconds, 3),
+            'allocations': [(type_name, count) for type_name, count
+                            in allocations.most_common(3) if count > 0],
+        }
+        del counts, allocations
+    return results
+
+
+def measure_in_subprocess(name):
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--measure', name])
+    return json.loads(output, object_pairs_hook=OrderedDict)
+
+
+def load_budgets(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def over_budget(results, budgets):
+    """Returns (document, phase, peak, budget) for every phase whose peak is
+    over its budget
+    """
+    failures = []
+    for name, phases in results.items():
+        for phase, result in phases.items():
+            budget = budgets.get(name, {}).get(phase)
+            if budget is not None and result['peak_kb'] > budget:
+                failures.append((name, phase, result['peak_kb'], budget))
+    return failures
+
+
+def report(results, budgets):
+    print '%-12s %-8s %10s %10s %10s %8s  %s' % (
+        'document', 'phase', 'peak KB', 'budget KB', 'retained', 'seconds',
+        'allocations')
+    for name, phases in results.items():
+        for phase, result in phases.items():
+            budget = budgets.get(name, {}).get(phase, '-')
+            allocations = ', '.join('%s +%d' % tuple(item) for item in result['allocations'])
+            print '%-12s %-8s %10d %10s %10d %8.3f  %s' % (
+                name, phase, result['peak_kb'], budget, result['retained_kb'],
+                result['seconds'], allocations)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('documents', nargs='*', metavar='document',
+                        help='corpus documents to run (default: all of %s)'
+                             % ', '.join(CORPUS))
+    parser.add_argument('--check', action='store_true',
+                        help='exit with status 1 when a phase is over budget')
+    parser.add_argument('--update', action='store_true',
+                        help='store the measured peaks plus %d%% and 1 MB as the budgets'
+                             % round((HEADROOM - 1) * 100))
+    parser.add_argument('--budgets', default=BUDGETS_PATH,
+                        help='budgets file (default: %(default)s)')
+    parser.add_argument('--measure', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.measure:
+        print json.dumps(measure(args.measure))
+        return 0
+
+    names = args.documents or list(CORPUS)
+    for name in names:
+        if name not in CORPUS:
+            parser.error('unknown document %r' % name)
+    results = OrderedDict((name, measure_in_subprocess(name)) for name in names)
+    budgets = load_budgets(args.budgets)
+
+    if args.update:
+        for name, phases in results.items():
+            budgets[name] = OrderedDict(
+                (phase, int(result['peak_kb'] * HEADROOM) + 1024)
+                for phase, result in phases.items())
+        with open(args.budgets, 'w') as f:
+            json.dump(budgets, f, indent=2, sort_keys=True, separators=(',', ': '))
+            f.write('\n')
+
+    report(results, budgets)
+    failures = over_budget(results, budgets)
+    for name, phase, peak, budget in failures:
+        print 'OVER BUDGET: %s %s peaked at %d KB, budget %d KB' % (
+            name, phase, peak, budget)
+    if args.check and failures:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
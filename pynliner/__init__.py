@@ -33,42 +33,281 @@ THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 __version__ = "0.5.1.12"
 
 import re
-import urlparse
-import urllib2
-import cssutils
-from BeautifulSoup import BeautifulSoup, Tag, Comment
-from soupselect import select, SelectorNotSupportedException
-
-_CSS_RULE_TYPES_TO_PRESERVE = (
-    cssutils.css.CSSRule.MEDIA_RULE,
-    cssutils.css.CSSRule.IMPORT_RULE,
-    cssutils.css.CSSRule.FONT_FACE_RULE,
-)
+import sys
+import threading
+from collections import OrderedDict
+from operator import attrgetter
+from soupselect import (select_steps, parse_selector, parse_compound,
+                        SelectorNotSupportedException, SiblingIndex)
+from fetchers import UrllibFetcher, ResponseTooLarge, fetch_limited
+from cache import make_key
+from session import InliningSession
+from shadow import ShadowMode
+from budget import Budget, BudgetExceeded, BudgetMeter
+from bitset import BitsetMatcher
+import parallel
+import fastcss
+from optimize import (parse_inline_style, merge_declarations, fold_shorthands,
+                      inline_properties, collapse_block_white_space,
+                      prune_media_rule)
+from compiled import (CompiledStylesheet, CompiledStylesheetVersionError,
+                      compile_css, compile_rule, compile_stylesheet,
+                      preserved_rule_types)
+from _lazy import LazyModule
+
+# imported on first use to keep `import pynliner` cheap
+cssutils = LazyModule('cssutils')
+bs = LazyModule('BeautifulSoup')
+urlparse = LazyModule('urlparse')
+
+class InliningCancelled(Exception):
+    """Raised inside a background run once it has been cancelled"""
+    pass
+
+
+class InliningTimeout(Exception):
+    """Raised by `AsyncResult.result` when the output is not ready in time"""
+    pass
+
+
+# the AsyncResult of the background run in the current thread
+_current_run = threading.local()
+
+# threads fetching the linked stylesheets of one document
+_FETCH_THREADS = 4
+
+
+class AsyncResult(object):
+    """The eventual output of an inlining run started in the background by
+    `Pynliner.run_async`, `fromURLAsync` or `fromStringAsync`.
+
+    Follows the parts of the `concurrent.futures.Future` interface that matter
+    here. Cancellation is cooperative: the run stops with InliningCancelled
+    at its next checkpoint (between fetches, phases and rules).
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._output = None
+        self._exc_info = None
+
+    def cancel(self):
+        """Asks the run to stop. Returns False if it has already finished."""
+        if self._done.is_set():
+            return False
+        self._cancelled.set()
+        return True
+
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Waits for the run to finish and returns its output, re-raising any
+        exception it raised. If the output is not ready within `timeout`
+        seconds InliningTimeout is raised and the run goes on; call `cancel`
+        to stop it.
+        """
+        if not self._done.wait(timeout):
+            raise InliningTimeout('inlining did not finish in %s seconds' % timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._output
+
+    def add_done_callback(self, fn):
+        """Calls `fn(self)` once the run has finished, immediately if it
+        already has.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _run(self, function):
+        _current_run.result = self
+        try:
+            if self.cancelled():
+                raise InliningCancelled()
+            self._output = function()
+        except BaseException:
+            self._exc_info = sys.exc_info()
+        finally:
+            _current_run.result = None
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class _StyleMatch(object):
+    """A rule matched by an element: the specificity of the selector that
+    matched and the index of the rule in the stylesheet, which breaks ties in
+    source order. One record is shared by every element the selector selects.
+    """
+    __slots__ = ('specificity', 'rule_index')
+
+    def __init__(self, specificity, rule_index):
+        self.specificity = specificity
+        self.rule_index = rule_index
+
+
+_match_sort_key = attrgetter('specificity', 'rule_index')
+
+_PENDING = object()
+
+# documents that may link stylesheets, whose result cache key depends on
+# the content of the stylesheets
+_link_regex = re.compile(r'<link\b', re.I)
+
+
+class _CacheHit(Exception):
+    """Stops a run whose output is found in the result cache once its
+    linked stylesheets are fetched
+    """
+
+    def __init__(self, output):
+        Exception.__init__(self)
+        self.output = output
+
 
 class Pynliner(object):
     """Pynliner class"""
 
+    # constructor options that affect the output and so the result cache key
+    _OUTPUT_OPTIONS = (
+        'allow_conditional_comments',
+        'preserve_media_queries',
+        'preserve_unknown_rules',
+        'ingore_unsupported_selectors',
+        'optimize_output',
+        'fold_shorthands',
+        'prune_media_queries',
+    )
+
     soup = False
     style_string = False
     stylesheet = False
     output = False
+    # the use of the budget by the current run
+    _meter = None
+    # the BudgetExceeded that degraded the last run
+    budget_exceeded = None
+    # every property declared by the stylesheets, see fold_shorthands
+    _declared_properties = frozenset()
+    # every property declared by the @style attributes of the document
+    _inline_properties = frozenset()
+    # (url, content) of the linked stylesheets fetched, kept for the shadow
+    # candidate
+    _linked_contents = ()
+    # (offset, compiled rules) of the <style> elements parsed while
+    # preserving media queries; the rules cascade after the CSS before
+    # `offset` in `style_string` and before the CSS after it
+    _internal_rules = None
+    # the cssutils parser, kept for every document
+    _css_parser = None
+    # the result cache key of a run that looks up linked stylesheets, or
+    # _PENDING until they are fetched
+    _cache_key = None
+    # the worker processes of `processes`, started by the first large document
+    _pool = None
 
     def __init__(self, log=None,
         allow_conditional_comments=False,
         preserve_media_queries=False,
         preserve_unknown_rules=False,
-        ingore_unsupported_selectors=False):
+        ingore_unsupported_selectors=False,
+        fetcher=None,
+        cache=None,
+        matcher='python',
+        processes=None,
+        optimize_output=False,
+        fold_shorthands=False,
+        css_parser='cssutils',
+        prune_media_queries=False,
+        shadow=None,
+        budget=None,
+        low_memory=False):
 
         self.log = log
         cssutils.log.enabled = False if log is None else True
         self.extra_style_strings = []
+        self.compiled_stylesheets = []
         self.allow_conditional_comments = allow_conditional_comments
         self.preserve_media_queries = preserve_media_queries
         self.preserve_unknown_rules = preserve_unknown_rules
         self.ingore_unsupported_selectors = ingore_unsupported_selectors
+        self.fetcher = fetcher if fetcher is not None else UrllibFetcher()
+        self.cache = cache
+        if matcher not in ('python', 'numpy'):
+            raise ValueError("matcher must be 'python' or 'numpy', not %r" % matcher)
+        self.matcher = matcher
+        self.processes = processes
+        self.optimize_output = optimize_output
+        self.fold_shorthands = fold_shorthands
+        if css_parser not in ('cssutils', 'fast'):
+            raise ValueError("css_parser must be 'cssutils' or 'fast', not %r" % css_parser)
+        self.css_parser = css_parser
+        self.prune_media_queries = prune_media_queries
+        self.shadow = shadow
+        self.budget = budget
+        self.low_memory = low_memory
 
         self.root_url = None
         self.relative_url = None
+        self.reset()
+
+    def reset(self):
+        """Forgets the current document and everything derived from it so
+        that another document can be inlined. The options, the CSS added
+        with `with_cssString` and `with_compiled`, the base URLs of linked
+        stylesheets and the CSS parser are kept. `from_url`, `from_string`
+        and `from_fragment` reset the Pynliner first.
+
+        Returns self.
+
+        >>> p = Pynliner().with_compiled(compiled)
+        >>> outputs = [p.from_string(html).run() for html in documents]
+        """
+        self._release_intermediates()
+        self.source_string = None
+        self.fragment_ancestors = None
+        self.output = False
+        self.budget_exceeded = None
+        # bytes the output optimizations removed from the last run
+        self.bytes_saved = 0
+        return self
+
+    def close(self):
+        """Stops the worker processes a Pynliner with `processes` started.
+        They are started again by a later run that needs them.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = parallel.create_pool(self.processes)
+        return self._pool
+
+    def _release_intermediates(self):
+        """Drops the parsed document and stylesheets of the current run"""
+        self.soup = False
+        self.style_string = False
+        self.stylesheet = False
+        self._internal_rules = None
+        self._declared_properties = frozenset()
+        self._inline_properties = frozenset()
+        self._linked_contents = ()
+        self._fragment_parent = None
 
     def from_url(self, url):
         """Gets remote HTML page for conversion
@@ -83,6 +322,7 @@ class Pynliner(object):
         >>> p.from_url('http://somewebsite.com/file.html')
         <Pynliner object at 0x26ac70>
         """
+        self.reset()
         self.url = url
         self.relative_url = '/'.join(url.split('/')[:-1]) + '/'
         self.root_url = '/'.join(url.split('/')[:3])
@@ -98,7 +338,30 @@ class Pynliner(object):
         >>> p.from_string('<style>h1 {color:#ffcc00;}</style><h1>Hi</h1>')
         <Pynliner object at 0x26ac70>
         """
+        self.reset()
+        self.source_string = string
+        return self
+
+    def from_fragment(self, string, ancestors=()):
+        """Generates a Pynliner object for an HTML fragment that will be
+        inserted into an already inlined document. Only the fragment is
+        styled and output.
+
+        `ancestors` describes the elements the fragment is inserted into,
+        outermost first, so that descendant and child selectors resolve as
+        they would in the document. Each is a compound selector such as
+        'td.total#sum[data-role=price]' or a (name, attrs) pair. The
+        ancestors are matched as if they had no siblings.
+
+        Returns self.
+
+        >>> p = Pynliner().with_compiled(compiled)
+        >>> p.from_fragment('<td>9.99</td>', ['table.order', 'tbody', 'tr'])
+        <Pynliner object at 0x26ac70>
+        """
+        self.reset()
         self.source_string = string
+        self.fragment_ancestors = tuple(ancestors)
         return self
 
     def with_cssString(self, css_string):
@@ -115,6 +378,21 @@ class Pynliner(object):
         self.extra_style_strings.append(css_string)
         return self
 
+    def with_compiled(self, compiled):
+        """Adds a CompiledStylesheet to the Pynliner object. Can be "chained".
+        Its rules cascade after all other CSS. When preserving media queries,
+        its preserved rules are written to a new <style> element.
+
+        Returns self.
+
+        >>> compiled = pynliner.compile_css("h1 { color:#ffcc00; }")
+        >>> p = Pynliner()
+        >>> p.from_string("<h1>Hello World!</h1>").with_compiled(compiled)
+        <pynliner.Pynliner object at 0x2ca810>
+        """
+        self.compiled_stylesheets.append(compiled)
+        return self
+
     def run(self):
         """Applies each step of the process if they have not already been
         performed.
@@ -124,25 +402,255 @@ class Pynliner(object):
         >>> html = "<style>h1 { color:#ffcc00; }</style><h1>Hello World!</h1>"
         >>> Pynliner().from_string(html).run()
         u'<h1 style="color: #fc0">Hello World!</h1>'
+
+        With a result cache, an output stored for the same HTML, CSS and
+        options is returned without parsing anything. A document with <link>
+        elements is parsed and its stylesheets fetched first, as their
+        content is part of the cache key.
+
+        With a budget, raises BudgetExceeded when the run goes over it, or
+        with a degrading budget returns the document unchanged and sets
+        `self.budget_exceeded`.
+
+        With `low_memory`, the parsed document and stylesheets are dropped
+        once the output is produced; only `self.output` is kept.
         """
+        cache_key = None
+        self._cache_key = None
+        if self.cache is not None and not self.soup:
+            if _link_regex.search(self.source_string):
+                # looked up by _get_external_styles
+                self._cache_key = _PENDING
+            else:
+                cache_key = self._get_cache_key()
+                output = self.cache.get(cache_key)
+                if output is not None:
+                    self.output = output
+                    return self.output
+
+        shadow_started = None
+        if self.shadow is not None:
+            shadow_started = self.shadow.start()
+
+        self.budget_exceeded = None
+        if self.budget is not None:
+            self._meter = BudgetMeter(self.budget)
+        try:
+            self._inline()
+        except _CacheHit, hit:
+            self.output = hit.output
+            if self.low_memory:
+                self._release_intermediates()
+            return self.output
+        except BudgetExceeded, ex:
+            if not self.budget.degrade:
+                raise
+            self.budget_exceeded = ex
+            self.output = self._source_text()
+            if self.low_memory:
+                self._release_intermediates()
+            return self.output
+        finally:
+            self._meter = None
+
+        if self._cache_key not in (None, _PENDING):
+            cache_key = self._cache_key
+        if cache_key is not None:
+            self.cache.set(cache_key, self.output)
+        if shadow_started is not None:
+            self.shadow.finish(self, shadow_started)
+        if self.low_memory:
+            self._release_intermediates()
+        return self.output
+
+    def _inline(self):
+        """Performs the steps of `run` that have not been performed yet"""
         if not self.soup:
             self._get_soup()
+            if self._meter is not None and self._meter.limits('elements'):
+                self._meter.charge('elements', len(self.soup.findAll(True)))
+        self._checkpoint()
         if not self.stylesheet:
             self._get_styles()
+        self._checkpoint()
 
         previous_spacer = cssutils.ser.prefs.propertyNameSpacer
         cssutils.ser.prefs.propertyNameSpacer = u''
-        self._apply_styles()
-        cssutils.ser.prefs.propertyNameSpacer = previous_spacer
+        try:
+            if self.processes > 1 and parallel.worth_splitting(self.soup):
+                rules = self._get_compiled_rules()
+                # matched in the worker processes
+                self._charge('selector_evaluations',
+                             sum(len(rule.selectors) for rule in rules))
+                parallel.apply_styles(self, rules, self._get_pool())
+            else:
+                self._apply_styles()
+        finally:
+            cssutils.ser.prefs.propertyNameSpacer = previous_spacer
+        self._checkpoint()
 
         self._get_output()
         self._clean_output()
-        return self.output
+
+    def _source_text(self):
+        """Returns the document as it was given, as Unicode"""
+        if isinstance(self.source_string, unicode):
+            return self.source_string
+        return self.source_string.decode('utf-8', 'replace')
+
+    def session(self):
+        """Inlines the document and returns an InliningSession that keeps it
+        inlined as individual rules are inserted, deleted or replaced, only
+        recomputing the elements each edit affects.
+
+        >>> session = Pynliner().from_string(html).session()
+        >>> session.insert_rule('h1 { color: navy; }')
+        >>> session.output()
+        """
+        return InliningSession(self)
+
+    def _get_cache_key(self, linked_contents=()):
+        """Returns the result cache key of the source HTML, the content of
+        its linked stylesheets, the CSS added with `with_cssString` and
+        `with_compiled`, the base URLs linked stylesheets resolve against
+        and the output options.
+        """
+        return make_key(
+            __version__,
+            self.source_string,
+            make_key(*linked_contents),
+            self.root_url,
+            self.relative_url,
+            self.fragment_ancestors,
+            tuple(self.extra_style_strings),
+            tuple(c.fingerprint for c in self.compiled_stylesheets),
+            tuple(getattr(self, name) for name in self._OUTPUT_OPTIONS),
+        )
+
+    def _lookup_linked_cache(self, contents):
+        """Looks a document that may link stylesheets up in the result cache
+        once their `contents` are fetched, stopping the run with _CacheHit
+        """
+        if self._cache_key is not _PENDING:
+            return
+        self._cache_key = self._get_cache_key(contents)
+        output = self.cache.get(self._cache_key)
+        if output is not None:
+            raise _CacheHit(output)
+
+    def run_async(self, executor=None):
+        """Starts `run` in the background and returns an AsyncResult.
+
+        Linked stylesheets are fetched concurrently. The work runs on a new
+        daemon thread, or is submitted to `executor` (any object with a
+        `submit(fn)` method, such as a `concurrent.futures` executor) when
+        one is given.
+
+        >>> html = "<style>h1 { color:#ffcc00; }</style><h1>Hello World!</h1>"
+        >>> Pynliner().from_string(html).run_async().result(timeout=5)
+        u'<h1 style="color: #fc0">Hello World!</h1>'
+        """
+        return self._start_async(self.run, executor)
+
+    def _start_async(self, function, executor=None):
+        """Runs `function` in the background with cancellation checkpoints
+        reporting to a new AsyncResult, which is returned.
+        """
+        async_result = AsyncResult()
+        job = lambda: async_result._run(function)
+        if executor is not None:
+            executor.submit(job)
+        else:
+            thread = threading.Thread(target=job)
+            thread.daemon = True
+            thread.start()
+        return async_result
+
+    def _checkpoint(self):
+        """Called between the steps of a run; stops a cancelled background
+        run by raising InliningCancelled, and a run whose time budget is up
+        by raising BudgetExceeded. Cancelling concerns the background run
+        of the current thread only, so a Pynliner whose background run was
+        cancelled can inline other documents.
+        """
+        async_result = getattr(_current_run, 'result', None)
+        if async_result is not None and async_result.cancelled():
+            raise InliningCancelled()
+        if self._meter is not None:
+            self._meter.check_time()
+
+    def _charge(self, resource, amount=1):
+        """Counts `amount` of `resource` against the budget of the run"""
+        if self._meter is not None:
+            self._meter.charge(resource, amount)
 
     def _get_url(self, url):
-        """Returns the response content from the given url
+        """Returns the response content from the given url using
+        `self.fetcher`. Within a budget, the download is limited to the
+        fetch bytes and the time left.
+        """
+        meter = self._meter
+        if meter is None:
+            return self.fetcher.fetch(url)
+        meter.check_time()
+        max_bytes = meter.remaining('fetch_bytes')
+        try:
+            content = fetch_limited(self.fetcher, url, max_bytes, meter.remaining_seconds())
+        except ResponseTooLarge, ex:
+            if ex.max_bytes == max_bytes:
+                meter.charge('fetch_bytes', max_bytes + 1)
+            raise
+        except Exception:
+            # the download may have been stopped by the time limit
+            meter.check_time()
+            raise
+        meter.charge('fetch_bytes', len(content))
+        return content
+
+    def _get_urls(self, urls):
+        """Returns the response contents of several urls, in order, fetching
+        them concurrently on up to _FETCH_THREADS threads. The threads stop
+        taking urls once one fails or the run is cancelled.
         """
-        return urllib2.urlopen(url).read()
+        if len(urls) < 2:
+            return [self._get_url(url) for url in urls]
+
+        contents = [None] * len(urls)
+        errors = []
+        pending = iter(enumerate(urls))
+        lock = threading.Lock()
+        async_result = getattr(_current_run, 'result', None)
+
+        def fetch():
+            # cancelling the run reaches the checkpoints of this thread too
+            _current_run.result = async_result
+            while True:
+                with lock:
+                    if errors:
+                        return
+                    try:
+                        i, url = next(pending)
+                    except StopIteration:
+                        return
+                try:
+                    self._checkpoint()
+                    contents[i] = self._get_url(url)
+                except Exception:
+                    with lock:
+                        errors.append(sys.exc_info())
+
+        threads = [threading.Thread(target=fetch)
+                   for _ in range(min(_FETCH_THREADS, len(urls)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            error = errors[0]
+            raise error[0], error[1], error[2]
+        return contents
 
     def _get_soup(self):
         """Convert source string to BeautifulSoup object. Sets it to self.soup.
@@ -154,22 +662,91 @@ class Pynliner(object):
         # - see http://code.google.com/p/modwsgi/wiki/TipsAndTricks
         try:
             from mod_wsgi import version
-            self.soup = BeautifulSoup(self.source_string, "html5lib")
+            self.soup = bs.BeautifulSoup(self.source_string, "html5lib")
         except:
-            self.soup = BeautifulSoup(self.source_string)
+            self.soup = bs.BeautifulSoup(self.source_string)
+        if self.fragment_ancestors is not None:
+            self._wrap_fragment()
+
+    def _wrap_fragment(self):
+        """Moves the parsed fragment into a new soup made of its ancestors"""
+        fragment = self.soup
+        self.soup = bs.BeautifulSoup('')
+        parent = self.soup
+        for ancestor in self.fragment_ancestors:
+            tag = _ancestor_tag(self.soup, ancestor)
+            parent.insert(len(parent.contents), tag)
+            parent = tag
+        for child in list(fragment.contents):
+            parent.insert(len(parent.contents), child)
+        self._fragment_parent = parent
 
     def _get_styles(self):
         """Gets all CSS content from and removes all <link rel="stylesheet"> and
         <style> tags concatenating into one CSS string which is then parsed with
         cssutils and the resulting CSSStyleSheet object set to
-        `self.stylesheet`.
+        `self.stylesheet`. With the fast CSS parser, or when preserving
+        media queries, `self.stylesheet` is a CompiledStylesheet instead.
         """
         self._get_external_styles()
         self._get_internal_styles()
         for style_string in self.extra_style_strings:
+            self._charge('css_bytes', _utf8_size(style_string))
             self.style_string += style_string
-        cssparser = cssutils.CSSParser(log=self.log)
-        self.stylesheet = cssparser.parseString(self.style_string)
+        if self._internal_rules is not None:
+            # the <style> elements are parsed already
+            offset, internal_rules = self._internal_rules
+            rules = self._parse_rules(self.style_string[:offset])
+            rules.extend(internal_rules)
+            rules.extend(self._parse_rules(self.style_string[offset:]))
+            self.stylesheet = CompiledStylesheet(rules)
+        else:
+            self.stylesheet = self._parse_css(self.style_string)
+        self._insert_compiled_preserved_styles()
+
+    def _parse_css(self, css_string):
+        """Parses `css_string` into a CompiledStylesheet with the fast CSS
+        parser, or else into a cssutils CSSStyleSheet
+        """
+        parsed = None
+        if self.css_parser == 'fast':
+            parsed = fastcss.parse_stylesheet(css_string)
+        if parsed is not None:
+            return CompiledStylesheet(parsed[0])
+        return self._get_css_parser().parseString(css_string)
+
+    def _get_css_parser(self):
+        """Returns the cssutils parser, which is kept for every document"""
+        if self._css_parser is None:
+            self._css_parser = cssutils.CSSParser(log=self.log)
+        return self._css_parser
+
+    def _parse_rules(self, css_string):
+        """Returns the compiled style rules of `css_string`"""
+        if not css_string.strip():
+            return []
+        stylesheet = self._parse_css(css_string)
+        if isinstance(stylesheet, CompiledStylesheet):
+            return list(stylesheet.rules)
+        return compile_stylesheet(stylesheet).rules
+
+    def _insert_compiled_preserved_styles(self):
+        """Writes the preserved rules of compiled stylesheets to a new <style>
+        element in <head>, or at the start of the document without one.
+        """
+        if not self.preserve_media_queries:
+            return
+        preserved = [text for compiled in self.compiled_stylesheets
+                     for text in compiled.preserved]
+        if not preserved:
+            return
+        style_tag = bs.Tag(self.soup, 'style', [('type', 'text/css')])
+        style_tag.insert(0, u'\n' + u'\n'.join(preserved) + u'\n')
+        head = self.soup.find('head')
+        if head is not None:
+            head.insert(len(head.contents), style_tag)
+        else:
+            self.soup.insert(0, style_tag)
 
     def _get_external_styles(self):
         """Gets <link> element styles
@@ -182,21 +759,31 @@ class Pynliner(object):
         link_tags = self.soup.findAll('link', {'rel': 'stylesheet'})
 
         if not link_tags:
+            self._lookup_linked_cache(())
             return
 
-        css_parser = cssutils.CSSParser(log=self.log)
-
-        for tag in link_tags:
-            url = tag['href']
+        css_parser = self._get_css_parser()
 
-            # Convert the relative URL to an absolute URL ready to pass to urllib
-            base_url = self.relative_url or self.root_url
-            url = urlparse.urljoin(base_url, url)
-
-            content = self._get_url(url)
+        # Convert the relative URLs to absolute URLs ready to pass to urllib
+        base_url = self.relative_url or self.root_url
+        urls = [urlparse.urljoin(base_url, tag['href']) for tag in link_tags]
+        contents = self._get_urls(urls)
+        if self.shadow is not None:
+            self._linked_contents = zip(urls, contents)
+        self._checkpoint()
+        self._lookup_linked_cache(contents)
 
+        for tag, content in zip(link_tags, contents):
+            self._charge('css_bytes', _utf8_size(content))
             # Sanity check. Is this even a CSS stylesheet? If not, then move on.
-            if not css_parser.parseString(content).cssRules:
+            parsed = None
+            if self.css_parser == 'fast':
+                parsed = fastcss.parse_stylesheet(content)
+            if parsed is not None:
+                rules, skipped = parsed
+                if not rules and not skipped:
+                    continue
+            elif not css_parser.parseString(content).cssRules:
                 continue
 
             self.style_string += content
@@ -211,112 +798,232 @@ class Pynliner(object):
             self.style_string += u'\n'
 
         # Parse out the media queries and save them in one style block.
+        self._internal_rules = None
         if self.preserve_media_queries:
-            css_parser = cssutils.CSSParser(log=self.log)
+            css_parser = self._get_css_parser()
+            preserve_types = preserved_rule_types()
+            internal_rules = []
+            self._internal_rules = (len(self.style_string), internal_rules)
 
+        preserved = []
         style_tags = self.soup.findAll('style')
         for tag in style_tags:
             strings_and_comments = filter(lambda c: isinstance(c, basestring), tag.contents)
+            self._charge('css_bytes', sum(_utf8_size(s) for s in strings_and_comments))
 
             if not self.preserve_media_queries:
                 self.style_string += u'\n'.join(strings_and_comments) + u'\n'
                 tag.extract()
-            else:
-                stylesheet = css_parser.parseString('\n'.join(strings_and_comments))
-                media_stylesheet = cssutils.css.CSSStyleSheet()
-                other_stylesheet = cssutils.css.CSSStyleSheet()
-
-                for rule in stylesheet.cssRules:
-                    if rule.type in _CSS_RULE_TYPES_TO_PRESERVE or \
-                        (self.preserve_unknown_rules and rule.type == cssutils.css.CSSRule.UNKNOWN_RULE):
-                        media_stylesheet.add(rule)
-                    else:
-                        other_stylesheet.add(rule)
-
-                if media_stylesheet.cssRules:
-                    new_tag = Tag(self.soup, 'style')
-                    for attr_name, attr_value in tag.attrs:
-                        new_tag[attr_name] = attr_value
-                    new_tag.insert(0, u'\n' + media_stylesheet.cssText.decode('utf-8') + u'\n')
-                    tag.replaceWith(new_tag)
-
-                    self.style_string += other_stylesheet.cssText.decode('utf-8') + u'\n'
-                else:
-                    self.style_string += u'\n'.join(strings_and_comments) + u'\n'
-                    tag.extract()
+                continue
 
-    def _get_specificity_from_list(self, lst):
-        """
-        Takes an array of ints and returns an integer formed
-        by adding all ints multiplied by the power of 10 of the current index
+            # style rules go to the cascade as parsed, preserved rules are
+            # written as they were in the source
+            css_string = u'\n'.join(strings_and_comments)
+            rules = [rule for rule in css_parser.parseString(css_string).cssRules
+                     if rule.type != cssutils.css.CSSRule.COMMENT]
+            spans = fastcss.rule_spans(css_string)
+            if spans is not None and len(spans) != len(rules):
+                # cssutils dropped a rule it could not parse
+                spans = None
+            preserved_rules = []
+            for i, rule in enumerate(rules):
+                if rule.type == cssutils.css.CSSRule.STYLE_RULE:
+                    internal_rules.append(compile_rule(rule))
+                elif rule.type in preserve_types or \
+                    (self.preserve_unknown_rules and rule.type == cssutils.css.CSSRule.UNKNOWN_RULE):
+                    text = None
+                    if spans is not None:
+                        text = css_string[spans[i][0]:spans[i][1]]
+                        if not text.startswith(u'@'):
+                            text = None
+                    preserved_rules.append((rule, text))
+
+            if preserved_rules:
+                new_tag = bs.Tag(self.soup, 'style')
+                for attr_name, attr_value in tag.attrs:
+                    new_tag[attr_name] = attr_value
+                tag.replaceWith(new_tag)
+                preserved.append((new_tag, preserved_rules))
+            else:
+                tag.extract()
 
-        (1, 0, 0, 1) => (1 * 10**3) + (0 * 10**2) + (0 * 10**1) + (1 * 10**0) => 1001
-        """
-        return int(''.join(map(str, lst)))
+        # written once all other <style> elements are gone, which pruning
+        # must not match
+        if self.prune_media_queries and preserved:
+            select = self._selector_function()
+        for tag, preserved_rules in preserved:
+            texts = []
+            for rule, text in preserved_rules:
+                if self.prune_media_queries and \
+                        rule.type == cssutils.css.CSSRule.MEDIA_RULE and \
+                        prune_media_rule(rule, select):
+                    if not rule.cssRules:
+                        continue
+                    text = None
+                if text is None:
+                    text = rule.cssText
+                texts.append(text)
+            if not texts:
+                tag.extract()
+                continue
+            tag.insert(0, u'\n' + u'\n'.join(texts) + u'\n')
 
-    def _get_rule_specificity(self, rule):
+    def _get_compiled_rules(self):
+        """Returns the compiled style rules of `self.stylesheet` followed by
+        those of every stylesheet added with `with_compiled`
         """
-        For a given CSSRule get its selector specificity in base 10
+        if isinstance(self.stylesheet, CompiledStylesheet):
+            rules = list(self.stylesheet.rules)
+        else:
+            rules = compile_stylesheet(self.stylesheet).rules
+        for compiled in self.compiled_stylesheets:
+            rules.extend(compiled.rules)
+        return rules
+
+    def _selector_function(self):
+        """Returns a function selecting the elements of `self.soup` that
+        parsed selector steps match, with the configured matcher. Long
+        selections pass checkpoints, so they stop once cancelled or out of
+        time.
         """
-        return sum(map(self._get_specificity_from_list, (s.specificity for s in rule.selectorList)))
+        if self.matcher == 'numpy':
+            matcher = BitsetMatcher(self.soup)
+            return lambda steps: matcher.select_steps(steps, self._checkpoint)
+        sibling_index = SiblingIndex()
+        return lambda steps: select_steps(self.soup, steps, sibling_index, self._checkpoint)
 
-    def _apply_styles(self):
+    def _apply_styles(self, rules=None, inline_names=None):
         """Steps through CSS rules and applies each to all the proper elements
         as @style attributes prepending any current @style attributes.
+        `rules` defaults to the compiled rules of every stylesheet, and
+        `inline_names` to the properties the @style attributes of the soup
+        declare.
         """
-        rules = self.stylesheet.cssRules.rulesOfType(1)
-        elem_prop_map = {}
-        elem_style_map = {}
-
-        # build up a property list for every styled element
-        for rule in rules:
-            # select elements for every selector
-            selectors = map(lambda s: s.strip(), rule.selectorText.split(','))
-            elements = []
-
-            for selector in selectors:
-                try:
-                    elements += select(self.soup, selector)
-                except SelectorNotSupportedException, ex:
+        if rules is None:
+            rules = self._get_compiled_rules()
+        if self.fold_shorthands:
+            self._declared_properties = frozenset(
+                name for rule in rules for name, _ in rule.properties)
+            if inline_names is None:
+                inline_names = inline_properties(self.soup)
+            self._inline_properties = inline_names
+        elem_match_map = {}
+        select = self._selector_function()
+
+        # build up a list of match records for every styled element
+        for rule_index, rule in enumerate(rules):
+            # select elements for every selector, keeping the most specific
+            # selector when an element is matched by several of them
+            rule_match_map = {}
+            for selector, specificity, steps in rule.selectors:
+                self._checkpoint()
+                if steps is None:
                     if self.ingore_unsupported_selectors:
-                        pass
+                        continue
                     else:
-                        raise
-
-            # build prop_list for each selected element
-            for elem in elements:
-                if elem not in elem_prop_map:
-                    elem_prop_map[elem] = []
-                elem_prop_map[elem].append({
-                    'specificity': self._get_rule_specificity(rule),
-                    'props': rule.style.getProperties(),
-                })
-
-        # build up another property list using selector specificity
-        for elem, props in elem_prop_map.items():
-            if elem not in elem_style_map:
-                elem_style_map[elem] = cssutils.css.CSSStyleDeclaration()
-            # ascending sort of prop_lists based on specificity
-            props = sorted(props, key=lambda p: p['specificity'])
-            # for each prop_list, apply to CSSStyleDeclaration
-            for prop_list in map(lambda obj: obj['props'], props):
-                for prop in prop_list:
-                    elem_style_map[elem][prop.name] = prop.value
-
-
-        # apply rules to elements
-        for elem, style_declaration in elem_style_map.items():
-            if elem.has_key('style'):
-                elem['style'] = u'%s;%s' % (style_declaration.cssText.replace('\n', ''), elem['style'])
+                        raise SelectorNotSupportedException(selector)
+                self._charge('selector_evaluations')
+                elements = select(steps)
+
+                match = _StyleMatch(specificity, rule_index)
+                for elem in elements:
+                    previous = rule_match_map.get(elem)
+                    if previous is None or previous.specificity < specificity:
+                        rule_match_map[elem] = match
+
+            for elem, match in rule_match_map.iteritems():
+                if elem not in elem_match_map:
+                    elem_match_map[elem] = []
+                elem_match_map[elem].append(match)
+
+        # cascade and apply rules to elements, releasing each element's
+        # match records as soon as its style has been set and serializing
+        # each distinct combination of declarations only once
+        style_strings = {}
+        optimized_styles = {}
+        while elem_match_map:
+            self._checkpoint()
+            elem, matches = elem_match_map.popitem()
+            # ascending sort of matches on specificity, then source order
+            matches.sort(key=_match_sort_key)
+            declarations = OrderedDict()
+            for match in matches:
+                for name, value in rules[match.rule_index].properties:
+                    declarations[name] = value
+            declarations = tuple(declarations.iteritems())
+
+            style_string = style_strings.get(declarations)
+            if style_string is None:
+                style_string = self._serialize_declarations(declarations)
+                style_strings[declarations] = style_string
+            if self.optimize_output:
+                elem['style'] = self._optimize_style(
+                    declarations, style_string, elem.get('style'), optimized_styles)
+            elif elem.has_key('style'):
+                elem['style'] = u'%s;%s' % (style_string, elem['style'])
+            else:
+                elem['style'] = style_string
+
+    def _optimize_style(self, declarations, style_string, inline, optimized_styles):
+        """Returns the @style of an element with `declarations` applied over
+        its `inline` style, merging the two and dropping overridden
+        declarations. Adds the bytes saved over appending the inline style
+        to `self.bytes_saved`.
+        """
+        key = (declarations, inline)
+        try:
+            style, saved = optimized_styles[key]
+        except KeyError:
+            if inline is None:
+                appended = style_string
+                inline_declarations = ()
+            else:
+                appended = u'%s;%s' % (style_string, inline)
+                inline_declarations = parse_inline_style(inline)
+            if inline_declarations is None:
+                style = appended
             else:
-                elem['style'] = style_declaration.cssText.replace('\n', '')
-        
+                merged = merge_declarations(declarations, inline_declarations)
+                if merged == declarations:
+                    style = style_string
+                else:
+                    style = self._serialize_declarations(merged)
+            saved = len(appended.encode('utf-8')) - len(style.encode('utf-8'))
+            optimized_styles[key] = (style, saved)
+        self.bytes_saved += saved
+        return style
+
+    def _serialize_declarations(self, declarations):
+        """Serializes a sequence of (name, value) pairs as the contents of a
+        @style attribute. With `fold_shorthands`, complete sets of longhand
+        declarations are serialized as shorthands.
+        """
+        if self.fold_shorthands:
+            declarations = fold_shorthands(declarations, self._declared_properties,
+                                           self._inline_properties)
+        style_declaration = cssutils.css.CSSStyleDeclaration()
+        for name, value in declarations:
+            style_declaration[name] = value
+        return style_declaration.cssText.replace('\n', '')
+
     def _get_output(self):
         """Generate Unicode string of `self.soup` and set it to `self.output`
 
         Returns self.output
         """
-        self.output = unicode(self.soup)
+        if self.optimize_output:
+            self.bytes_saved += collapse_block_white_space(self.soup)
+        return self._serialize_output()
+
+    def _serialize_output(self):
+        """Sets `self.output` to the Unicode string of `self.soup`, or of the
+        fragment, and returns it
+        """
+        if self._fragment_parent is not None:
+            self.output = u''.join(
+                unicode(child) for child in self._fragment_parent.contents)
+        else:
+            self.output = unicode(self.soup)
         return self.output
     
     def _clean_output(self):
@@ -332,6 +1039,32 @@ class Pynliner(object):
                                self.output[match.end():])
 
 
+def _utf8_size(string):
+    if isinstance(string, unicode):
+        return len(string.encode('utf-8'))
+    return len(string)
+
+
+def _ancestor_tag(soup, ancestor):
+    """Builds a Tag of `soup` from an ancestor description of
+    `Pynliner.from_fragment`
+    """
+    if not isinstance(ancestor, basestring):
+        name, attrs = ancestor
+        if isinstance(attrs, dict):
+            attrs = attrs.items()
+        return bs.Tag(soup, name, list(attrs))
+
+    compound = parse_compound(ancestor)
+    if compound.tag is True:
+        raise ValueError('ancestor %r has no tag name' % ancestor)
+    attrs = [('id', id_) for id_ in compound.ids]
+    if compound.classes:
+        attrs.append(('class', u' '.join(compound.classes)))
+    attrs.extend((attribute, value) for _, attribute, value in compound.attributes)
+    return bs.Tag(soup, compound.tag, attrs)
+
+
 def fromURL(url, log=None):
     """Shortcut Pynliner constructor. Equivalent to:
 
@@ -349,3 +1082,74 @@ def fromString(string, log=None):
     Returns processed HTML string.
     """
     return Pynliner(log).from_string(string).run()
+
+def fromURLAsync(url, log=None, executor=None):
+    """Background equivalent of `fromURL`: downloads and processes the page
+    without blocking the caller.
+
+    Returns an AsyncResult whose `result()` is the processed HTML string.
+    """
+    p = Pynliner(log)
+    return p._start_async(lambda: p.from_url(url).run(), executor)
+
+def fromStringAsync(string, log=None, executor=None):
+    """Background equivalent of `fromString`.
+
+    Returns an AsyncResult whose `result()` is the processed HTML string.
+    """
+    return Pynliner(log).from_string(string).run_async(executor)
+
+# a small document using every kind of selector and CSS the cascade handles
+_WARMUP_HTML = u"""<html><head><style type="text/css">
+p.a > span:first-child, #b + p[title^=t], li:nth-child(odd) ~ li { color: #fc0; margin: 0 !important }
+/* comment */ ul li { padding: 1px 2px; font: bold 12px/1.5 Arial, sans-serif }
+@media screen { p { color: red } }
+</style></head><body><p class="a" id="b"><span>x</span></p><p title="t" style="color: blue">y</p>
+<ul><li>1</li><li>2</li><li>3</li></ul></body></html>"""
+
+# modules pynliner imports on first use
+_DEPENDENCIES = ('cssutils', 'BeautifulSoup', 'urlparse', 'urllib2', 'httplib', 'tempfile')
+
+def warmup(css_sources=(), selectors=(), **options):
+    """Builds the state inlining needs in a server's master process, before
+    it forks its workers, so that they start at full speed and share one
+    copy of it instead of each building their own.
+
+    Imports the dependencies, compiles `css_sources`, CSS strings or
+    CompiledStylesheets, parses `selectors` into the selector cache and
+    inlines a small document with the Pynliner `options` the workers use,
+    which fills the regular expression caches of soupselect and cssutils.
+    Finally collects garbage, which untracks the declaration and
+    specificity tuples of the compiled rules, so that collections in the
+    workers do not write to the pages they are on.
+
+    Returns a CompiledStylesheet for each of `css_sources`, to pass to
+    `with_compiled` in the workers.
+
+    >>> site_css = pynliner.warmup([open('site.css').read()], matcher='numpy')
+    >>> # after fork, in a worker
+    >>> Pynliner(matcher='numpy').from_string(html).with_compiled(site_css[0]).run()
+    """
+    import gc
+    import importlib
+    for name in _DEPENDENCIES:
+        importlib.import_module(name)
+
+    compiled = []
+    for source in css_sources:
+        if not isinstance(source, CompiledStylesheet):
+            source = compile_css(source, options.get('log'),
+                                 options.get('preserve_unknown_rules', False))
+        # computed now rather than in every worker
+        source.fingerprint
+        compiled.append(source)
+    for selector in selectors:
+        try:
+            parse_selector(selector)
+        except SelectorNotSupportedException:
+            pass
+
+    options = dict(options, cache=None, processes=None)
+    Pynliner(**options).from_string(_WARMUP_HTML).run()
+    gc.collect()
+    return compiled
@@ -0,0 +1,300 @@
+"""Command line batch inliner.
+
+    python -m pynliner --css site.css -j 4 --output-dir out/ templates/
+    python -m pynliner --css site.css --jsonl < records.jsonl > inlined.jsonl
+
+Inputs are HTML files, directories searched for *.html and *.htm files, or
+JSON Lines records with an "html" and an optional "id" field read from
+stdin. Every --css file is compiled once and applied after the CSS of each
+document. Results are written in input order, either as files under
+--output-dir or as JSON Lines on stdout; a document whose file name is
+taken by an earlier one fails instead of overwriting it. A record is
+printed for every document with its id, the time it took and its output or
+error. At most a few documents per worker are in memory at a time.
+"""
+
+import argparse
+import collections
+import json
+import os
+import re
+import sys
+import time
+
+from pynliner import Pynliner, CompiledStylesheet, Budget, compile_css
+from pynliner.fetchers import UrllibFetcher
+from pynliner.cache import DiskCache
+
+HTML_EXTENSIONS = ('.html', '.htm')
+
+# documents in flight per worker process
+_WINDOW_PER_JOB = 2
+
+# set in each worker by _init_worker
+_worker = {}
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m pynliner',
+        description='Inline CSS into HTML documents in batch.')
+    parser.add_argument('paths', nargs='*', metavar='path',
+                        help='HTML files or directories to inline')
+    parser.add_argument('--jsonl', action='store_true',
+                        help='read JSON Lines records with "html" and "id" fields from stdin')
+    parser.add_argument('--css', action='append', default=[], metavar='FILE',
+                        help='CSS file applied to every document, may be repeated')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='worker processes (default: %(default)s)')
+    parser.add_argument('-o', '--output-dir',
+                        help='write documents under this directory instead of '
+                             'as JSON Lines on stdout')
+    parser.add_argument('--encoding', default='utf-8',
+                        help='encoding of HTML files (default: %(default)s)')
+
+    options = parser.add_argument_group('Pynliner options')
+    options.add_argument('--log', action='store_true',
+                         help='log CSS parsing problems to stderr')
+    options.add_argument('--allow-conditional-comments', action='store_true')
+    options.add_argument('--preserve-media-queries', action='store_true')
+    options.add_argument('--preserve-unknown-rules', action='store_true')
+    options.add_argument('--prune-media-queries', action='store_true')
+    options.add_argument('--ignore-unsupported-selectors', action='store_true')
+    options.add_argument('--matcher', choices=('python', 'numpy'), default='python')
+    options.add_argument('--processes', type=int,
+                         help='processes inlining each document')
+    options.add_argument('--optimize-output', action='store_true')
+    options.add_argument('--fold-shorthands', action='store_true')
+    options.add_argument('--css-parser', choices=('cssutils', 'fast'), default='cssutils')
+    options.add_argument('--low-memory', action='store_true',
+                         help='drop parsed documents as soon as they are inlined')
+    options.add_argument('--fetch-timeout', type=float,
+                         help='timeout in seconds for linked stylesheets')
+    options.add_argument('--fetch-max-bytes', type=int,
+                         help='largest linked stylesheet to download')
+    options.add_argument('--cache-dir',
+                         help='directory of a result cache shared by the workers')
+    options.add_argument('--cache-max-bytes', type=int, default=256 * 1024 * 1024)
+
+    budget = parser.add_argument_group('budget per document')
+    budget.add_argument('--max-seconds', type=float)
+    budget.add_argument('--max-elements', type=int)
+    budget.add_argument('--max-css-bytes', type=int)
+    budget.add_argument('--max-fetch-bytes', type=int)
+    budget.add_argument('--max-selector-evaluations', type=int)
+    budget.add_argument('--degrade', action='store_true',
+                        help='output a document that goes over budget unchanged '
+                             'instead of failing it')
+    return parser
+
+
+def _budget(args):
+    limits = {
+        'seconds': args.max_seconds,
+        'elements': args.max_elements,
+        'css_bytes': args.max_css_bytes,
+        'fetch_bytes': args.max_fetch_bytes,
+        'selector_evaluations': args.max_selector_evaluations,
+    }
+    if all(limit is None for limit in limits.values()):
+        return None
+    return Budget(degrade=args.degrade, **limits)
+
+
+def _pynliner_options(args):
+    """Returns the keyword arguments for Pynliner that can be sent to a
+    worker. Objects such as the logger are created in the worker.
+    """
+    return {
+        'log': args.log,
+        'allow_conditional_comments': args.allow_conditional_comments,
+        'preserve_media_queries': args.preserve_media_queries,
+        'preserve_unknown_rules': args.preserve_unknown_rules,
+        'prune_media_queries': args.prune_media_queries,
+        'ingore_unsupported_selectors': args.ignore_unsupported_selectors,
+        'matcher': args.matcher,
+        'processes': args.processes,
+        'optimize_output': args.optimize_output,
+        'fold_shorthands': args.fold_shorthands,
+        'css_parser': args.css_parser,
+        'low_memory': args.low_memory,
+        'budget': _budget(args),
+        'fetch_timeout': args.fetch_timeout,
+        'fetch_max_bytes': args.fetch_max_bytes,
+        'cache_dir': args.cache_dir,
+        'cache_max_bytes': args.cache_max_bytes,
+        'encoding': args.encoding,
+    }
+
+
+def _init_worker(compiled_data, options, output_dir):
+    options = dict(options)
+    if options.pop('log'):
+        import logging
+        logging.basicConfig()
+        options['log'] = logging.getLogger('pynliner')
+    options['fetcher'] = UrllibFetcher(timeout=options.pop('fetch_timeout'),
+                                       max_bytes=options.pop('fetch_max_bytes'))
+    cache_dir = options.pop('cache_dir')
+    cache_max_bytes = options.pop('cache_max_bytes')
+    if cache_dir:
+        options['cache'] = DiskCache(cache_dir, cache_max_bytes)
+    _worker['encoding'] = options.pop('encoding')
+    # one Pynliner inlines every document, keeping its --processes workers
+    inliner = Pynliner(**options)
+    for data in compiled_data:
+        inliner.with_compiled(CompiledStylesheet.loads(data))
+    _worker['inliner'] = inliner
+    _worker['output_dir'] = output_dir
+
+
+def _inline(task):
+    """Inlines one document. Returns its result record."""
+    start = time.time()
+    record = collections.OrderedDict([('id', task['id'])])
+    try:
+        html = task.get('html')
+        if html is None:
+            with open(task['path'], 'rb') as f:
+                html = f.read().decode(_worker['encoding'])
+        output = _worker['inliner'].from_string(html).run()
+        if _worker['output_dir']:
+            path = os.path.join(_worker['output_dir'], task['output'])
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # made by another worker in the meantime
+                    if not os.path.isdir(directory):
+                        raise
+            with open(path, 'wb') as f:
+                f.write(output.encode('utf-8'))
+            record['output'] = path
+        else:
+            record['html'] = output
+    except Exception, ex:
+        record['error'] = '%s: %s' % (type(ex).__name__, ex)
+    record['seconds'] = round(time.time() - start, 6)
+    return record
+
+
+def _file_tasks(paths):
+    """Yields a task for every HTML file given or found under a directory"""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield {'id': path, 'path': path, 'output': os.path.basename(path)}
+            continue
+        for directory, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if not filename.lower().endswith(HTML_EXTENSIONS):
+                    continue
+                file_path = os.path.join(directory, filename)
+                yield {'id': file_path, 'path': file_path,
+                       'output': os.path.relpath(file_path, path)}
+
+
+def _jsonl_tasks(lines):
+    """Yields a task for every JSON Lines record. Records without an id get
+    their line number.
+    """
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            task_id = record.get('id', number)
+            filename = re.sub(r'[^\w.-]', '_', unicode(task_id)).lstrip('.')
+            yield {'id': task_id, 'html': record['html'],
+                   'output': '%s.html' % filename}
+        except (ValueError, KeyError, AttributeError), ex:
+            yield {'id': number, 'error': 'invalid record: %s' % ex}
+
+
+def _unique_outputs(tasks):
+    """Fails every task whose output file another task already writes, as
+    files of the same name in different directories or ids that only differ
+    in characters not allowed in file names would
+    """
+    outputs = {}
+    for task in tasks:
+        if 'output' in task:
+            output = os.path.normcase(os.path.normpath(task['output']))
+            if output in outputs:
+                task = {'id': task['id'], 'error': 'output %s is already written for %s'
+                        % (task['output'], outputs[output])}
+            else:
+                outputs[output] = task['id']
+        yield task
+
+
+def _run_task(task):
+    if 'error' in task:
+        return collections.OrderedDict([
+            ('id', task['id']), ('error', task['error']), ('seconds', 0.0)])
+    return _inline(task)
+
+
+def _bounded_imap(pool, function, iterable, window):
+    """Like Pool.imap, but only takes a new item from `iterable` when fewer
+    than `window` results are pending, so memory stays bounded however many
+    items there are
+    """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(function, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def main(argv=None, stdin=None, stdout=None):
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+    parser = _parser()
+    args = parser.parse_args(argv)
+    if not args.paths and not args.jsonl:
+        parser.error('give paths to inline or --jsonl')
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+
+    compiled_data = []
+    for path in args.css:
+        with open(path, 'rb') as f:
+            compiled_data.append(compile_css(
+                f.read(), preserve_unknown_rules=args.preserve_unknown_rules).dumps())
+    initargs = (compiled_data, _pynliner_options(args), args.output_dir)
+
+    tasks = _jsonl_tasks(stdin) if args.jsonl else _file_tasks(args.paths)
+    if args.output_dir:
+        tasks = _unique_outputs(tasks)
+    if args.jobs == 1:
+        _init_worker(*initargs)
+        pool = None
+        results = (_run_task(task) for task in tasks)
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(args.jobs, _init_worker, initargs)
+        results = _bounded_imap(pool, _run_task, tasks, args.jobs * _WINDOW_PER_JOB)
+
+    failed = False
+    try:
+        for record in results:
+            failed = failed or 'error' in record
+            stdout.write(json.dumps(record) + '\n')
+            stdout.flush()
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        else:
+            _worker['inliner'].close()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,33 @@
+"""Deferred imports for the heavy dependencies of pynliner."""
+
+import importlib
+
+
+class LazyModule(object):
+    """Stands in for a module that is only imported when one of its
+    attributes is first used. Attributes are looked up on the module every
+    time, so that replacing them, as mock.patch does, takes effect.
+
+    >>> cssutils = LazyModule('cssutils')
+    >>> cssutils.CSSParser()  # cssutils is imported here
+    """
+
+    def __init__(self, name):
+        self.__dict__['_lazy_name'] = name
+        self.__dict__['_lazy_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            module = importlib.import_module(self.__dict__['_lazy_name'])
+            self.__dict__['_lazy_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        return '<lazy module %r>' % self.__dict__['_lazy_name']
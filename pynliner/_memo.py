@@ -0,0 +1,22 @@
+"""Bounded memo dictionaries for results shared by all documents."""
+
+
+class BoundedDict(dict):
+    """Dictionary holding at most `max_size` entries. Like the caches of the
+    re module it is emptied when full, which keeps lookups as fast as a
+    plain dict's and safe to share between threads.
+
+    >>> memo = BoundedDict(2)
+    >>> memo['a'] = 1; memo['b'] = 2; memo['c'] = 3
+    >>> memo
+    {'c': 3}
+    """
+
+    def __init__(self, max_size):
+        dict.__init__(self)
+        self.max_size = max_size
+
+    def __setitem__(self, key, value):
+        if len(self) >= self.max_size and key not in self:
+            self.clear()
+        dict.__setitem__(self, key, value)
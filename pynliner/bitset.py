@@ -0,0 +1,233 @@
+"""Selector matching over a whole document at once with NumPy.
+
+A BitsetMatcher indexes a document once: every element gets a position in
+document order, a parent and previous element sibling index, and a row in
+a boolean table of tag names, ids, classes and attributes. The table is
+stored by column and each column is only built the first time a selector
+uses it. Compound selectors are then evaluated as boolean operations over
+all elements and combinators as propagation along the parent and sibling
+arrays. It selects exactly the same elements as `soupselect.select_steps`
+and pays off on large stylesheets, where the per-element Python loops of
+soupselect dominate.
+
+Requires NumPy, which is not a dependency of pynliner. Use it with
+`Pynliner(matcher='numpy')`.
+"""
+
+from soupselect import parse_nth, parse_selector, SelectorNotSupportedException
+from _lazy import LazyModule
+
+numpy = LazyModule('numpy')
+BeautifulSoup = LazyModule('BeautifulSoup')
+
+
+def _nth_mask(a, b, positions):
+    """Vectorized `soupselect.nth_matches` over 1-based positions"""
+    if a == 0:
+        return positions == b
+    offsets = positions - b
+    return (offsets % a == 0) & (offsets // a >= 0)
+
+
+class BitsetMatcher(object):
+    """Matches parsed selectors against every element of `soup` at once.
+    The document must not change while the matcher is in use.
+    """
+
+    def __init__(self, soup):
+        # feature -> indices of the elements that have it; a feature is
+        # ('tag', name), ('id', id), ('class', name) or ('attr', name)
+        self._postings = {}
+        # attribute name -> (indices, values) of the elements that have it
+        self._attribute_values = {}
+        self._columns = {}
+        self._compound_masks = {}
+        self._index(soup)
+
+    def _index(self, soup):
+        elements = self.elements = soup.findAll(True)
+        n = self.size = len(elements)
+        numbers = dict((id(el), i) for i, el in enumerate(elements))
+        # index arrays use n for "no element", masks get a False at n
+        parent = [n] * (n + 1)
+        previous = [n] * (n + 1)
+        sibling_index = [0] * n
+        sibling_count = [0] * n
+        type_index = [0] * n
+        type_count = [0] * n
+        postings = self._postings
+        attribute_values = self._attribute_values
+
+        # number the element children of every parent in one pass; the
+        # soup itself is not an element, as in soupselect
+        for parent_el, parent_number in [(soup, n)] + zip(elements, xrange(n)):
+            siblings = []
+            type_counts = {}
+            for node in parent_el.contents:
+                if not isinstance(node, BeautifulSoup.Tag):
+                    continue
+                i = numbers[id(node)]
+                parent[i] = parent_number
+                if siblings:
+                    previous[i] = siblings[-1]
+                sibling_index[i] = len(siblings)
+                type_index[i] = type_counts.get(node.name, 0)
+                type_counts[node.name] = type_index[i] + 1
+                siblings.append(i)
+            for i in siblings:
+                sibling_count[i] = len(siblings)
+                type_count[i] = type_counts[elements[i].name]
+
+        for i, el in enumerate(elements):
+            postings.setdefault(('tag', el.name), []).append(i)
+            element_id = el.get('id')
+            if element_id is not None:
+                postings.setdefault(('id', element_id), []).append(i)
+            for name in el.get('class', '').split():
+                postings.setdefault(('class', name), []).append(i)
+            for name in set(name for name, _ in el.attrs):
+                postings.setdefault(('attr', name), []).append(i)
+                indices, values = attribute_values.setdefault(name, ([], []))
+                indices.append(i)
+                values.append(el.get(name))
+
+        self.parent = numpy.array(parent, dtype=int)
+        self.previous = numpy.array(previous, dtype=int)
+        self.sibling_index = numpy.array(sibling_index, dtype=int)
+        self.sibling_count = numpy.array(sibling_count, dtype=int)
+        self.type_index = numpy.array(type_index, dtype=int)
+        self.type_count = numpy.array(type_count, dtype=int)
+
+    def select(self, selector):
+        """Returns the elements matching a selector string in document order"""
+        return self.select_steps(parse_selector(selector))
+
+    def select_steps(self, steps, checkpoint=None):
+        """Like select, for a selector already split up by parse_selector.
+        `checkpoint` is called before every compound selector and may raise
+        to stop the selection.
+        """
+        if not steps:
+            return []
+        mask = None
+        for operator, compound in steps:
+            if checkpoint is not None:
+                checkpoint()
+            compound_mask = self._compound_mask(compound)
+            if mask is None:
+                mask = compound_mask
+            else:
+                mask = compound_mask & self._combine(operator, mask)
+        return [self.elements[i] for i in numpy.flatnonzero(mask[:self.size])]
+
+    def _empty(self):
+        return numpy.zeros(self.size + 1, dtype=bool)
+
+    def _column(self, feature):
+        """Returns the boolean column of a feature over all elements"""
+        try:
+            return self._columns[feature]
+        except KeyError:
+            pass
+        column = self._empty()
+        indices = self._postings.get(feature)
+        if indices:
+            column[indices] = True
+        self._columns[feature] = column
+        return column
+
+    def _attribute_mask(self, operator, attribute, value):
+        key = ('attr', operator, attribute, value)
+        try:
+            return self._columns[key]
+        except KeyError:
+            pass
+        if operator not in ('=', '~', '^', '$', '*', '|'):
+            return self._column(('attr', attribute))
+        test = {
+            '=': lambda v: v == value,
+            '~': lambda v: value in v.split(),
+            '^': lambda v: v.startswith(value),
+            '$': lambda v: v.endswith(value),
+            '*': lambda v: value in v,
+            '|': lambda v: v == value or v.startswith('%s-' % value),
+        }[operator]
+        # soupselect compares a missing attribute as '' for every operator
+        # but '='
+        mask = self._empty()
+        if operator != '=' and test(''):
+            mask[:self.size] = True
+        indices, values = self._attribute_values.get(attribute, ((), ()))
+        if indices:
+            mask[indices] = [test(v) for v in values]
+        self._columns[key] = mask
+        return mask
+
+    def _pseudo_class_mask(self, pseudo_class, argument):
+        mask = self._empty()
+        n = self.size
+        if pseudo_class == 'first-child':
+            mask[:n] = self.sibling_index == 0
+        elif pseudo_class == 'last-child':
+            mask[:n] = self.sibling_index == self.sibling_count - 1
+        elif pseudo_class == 'first-of-type':
+            mask[:n] = self.type_index == 0
+        elif pseudo_class == 'last-of-type':
+            mask[:n] = self.type_index == self.type_count - 1
+        elif pseudo_class == 'nth-child':
+            a, b = parse_nth(argument or '')
+            mask[:n] = _nth_mask(a, b, self.sibling_index + 1)
+        elif pseudo_class == 'nth-last-child':
+            a, b = parse_nth(argument or '')
+            mask[:n] = _nth_mask(a, b, self.sibling_count - self.sibling_index)
+        else:
+            raise SelectorNotSupportedException(':' + pseudo_class)
+        return mask
+
+    def _compound_mask(self, compound):
+        try:
+            return self._compound_masks[compound]
+        except KeyError:
+            pass
+        tag, ids, classes, attributes, pseudo_classes = compound
+        mask = self._empty()
+        mask[:self.size] = True
+        if tag is not True:
+            mask &= self._column(('tag', tag))
+        if ids:
+            id_mask = self._empty()
+            for element_id in ids:
+                id_mask |= self._column(('id', element_id))
+            mask &= id_mask
+        for name in classes:
+            mask &= self._column(('class', name))
+        for operator, attribute, value in attributes:
+            mask &= self._attribute_mask(operator, attribute, value)
+        for pseudo_class, argument in pseudo_classes:
+            mask &= self._pseudo_class_mask(pseudo_class, argument)
+        self._compound_masks[compound] = mask
+        return mask
+
+    def _combine(self, operator, mask):
+        """Returns the mask of elements related by `operator` to an element
+        of `mask`
+        """
+        if operator == '>':
+            return mask[self.parent]
+        if operator == '+':
+            return mask[self.previous]
+        links = self.parent if operator == ' ' else self.previous
+        return self._reachable(mask, links)
+
+    def _reachable(self, mask, links):
+        """Marks the elements with any element of `mask` among the elements
+        reached by following `links` one or more times. Doubles the distance
+        covered on every iteration, so it takes log2(depth) steps.
+        """
+        found = mask[links]
+        jump = links
+        n = self.size
+        while (jump[:n] != n).any():
+            found = found | found[jump]
+            jump = jump[jump]
+        return found
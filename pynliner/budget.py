@@ -0,0 +1,101 @@
+"""Limits on the time and resources one inlining run may use.
+
+>>> budget = Budget(seconds=2, elements=20000, css_bytes=512 * 1024)
+>>> Pynliner(budget=budget).from_string(html).run()
+
+A run that goes over any limit raises BudgetExceeded, or with
+`degrade=True` returns the document as it was given, with its <style>
+and <link> elements, and sets `Pynliner.budget_exceeded`. Time is checked
+between phases, styled elements and every few elements a selector is
+matched against, so a run stops shortly after its time is up. Linked
+stylesheets are downloaded with the time and fetch bytes left, and
+stopped once they run out.
+"""
+
+import threading
+import time
+
+# the resources a Budget limits besides time
+RESOURCES = ('elements', 'css_bytes', 'fetch_bytes', 'selector_evaluations')
+
+
+class BudgetExceeded(Exception):
+    """Raised when a run goes over its Budget. `resource` is the name of the
+    limit, `limit` its value and `used` how much was used.
+    """
+
+    def __init__(self, resource, limit, used):
+        Exception.__init__(self, '%s budget of %s exceeded: %s' % (resource, limit, used))
+        self.resource = resource
+        self.limit = limit
+        self.used = used
+
+
+class Budget(object):
+    """Limits for every run of a Pynliner; None leaves a resource unlimited.
+
+    `seconds` is the wall time of the run, `elements` the number of
+    elements in the document, `css_bytes` the UTF-8 size of the CSS of the
+    document, linked or not, `fetch_bytes` the bytes of linked stylesheets
+    downloaded and `selector_evaluations` the number of times a selector is
+    matched against the document, each of which takes time in proportion
+    to the size of the document.
+    """
+
+    def __init__(self, seconds=None, elements=None, css_bytes=None, fetch_bytes=None,
+                 selector_evaluations=None, degrade=False):
+        self.seconds = seconds
+        self.elements = elements
+        self.css_bytes = css_bytes
+        self.fetch_bytes = fetch_bytes
+        self.selector_evaluations = selector_evaluations
+        self.degrade = degrade
+
+
+class BudgetMeter(object):
+    """The use of a Budget by one run"""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.started = time.time()
+        self.used = dict.fromkeys(RESOURCES, 0)
+        # linked stylesheets are fetched in threads
+        self._lock = threading.Lock()
+
+    def limits(self, resource):
+        return getattr(self.budget, resource) is not None
+
+    def charge(self, resource, amount=1):
+        """Counts `amount` of `resource`, raises BudgetExceeded when it goes
+        over the limit
+        """
+        limit = getattr(self.budget, resource)
+        if limit is None:
+            return
+        with self._lock:
+            self.used[resource] += amount
+            used = self.used[resource]
+        if used > limit:
+            raise BudgetExceeded(resource, limit, used)
+
+    def remaining(self, resource):
+        """Returns how much of `resource` is left, or None without a limit"""
+        limit = getattr(self.budget, resource)
+        if limit is None:
+            return None
+        with self._lock:
+            return max(limit - self.used[resource], 0)
+
+    def remaining_seconds(self):
+        """Returns the seconds left, or None without a time limit"""
+        if self.budget.seconds is None:
+            return None
+        return max(self.budget.seconds - (time.time() - self.started), 0)
+
+    def check_time(self):
+        """Raises BudgetExceeded when the time of the run is up"""
+        if self.budget.seconds is None:
+            return
+        elapsed = time.time() - self.started
+        if elapsed > self.budget.seconds:
+            raise BudgetExceeded('seconds', self.budget.seconds, round(elapsed, 3))
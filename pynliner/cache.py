@@ -0,0 +1,232 @@
+"""Caches for whole inlining results.
+
+Pass a cache to `Pynliner(cache=...)` and `run()` will return a stored
+output without parsing anything when the same HTML, CSS and options have
+been inlined before.
+
+>>> from pynliner import Pynliner
+>>> cache = MemoryCache(max_bytes=64 * 1024 * 1024)
+>>> Pynliner(cache=cache).from_string(html).run()
+>>> cache.stats.hit_rate
+"""
+
+import os
+import errno
+import hashlib
+import threading
+from collections import OrderedDict
+from _lazy import LazyModule
+
+tempfile = LazyModule('tempfile')
+
+
+class CacheStats(object):
+    """Counters of a result cache"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    @property
+    def hit_rate(self):
+        """Fraction of lookups that were hits, 0.0 before any lookup"""
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def as_dict(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'hit_rate': self.hit_rate,
+        }
+
+
+class ResultCache(object):
+    """Base class for result caches. Keys are hex digests, values are the
+    unicode output of a run. Subclasses implement `_get`, `_set` and
+    `clear`.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the output stored under `key` or None"""
+        with self._lock:
+            value = self._get(key)
+            if value is None:
+                self.stats.misses += 1
+            else:
+                self.stats.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Stores `value` under `key`, evicting least recently used entries
+        until the cache fits in `max_bytes`. Values larger than the whole
+        cache are not stored.
+        """
+        data = value.encode('utf-8')
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            self._set(key, value, data)
+            self.stats.stores += 1
+
+    def clear(self):
+        raise NotImplementedError
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _set(self, key, value, data):
+        raise NotImplementedError
+
+
+class MemoryCache(ResultCache):
+    """In-memory LRU cache bounded by the total size of its outputs"""
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        super(MemoryCache, self).__init__(max_bytes)
+        self._entries = OrderedDict()
+        self.size = 0
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _get(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        self._entries[key] = entry
+        return entry[0]
+
+    def _set(self, key, value, data):
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.size -= previous[1]
+        self._entries[key] = (value, len(data))
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, (_, size) = self._entries.popitem(last=False)
+            self.size -= size
+            self.stats.evictions += 1
+
+
+class DiskCache(ResultCache):
+    """Cache storing one file per output in `directory`, bounded by the total
+    size of the files. Recency is tracked with file modification times, so
+    several processes may share a directory.
+
+    The directory is only listed when the size of the files, estimated from
+    the outputs this cache stored since it last listed it, goes over
+    `max_bytes`, or after RESCAN_WRITES writes, which also counts the files
+    other processes stored.
+    """
+
+    RESCAN_WRITES = 100
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024):
+        super(DiskCache, self).__init__(max_bytes)
+        self.directory = directory
+        # estimated size of the files, None until the directory is listed
+        self._size = None
+        self._writes = 0
+        try:
+            os.makedirs(directory)
+        except OSError, ex:
+            if ex.errno != errno.EEXIST:
+                raise
+
+    def clear(self):
+        with self._lock:
+            for filename, _, _ in self._entries():
+                self._remove(filename)
+            self._size = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.html')
+
+    def _get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            # evicted a little early, but still a hit
+            pass
+        return data.decode('utf-8')
+
+    def _set(self, key, value, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, self._path(key))
+        self._writes += 1
+        if self._size is not None:
+            # replacing an output overestimates, which only rescans earlier
+            self._size += len(data)
+        if self._size is None or self._size > self.max_bytes or \
+                self._writes >= self.RESCAN_WRITES:
+            self._evict()
+
+    def _entries(self):
+        """Returns (path, size, mtime) of every stored output"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.html'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _evict(self):
+        """Lists the directory and removes the least recently used outputs
+        while their size is over `max_bytes`
+        """
+        entries = self._entries()
+        size = sum(entry[1] for entry in entries)
+        entries.sort(key=lambda entry: entry[2])
+        for path, entry_size, _ in entries:
+            if size <= self.max_bytes:
+                break
+            self._remove(path)
+            size -= entry_size
+            self.stats.evictions += 1
+        self._size = size
+        self._writes = 0
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def make_key(*parts):
+    """Returns a hex digest identifying a sequence of strings and values"""
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        elif not isinstance(part, str):
+            part = repr(part)
+        digest.update(str(len(part)))
+        digest.update(':')
+        digest.update(part)
+    return digest.hexdigest()
@@ -0,0 +1,249 @@
+"""Stylesheets compiled once into everything the cascade needs.
+
+Compiling parses the CSS with cssutils and keeps, for every style rule, its
+declarations and each selector's text, specificity and parsed matching steps.
+@media, @import and @font-face rules are kept as text. A compiled stylesheet
+can be reused for any number of documents, and saved to a compact binary
+file that loads much faster than parsing the CSS again:
+
+>>> compiled = compile_css(open('framework.css').read())
+>>> compiled.save('framework.pynliner')
+>>> compiled = CompiledStylesheet.load('framework.pynliner')
+>>> Pynliner().from_string(html).with_compiled(compiled).run()
+"""
+
+import sys
+import hashlib
+import marshal
+import zlib
+from soupselect import parse_selector, Compound, SelectorNotSupportedException
+from _lazy import LazyModule
+from _memo import BoundedDict
+
+cssutils = LazyModule('cssutils')
+
+_FILE_MAGIC = 'PYNLINER-CSS\n'
+# bump when the layout of the payload changes
+_FORMAT_VERSION = 1
+
+# selector text of a rule -> ((selector, specificity, steps), ...), shared by
+# all documents
+_rule_selectors_cache = BoundedDict(10000)
+
+
+def _split_selector_list(selector_text):
+    """Splits a selector list on the commas outside of quotes, brackets and
+    parentheses, in a single pass
+    """
+    parts = []
+    start = 0
+    depth = 0
+    quote = None
+    i = 0
+    length = len(selector_text)
+    while i < length:
+        char = selector_text[i]
+        if quote is not None:
+            if char == '\\':
+                i += 1
+            elif char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char in '[(':
+            depth += 1
+        elif char in '])':
+            depth = max(depth - 1, 0)
+        elif char == ',' and not depth:
+            parts.append(selector_text[start:i])
+            start = i + 1
+        i += 1
+    parts.append(selector_text[start:])
+    return parts
+
+
+class CompiledStylesheetVersionError(ValueError):
+    """Raised when loading a file that was not written by this version of
+    pynliner
+    """
+    pass
+
+
+def preserved_rule_types():
+    """Returns the cssutils rule types that are kept in the document rather
+    than inlined
+    """
+    return (
+        cssutils.css.CSSRule.MEDIA_RULE,
+        cssutils.css.CSSRule.IMPORT_RULE,
+        cssutils.css.CSSRule.FONT_FACE_RULE,
+    )
+
+
+class CompiledRule(object):
+    """A style rule ready for the cascade.
+
+    `selectors` is a tuple of (selector text, specificity, steps) triples
+    where steps is the parsed selector, or None if soupselect does not
+    support it. `properties` is a tuple of (name, value) pairs.
+    """
+    __slots__ = ('selectors', 'properties')
+
+    def __init__(self, selectors, properties):
+        self.selectors = selectors
+        self.properties = properties
+
+
+class CompiledStylesheet(object):
+    """Style rules compiled for the cascade plus the text of the rules that
+    are preserved rather than inlined.
+    """
+
+    def __init__(self, rules, preserved=()):
+        self.rules = rules
+        self.preserved = tuple(preserved)
+        self._fingerprint = None
+
+    @property
+    def fingerprint(self):
+        """Hex digest identifying the contents of the stylesheet"""
+        if self._fingerprint is None:
+            self._fingerprint = hashlib.sha1(self._dumps()).hexdigest()
+        return self._fingerprint
+
+    def save(self, path):
+        """Writes the stylesheet to `path`"""
+        with open(path, 'wb') as f:
+            f.write(self.dumps())
+
+    @classmethod
+    def load(cls, path):
+        """Reads a stylesheet written by `save`"""
+        with open(path, 'rb') as f:
+            return cls.loads(f.read())
+
+    def dumps(self):
+        """Returns the stylesheet as a versioned, compressed byte string"""
+        return _file_header() + zlib.compress(self._dumps())
+
+    @classmethod
+    def loads(cls, data):
+        """Rebuilds a stylesheet from the output of `dumps`. Raises
+        CompiledStylesheetVersionError for data written by another version
+        of pynliner, Python or file format.
+        """
+        header = _file_header()
+        if not data.startswith(_FILE_MAGIC):
+            raise CompiledStylesheetVersionError('not a compiled stylesheet')
+        if not data.startswith(header):
+            found = data[len(_FILE_MAGIC):].split('\n', 1)[0]
+            raise CompiledStylesheetVersionError(
+                'compiled stylesheet was written by %s, expected %s'
+                % (found, header[len(_FILE_MAGIC):-1]))
+        rules, preserved = marshal.loads(zlib.decompress(data[len(header):]))
+        return cls([_load_rule(rule) for rule in rules], preserved)
+
+    def inline_fragment(self, fragment_html, ancestors=(), **options):
+        """Inlines the stylesheet into an HTML fragment that will be inserted
+        below `ancestors` in a document, see `Pynliner.from_fragment`. Other
+        keyword arguments are passed to Pynliner.
+
+        Returns the Unicode output of the fragment.
+
+        >>> compiled.inline_fragment('<td>9.99</td>', ['table.order', 'tr'])
+        u'<td style="padding: 4px">9.99</td>'
+        """
+        from pynliner import Pynliner
+        inliner = Pynliner(**options).from_fragment(fragment_html, ancestors)
+        return inliner.with_compiled(self).run()
+
+    def _dumps(self):
+        rules = tuple(_dump_rule(rule) for rule in self.rules)
+        return marshal.dumps((rules, self.preserved))
+
+
+def _file_header():
+    from pynliner import __version__
+    return '%spynliner %s format %d python %d.%d\n' % (
+        _FILE_MAGIC, __version__, _FORMAT_VERSION,
+        sys.version_info[0], sys.version_info[1])
+
+
+def _dump_rule(rule):
+    selectors = tuple(
+        (text, specificity,
+         None if steps is None else tuple(
+             (operator, tuple(compound)) for operator, compound in steps))
+        for text, specificity, steps in rule.selectors)
+    return selectors, rule.properties
+
+
+def _load_rule(data):
+    selectors, properties = data
+    selectors = tuple(
+        (text, specificity,
+         None if steps is None else tuple(
+             (operator, Compound(*compound)) for operator, compound in steps))
+        for text, specificity, steps in selectors)
+    return CompiledRule(selectors, properties)
+
+
+def compile_selectors(rule):
+    """
+    For a given CSSStyleRule get a tuple of (selector text, specificity,
+    steps) triples, one per selector in its selector list. Specificities are
+    sortable tuples; both they and the parsed steps are computed once per
+    distinct selector text.
+    """
+    selector_text = rule.selectorText
+    try:
+        return _rule_selectors_cache[selector_text]
+    except KeyError:
+        pass
+    selector_list = rule.selectorList
+    # serializing each selector with cssutils walks the whole stylesheet, so
+    # split the serialized list instead
+    texts = [text.strip() for text in _split_selector_list(selector_text)]
+    if len(texts) != selector_list.length:
+        texts = [selector.selectorText for selector in selector_list]
+    selectors = []
+    for text, selector in zip(texts, selector_list):
+        try:
+            steps = parse_selector(text)
+        except SelectorNotSupportedException:
+            steps = None
+        selectors.append((text, selector.specificity, steps))
+    selectors = tuple(selectors)
+    _rule_selectors_cache[selector_text] = selectors
+    return selectors
+
+
+def compile_rule(rule):
+    """Compiles a cssutils CSSStyleRule"""
+    return CompiledRule(
+        compile_selectors(rule),
+        tuple((prop.name, prop.value) for prop in rule.style.getProperties()))
+
+
+def compile_stylesheet(stylesheet, preserve_unknown_rules=False):
+    """Compiles a cssutils CSSStyleSheet. @media, @import and @font-face
+    rules, and unknown @ rules if `preserve_unknown_rules` is set, are kept
+    as text; all other non-style rules are dropped.
+    """
+    rules = []
+    preserved = []
+    preserve_types = preserved_rule_types()
+    for rule in stylesheet.cssRules:
+        if rule.type == cssutils.css.CSSRule.STYLE_RULE:
+            rules.append(compile_rule(rule))
+        elif rule.type in preserve_types or \
+            (preserve_unknown_rules and rule.type == cssutils.css.CSSRule.UNKNOWN_RULE):
+            preserved.append(rule.cssText)
+    return CompiledStylesheet(rules, preserved)
+
+
+def compile_css(css_string, log=None, preserve_unknown_rules=False):
+    """Parses and compiles a CSS string"""
+    parser = cssutils.CSSParser(log=log)
+    return compile_stylesheet(parser.parseString(css_string),
+                              preserve_unknown_rules)
@@ -0,0 +1,372 @@
+"""A fast parser for the CSS email templates use.
+
+With `Pynliner(css_parser='fast')` style rules are parsed straight into
+compiled rules for the cascade instead of through a full cssutils CSSOM.
+It understands comments, strings, style rules with lists of simple
+selectors and declarations with !important, and skips @ rules, which are
+never inlined. Declarations are still normalized by cssutils, but only
+once per distinct declaration, so the output is the same as with cssutils.
+
+Anything else, such as escapes, @namespace, nested blocks or a declaration
+cssutils would drop, makes `parse_stylesheet` return None so that the
+caller parses the stylesheet with cssutils instead. Only stylesheets
+parsed by cssutils are reported to the log given to Pynliner.
+"""
+
+import re
+from compiled import CompiledRule, _split_selector_list
+from soupselect import parse_selector, SelectorNotSupportedException
+from _lazy import LazyModule
+from _memo import BoundedDict
+
+cssutils = LazyModule('cssutils')
+
+_token_regex = re.compile(r"""
+    (?P<comment>/\*.*?\*/)
+  | (?P<string>"[^"\n]*"|'[^'\n]*')
+  | (?P<bad>/\*|["'])
+  | (?P<punctuation>[{};])
+  | (?P<text>[^{};"'/]+|/)
+""", re.S | re.X)
+
+# stands in for a comment until it is known to be at the start or end
+_COMMENT = u'\0'
+_STRIP = u' \t\r\n\f' + _COMMENT
+
+# SGML comment delimiters, allowed between rules
+_cdo_cdc_regex = re.compile(u'^(?:[%s]|<!--|-->)+' % _STRIP)
+
+_at_keyword_regex = re.compile(r'@([\w-]+)')
+# @ rules that change how the rest of the stylesheet is read
+_UNSUPPORTED_AT_RULES = frozenset(('namespace',))
+
+_IDENT = r'-?[_a-zA-Z][\w-]*'
+_property_name_regex = re.compile(_IDENT + '$')
+_important_regex = re.compile(r'\s*!\s*important$', re.I)
+
+_combinator_split_regex = re.compile(r'\s*([>+~])\s*|\s+')
+_type_regex = re.compile(r'%s|\*' % _IDENT)
+_simple_selector_regex = re.compile(
+    r'#[\w-]+|\.%(ident)s|\[%(ident)s(?:[~|^$*]?=(?:%(ident)s|"[^"]*"))?\]|::?%(ident)s'
+    % {'ident': _IDENT})
+# pseudo-elements that may be written with a single colon
+_LEGACY_PSEUDO_ELEMENTS = frozenset(
+    (':first-line', ':first-letter', ':before', ':after'))
+
+# selector list text -> ((selector, specificity, steps), ...), or None when
+# it is not valid, shared by all documents
+_selectors_cache = BoundedDict(10000)
+# (name, value, priority) -> normalized (name, value), or None when cssutils
+# would drop the declaration
+_declarations_cache = BoundedDict(20000)
+
+
+def _tokenize(css_string):
+    """Returns a list of (kind, text) tokens, or None if a comment or string
+    is not closed
+    """
+    tokens = []
+    for match in _token_regex.finditer(css_string):
+        kind = match.lastgroup
+        if kind == 'bad':
+            return None
+        if kind == 'punctuation':
+            kind = match.group()
+        tokens.append((kind, match.group()))
+    return tokens
+
+
+def _join(tokens, top_level=False):
+    """Joins tokens into text, dropping comments at the start and end, and
+    SGML comment delimiters at the start of `top_level` text. Returns None if
+    a comment or delimiter is left in between.
+    """
+    text = u''.join(_COMMENT if kind == 'comment' else text
+                    for kind, text in tokens)
+    if top_level:
+        text = _cdo_cdc_regex.sub(u'', text)
+        if u'<!--' in text or u'-->' in text:
+            return None
+    text = text.strip(_STRIP)
+    if _COMMENT in text:
+        return None
+    return text
+
+
+def _compound_specificity(compound):
+    """Returns the (ids, classes, types) counts of a compound selector the
+    way cssutils counts them, or None if it is not a simple one. Like in
+    cssutils, pseudo-classes do not count and pseudo-elements count as types.
+    """
+    if not compound:
+        return None
+    ids = classes = types = 0
+    match = _type_regex.match(compound)
+    position = 0
+    if match:
+        position = match.end()
+        if match.group() != '*':
+            types += 1
+    pseudo_element = False
+    while position < len(compound):
+        match = _simple_selector_regex.match(compound, position)
+        if match is None or pseudo_element:
+            return None
+        part = match.group()
+        position = match.end()
+        if part[0] in '[:' and part != part.lower():
+            # cssutils changes the case of some of these
+            return None
+        if part[0] == '#':
+            ids += 1
+        elif part[0] in '.[':
+            classes += 1
+        elif part.startswith('::') or part.lower() in _LEGACY_PSEUDO_ELEMENTS:
+            # only combinators may follow a pseudo-element
+            pseudo_element = True
+            types += 1
+    return ids, classes, types
+
+
+def _selector(text):
+    """Returns the text of a selector as cssutils serializes it and its
+    specificity, or None if it is not valid
+    """
+    parts = _combinator_split_regex.split(text)
+    serialized = []
+    specificity = [0, 0, 0, 0]
+    for i in range(0, len(parts), 2):
+        counts = _compound_specificity(parts[i])
+        if counts is None:
+            break
+        for j, count in enumerate(counts):
+            specificity[j + 1] += count
+        if i:
+            combinator = parts[i - 1]
+            serialized.append(u' %s ' % combinator if combinator else u' ')
+        serialized.append(parts[i])
+    else:
+        return u''.join(serialized), tuple(specificity)
+
+    # functional pseudo-classes, quoted attribute values and the like
+    selector = cssutils.css.Selector(text)
+    if not selector.wellformed:
+        return None
+    return selector.selectorText, selector.specificity
+
+
+def _compile_selectors(selector_text):
+    """Returns the (selector text, specificity, steps) triples of a selector
+    list, or None if it is not valid
+    """
+    try:
+        return _selectors_cache[selector_text]
+    except KeyError:
+        pass
+    selectors = []
+    for text in _split_selector_list(selector_text):
+        selector = _selector(text.strip())
+        if selector is None:
+            selectors = None
+            break
+        text, specificity = selector
+        try:
+            steps = parse_selector(text)
+        except SelectorNotSupportedException:
+            steps = None
+        selectors.append((text, specificity, steps))
+    if selectors is not None:
+        selectors = tuple(selectors)
+    _selectors_cache[selector_text] = selectors
+    return selectors
+
+
+def _normalize_declaration(name, value, priority):
+    key = (name, value, priority)
+    try:
+        return _declarations_cache[key]
+    except KeyError:
+        pass
+    prop = cssutils.css.Property(name, value, priority)
+    if prop.wellformed and prop.name and prop.value:
+        normalized = prop.name, prop.value
+    else:
+        normalized = None
+    _declarations_cache[key] = normalized
+    return normalized
+
+
+def _declaration(tokens):
+    """Returns the normalized (name, value, important) of a declaration,
+    False if it is empty, or None if it is not valid
+    """
+    text = _join(tokens)
+    if text is None:
+        return None
+    if not text:
+        return False
+    name, colon, value = text.partition(u':')
+    name = name.strip()
+    if not colon or not _property_name_regex.match(name):
+        return None
+    match = _important_regex.search(value)
+    priority = u''
+    if match:
+        value = value[:match.start()]
+        priority = u'important'
+    value = value.strip()
+    if not value or u'!' in value:
+        return None
+    normalized = _normalize_declaration(name, value, priority)
+    if normalized is None:
+        return None
+    return normalized + (bool(priority),)
+
+
+def _properties(tokens):
+    """Returns the effective (name, value) pairs of a declaration block as
+    cssutils does: one per name, ordered by its last declaration, with the
+    value of its last !important declaration or else its last declaration.
+    Returns None if the block is not valid.
+    """
+    declarations = []
+    start = 0
+    for i in range(len(tokens) + 1):
+        if i < len(tokens) and tokens[i][0] != ';':
+            continue
+        declaration = _declaration(tokens[start:i])
+        if declaration is None:
+            return None
+        if declaration:
+            declarations.append(declaration)
+        start = i + 1
+
+    values = {}
+    for name, value, important in declarations:
+        if important or name not in values or not values[name][1]:
+            values[name] = (value, important)
+    names = []
+    for name, _, _ in reversed(declarations):
+        if name not in names:
+            names.append(name)
+    return tuple((name, values[name][0]) for name in reversed(names))
+
+
+def _skip_block(tokens, i):
+    """Returns the index after the block whose '{' is just before `i`, or
+    None if it is not closed
+    """
+    depth = 1
+    while i < len(tokens):
+        kind = tokens[i][0]
+        if kind == '{':
+            depth += 1
+        elif kind == '}':
+            depth -= 1
+            if not depth:
+                return i + 1
+        i += 1
+    return None
+
+
+def parse_stylesheet(css_string):
+    """Parses `css_string` into CompiledRules. Returns the list of rules and
+    the number of @ rules that were skipped, or None if the stylesheet has
+    to be parsed with cssutils.
+    """
+    if u'\\' in css_string:
+        return None
+    tokens = _tokenize(css_string)
+    if tokens is None:
+        return None
+
+    rules = []
+    skipped = 0
+    prelude_start = 0
+    i = 0
+    while i < len(tokens):
+        kind = tokens[i][0]
+        i += 1
+        if kind not in ('{', ';', '}'):
+            continue
+        if kind == '}':
+            return None
+        prelude = _join(tokens[prelude_start:i - 1], top_level=True)
+        if prelude is None:
+            return None
+
+        if prelude.startswith(u'@'):
+            keyword = _at_keyword_regex.match(prelude)
+            if keyword is None or keyword.group(1).lower() in _UNSUPPORTED_AT_RULES:
+                return None
+            if kind == '{':
+                i = _skip_block(tokens, i)
+                if i is None:
+                    return None
+            skipped += 1
+        elif kind == ';':
+            return None
+        else:
+            end = i
+            while end < len(tokens) and tokens[end][0] not in ('{', '}'):
+                end += 1
+            if end == len(tokens) or tokens[end][0] == '{':
+                return None
+            selectors = _compile_selectors(prelude)
+            properties = _properties(tokens[i:end])
+            if selectors is None or properties is None:
+                return None
+            rules.append(CompiledRule(selectors, properties))
+            i = end + 1
+        prelude_start = i
+
+    if _join(tokens[prelude_start:], top_level=True) != u'':
+        return None
+    return rules, skipped
+
+
+def rule_spans(css_string):
+    """Returns the (start, end) offsets of the source text of every top
+    level rule of `css_string`, without the comments and SGML comment
+    delimiters between rules, or None if the stylesheet can not be split
+    without a full parser.
+    """
+    if u'\\' in css_string:
+        return None
+    tokens = _tokenize(css_string)
+    if tokens is None:
+        return None
+    offsets = [0]
+    for _, text in tokens:
+        offsets.append(offsets[-1] + len(text))
+
+    spans = []
+    start = None
+    i = 0
+    while i < len(tokens):
+        kind, text = tokens[i]
+        i += 1
+        if start is None:
+            if kind == 'comment':
+                continue
+            if kind != 'text':
+                return None
+            lead = _cdo_cdc_regex.match(text)
+            lead = lead.end() if lead else 0
+            if lead < len(text):
+                start = offsets[i - 1] + lead
+            continue
+        if kind == '{':
+            i = _skip_block(tokens, i)
+            if i is None:
+                return None
+        elif kind == '}':
+            return None
+        elif kind != ';':
+            continue
+        spans.append((start, offsets[i]))
+        start = None
+
+    if start is not None:
+        return None
+    return spans
@@ -0,0 +1,319 @@
+"""Fetchers used by Pynliner to download pages and linked stylesheets.
+
+A fetcher is any object with a `fetch(url)` method returning the response
+content as a string. Pass one to `Pynliner(fetcher=...)`; the default is an
+`UrllibFetcher`.
+
+>>> from pynliner import Pynliner
+>>> fetcher = ResolverFetcher({
+...     'http://cdn.example.com/css/': '/srv/static/css',
+...     'http://example.com/': {'base.css': 'p { color: red; }'},
+... }, fallback=PooledHTTPFetcher(timeout=5, max_bytes=1024 * 1024))
+>>> Pynliner(fetcher=fetcher).from_url('http://example.com/page.html').run()
+"""
+
+import os
+import threading
+import time
+from _lazy import LazyModule
+
+# imported on first use to keep `import pynliner` cheap
+urllib2 = LazyModule('urllib2')
+urlparse = LazyModule('urlparse')
+httplib = LazyModule('httplib')
+
+_REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+_READ_CHUNK_SIZE = 64 * 1024
+
+
+class FetchError(IOError):
+    """Raised when a URL can not be fetched"""
+    pass
+
+
+class ResponseTooLarge(FetchError):
+    """Raised when a response is larger than `max_bytes`"""
+
+    def __init__(self, max_bytes):
+        FetchError.__init__(self, 'response is larger than %d bytes' % max_bytes)
+        self.max_bytes = max_bytes
+
+
+class FetchTimeout(FetchError):
+    """Raised when a response is not read by its deadline"""
+    pass
+
+
+def read_limited(response, max_bytes=None, deadline=None):
+    """Reads a file-like `response` to the end, raising ResponseTooLarge as
+    soon as more than `max_bytes` have been read, and FetchTimeout when it
+    is still reading at the `deadline` time.
+    """
+    if max_bytes is None and deadline is None:
+        return response.read()
+    chunks = []
+    size = 0
+    while True:
+        if deadline is not None and time.time() > deadline:
+            raise FetchTimeout('response not read in time')
+        if max_bytes is None:
+            chunk = response.read(_READ_CHUNK_SIZE)
+        else:
+            chunk = response.read(min(_READ_CHUNK_SIZE, max_bytes + 1 - size))
+        if not chunk:
+            return ''.join(chunks)
+        size += len(chunk)
+        if max_bytes is not None and size > max_bytes:
+            raise ResponseTooLarge(max_bytes)
+        chunks.append(chunk)
+
+
+def fetch_limited(fetcher, url, max_bytes=None, timeout=None):
+    """Fetches `url` with `fetcher` within `max_bytes` and about `timeout`
+    seconds, see Fetcher.fetch_limited. Works with any object that has a
+    `fetch(url)` method.
+    """
+    method = getattr(fetcher, 'fetch_limited', None)
+    if method is not None:
+        return method(url, max_bytes, timeout)
+    return _check_size(fetcher.fetch(url), max_bytes)
+
+
+def _check_size(content, max_bytes):
+    if max_bytes is not None and len(content) > max_bytes:
+        raise ResponseTooLarge(max_bytes)
+    return content
+
+
+def _tighter(limit, other):
+    """Returns the smaller of two limits, None being no limit"""
+    if limit is None:
+        return other
+    if other is None:
+        return limit
+    return min(limit, other)
+
+
+class Fetcher(object):
+    """Base class for fetchers"""
+
+    def fetch(self, url):
+        """Returns the response content of `url`"""
+        raise NotImplementedError
+
+    def fetch_limited(self, url, max_bytes=None, timeout=None):
+        """Like fetch, raising ResponseTooLarge for a response larger than
+        `max_bytes` and giving up after about `timeout` seconds. Fetchers
+        that can not stop a download early check its size afterwards.
+        """
+        return _check_size(self.fetch(url), max_bytes)
+
+    def close(self):
+        """Releases any resources held by the fetcher"""
+        pass
+
+
+class UrllibFetcher(Fetcher):
+    """Fetches each URL with a new `urllib2.urlopen` call"""
+
+    def __init__(self, timeout=None, max_bytes=None):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+
+    def fetch(self, url):
+        return self.fetch_limited(url)
+
+    def fetch_limited(self, url, max_bytes=None, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        timeout = _tighter(self.timeout, timeout)
+        if timeout is None:
+            response = urllib2.urlopen(url)
+        else:
+            response = urllib2.urlopen(url, timeout=timeout)
+        try:
+            return read_limited(response, _tighter(self.max_bytes, max_bytes), deadline)
+        finally:
+            response.close()
+
+
+class PooledHTTPFetcher(Fetcher):
+    """HTTP(S) client that keeps connections alive and reuses them.
+
+    At most `max_connections_per_host` requests run against one host at a
+    time; further requests wait for a connection to be returned to the pool.
+    Redirects are followed up to `max_redirects` times and any other non-2xx
+    response raises FetchError. The fetcher is safe to share between
+    threads.
+    """
+
+    def __init__(self, timeout=10, max_connections_per_host=4,
+                 max_bytes=None, max_redirects=5):
+        self.timeout = timeout
+        self.max_connections_per_host = max_connections_per_host
+        self.max_bytes = max_bytes
+        self.max_redirects = max_redirects
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._slots = {}
+
+    def fetch(self, url):
+        return self.fetch_limited(url)
+
+    def fetch_limited(self, url, max_bytes=None, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        max_bytes = _tighter(self.max_bytes, max_bytes)
+        for _ in xrange(self.max_redirects + 1):
+            status, location, content = self._request(url, max_bytes, deadline)
+            if status in _REDIRECT_STATUSES and location:
+                url = urlparse.urljoin(url, location)
+                continue
+            if not 200 <= status < 300:
+                raise FetchError('%s returned HTTP %d' % (url, status))
+            return content
+        raise FetchError('%s redirected more than %d times'
+                         % (url, self.max_redirects))
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _request(self, url, max_bytes, deadline):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise FetchError('unsupported URL scheme: %s' % url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        slot = self._get_slot(key)
+        slot.acquire()
+        try:
+            connection, reused = self._checkout(key)
+            try:
+                try:
+                    self._set_deadline(connection, deadline)
+                    response = self._send(connection, parts.netloc, path)
+                except (httplib.HTTPException, IOError):
+                    if not reused:
+                        raise
+                    # the server closed an idle keep-alive connection, retry
+                    # once on a fresh one
+                    connection.close()
+                    connection = self._connect(key)
+                    self._set_deadline(connection, deadline)
+                    response = self._send(connection, parts.netloc, path)
+                content = read_limited(response, max_bytes, deadline)
+            except:
+                # closes the connection of the retry too
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._set_timeout(connection, self.timeout)
+                self._checkin(key, connection)
+            return response.status, response.getheader('location'), content
+        finally:
+            slot.release()
+
+    def _send(self, connection, host, path):
+        connection.request('GET', path, headers={
+            'Host': host,
+            'Connection': 'keep-alive',
+        })
+        return connection.getresponse()
+
+    def _set_deadline(self, connection, deadline):
+        if deadline is not None:
+            self._set_timeout(connection, _tighter(self.timeout,
+                                                   max(deadline - time.time(), 0.001)))
+
+    @staticmethod
+    def _set_timeout(connection, timeout):
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+
+    def _get_slot(self, key):
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(
+                    self.max_connections_per_host)
+            return self._slots[key]
+
+    def _checkout(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._connect(key), False
+
+    def _checkin(self, key, connection):
+        with self._lock:
+            self._idle.setdefault(key, []).append(connection)
+
+    def _connect(self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, port, timeout=self.timeout)
+        return httplib.HTTPConnection(host, port, timeout=self.timeout)
+
+
+class ResolverFetcher(Fetcher):
+    """Serves URLs under known prefixes without touching the network.
+
+    `mapping` maps URL prefixes to either a local directory or a dict of
+    contents keyed by the rest of the URL. The longest matching prefix wins.
+    URLs that match no prefix are passed to `fallback`, or raise FetchError
+    when there is none.
+    """
+
+    def __init__(self, mapping, fallback=None, max_bytes=None):
+        self.mapping = mapping
+        self.fallback = fallback
+        self.max_bytes = max_bytes
+        self._prefixes = sorted(mapping, key=len, reverse=True)
+
+    def fetch(self, url):
+        return self.fetch_limited(url)
+
+    def fetch_limited(self, url, max_bytes=None, timeout=None):
+        for prefix in self._prefixes:
+            if url.startswith(prefix):
+                return self._resolve(self.mapping[prefix], url[len(prefix):], url,
+                                     _tighter(self.max_bytes, max_bytes))
+        if self.fallback is None:
+            raise FetchError('no resolver for %s' % url)
+        if max_bytes is None and timeout is None:
+            return self.fallback.fetch(url)
+        return fetch_limited(self.fallback, url, max_bytes, timeout)
+
+    def close(self):
+        if self.fallback is not None:
+            self.fallback.close()
+
+    def _resolve(self, target, path, url, max_bytes):
+        path = path.split('#', 1)[0].split('?', 1)[0]
+        if isinstance(target, dict):
+            try:
+                content = target[path]
+            except KeyError:
+                raise FetchError('%s is not in the resolver' % url)
+            if max_bytes is not None and len(content) > max_bytes:
+                raise ResponseTooLarge(max_bytes)
+            return content
+
+        root = os.path.abspath(target)
+        filename = os.path.abspath(os.path.join(root, *path.split('/')))
+        if not filename.startswith(root + os.sep):
+            raise FetchError('%s resolves outside of %s' % (url, root))
+        try:
+            f = open(filename, 'rb')
+        except IOError, ex:
+            raise FetchError('%s: %s' % (url, ex))
+        with f:
+            return read_limited(f, max_bytes)
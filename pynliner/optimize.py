@@ -0,0 +1,338 @@
+"""Output size optimizations.
+
+With `Pynliner(optimize_output=True)`, inline styles are merged with the
+declarations applied from the stylesheet instead of being appended to
+them, declarations overridden by a later shorthand are dropped, and white
+space between block-level tags, which browsers do not render, is removed
+from the document before it is serialized.
+
+With `Pynliner(fold_shorthands=True)`, complete sets of longhand
+declarations are serialized as shorthands. With
+`Pynliner(prune_media_queries=True)`, rules of preserved @media blocks that
+match no element of the document are dropped.
+"""
+
+import re
+from soupselect import (parse_selector, SelectorNotSupportedException,
+                        EVALUATED_PSEUDO_CLASSES)
+from compiled import compile_selectors
+from _lazy import LazyModule
+
+cssutils = LazyModule('cssutils')
+bs = LazyModule('BeautifulSoup')
+
+# shorthand property -> the properties it sets
+_SHORTHANDS = {
+    'margin': ('margin-top', 'margin-right', 'margin-bottom', 'margin-left'),
+    'padding': ('padding-top', 'padding-right', 'padding-bottom', 'padding-left'),
+    'border': ('border-top', 'border-right', 'border-bottom', 'border-left',
+               'border-width', 'border-style', 'border-color'),
+    'border-width': ('border-top-width', 'border-right-width',
+                     'border-bottom-width', 'border-left-width'),
+    'border-style': ('border-top-style', 'border-right-style',
+                     'border-bottom-style', 'border-left-style'),
+    'border-color': ('border-top-color', 'border-right-color',
+                     'border-bottom-color', 'border-left-color'),
+    'background': ('background-color', 'background-image', 'background-repeat',
+                   'background-position', 'background-attachment'),
+    'font': ('font-style', 'font-variant', 'font-weight', 'font-size',
+             'line-height', 'font-family'),
+    'list-style': ('list-style-type', 'list-style-position', 'list-style-image'),
+    'outline': ('outline-color', 'outline-style', 'outline-width'),
+}
+for _side in ('top', 'right', 'bottom', 'left'):
+    _SHORTHANDS['border-' + _side] = tuple(
+        'border-%s-%s' % (_side, part) for part in ('width', 'style', 'color'))
+
+
+def _expand(name):
+    longhands = set()
+    for longhand in _SHORTHANDS.get(name, ()):
+        longhands.add(longhand)
+        longhands.update(_expand(longhand))
+    return frozenset(longhands)
+
+# shorthand property -> every property it overrides
+OVERRIDES = dict((name, _expand(name)) for name in _SHORTHANDS)
+
+# tags around which white space is not rendered
+BLOCK_TAGS = frozenset((
+    'address', 'article', 'aside', 'blockquote', 'body', 'caption', 'center',
+    'col', 'colgroup', 'dd', 'div', 'dl', 'dt', 'fieldset', 'footer', 'form',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'head', 'header', 'hr', 'html', 'li',
+    'link', 'meta', 'nav', 'ol', 'p', 'pre', 'section', 'style', 'table', 'tbody',
+    'td', 'tfoot', 'th', 'thead', 'title', 'tr', 'ul',
+))
+
+# tags whose white space is content
+PRESERVE_WHITE_SPACE_TAGS = frozenset(('pre', 'textarea', 'script'))
+
+# a semicolon outside of quotes and parentheses
+_declaration_split_regex = re.compile(
+    r';(?=(?:[^"\'()]|"[^"]*"|\'[^\']*\'|\([^)]*\))*$)')
+
+
+def parse_inline_style(style):
+    """Returns the (name, value) pairs of a @style attribute, or None when
+    they can not be merged safely: the attribute does not parse cleanly or
+    uses !important.
+    """
+    declaration = cssutils.css.CSSStyleDeclaration(cssText=style)
+    properties = declaration.getProperties(all=True)
+    expected = len([part for part in _declaration_split_regex.split(style)
+                    if part.strip()])
+    if len(properties) != expected:
+        return None
+    if any(prop.priority for prop in properties):
+        return None
+    return tuple((prop.name, prop.value) for prop in properties)
+
+
+def inline_properties(soup):
+    """Returns the names of the properties the @style attributes of the
+    elements of `soup` declare
+    """
+    names = set()
+    for elem in soup.findAll(style=True):
+        for part in _declaration_split_regex.split(elem['style']):
+            name, colon, _ = part.partition(':')
+            if colon:
+                names.add(name.strip().lower())
+    return frozenset(names)
+
+
+def merge_declarations(applied, inline):
+    """Merges the declarations applied from the stylesheet with those of
+    the inline style, which win, and drops every declaration overridden by a
+    later one. Returns a tuple of (name, value) pairs.
+    """
+    merged = []
+    for name, value in applied + inline:
+        overridden = OVERRIDES.get(name, ())
+        merged = [(other, other_value) for other, other_value in merged
+                  if other != name and other not in overridden]
+        merged.append((name, value))
+    return tuple(merged)
+
+
+def _is_block_boundary(node, parent):
+    if node is None:
+        return parent.parent is None or parent.name in BLOCK_TAGS
+    return isinstance(node, bs.Tag) and node.name in BLOCK_TAGS
+
+
+def collapse_block_white_space(soup):
+    """Removes white space only text between block-level tags, and between
+    a block-level tag and the start or end of its block-level parent.
+    Returns the number of UTF-8 bytes removed.
+    """
+    removed = 0
+    for node in soup.findAll(text=True):
+        if type(node) is not bs.NavigableString or node.strip():
+            continue
+        parent = node.parent
+        if parent.findParent(PRESERVE_WHITE_SPACE_TAGS) is not None or \
+                parent.name in PRESERVE_WHITE_SPACE_TAGS:
+            continue
+        if _is_block_boundary(node.previousSibling, parent) and \
+                _is_block_boundary(node.nextSibling, parent):
+            removed += len(node.encode('utf-8'))
+            node.extract()
+    return removed
+
+
+_SIDES = ('top', 'right', 'bottom', 'left')
+
+# shorthands setting one value per side
+_BOX_SHORTHANDS = (
+    ('margin', 'margin-%s'),
+    ('padding', 'padding-%s'),
+    ('border-width', 'border-%s-width'),
+    ('border-style', 'border-%s-style'),
+    ('border-color', 'border-%s-color'),
+)
+
+_GLOBAL_KEYWORDS = frozenset(('inherit', 'initial', 'unset', 'revert'))
+
+# properties the border shorthand resets besides the ones it folds
+BORDER_RESETS = frozenset((
+    'border-image', 'border-image-source', 'border-image-slice',
+    'border-image-width', 'border-image-outset', 'border-image-repeat',
+))
+
+# inherited properties the font shorthand resets besides the ones it folds
+FONT_RESETS = frozenset((
+    'font-stretch', 'font-size-adjust', 'font-kerning', 'font-variant-caps',
+    'font-variant-ligatures', 'font-variant-numeric', 'font-variant-east-asian',
+    'font-variant-alternates', 'font-variant-position', 'font-feature-settings',
+    'font-language-override', 'font-optical-sizing', 'font-variation-settings',
+))
+
+
+def _foldable(values, single_token=True):
+    for value in values:
+        if value.lower() in _GLOBAL_KEYWORDS or 'var(' in value.lower():
+            return False
+        if single_token and len(value.split()) != 1:
+            return False
+    return True
+
+
+def _box_value(values):
+    if not _foldable(values):
+        return None
+    top, right, bottom, left = values
+    if left != right:
+        return u' '.join(values)
+    if bottom != top:
+        return u' '.join((top, right, bottom))
+    if right != top:
+        return u' '.join((top, right))
+    return top
+
+
+def _border_side_value(values):
+    width, style, color = values
+    if not _foldable((width, style)) or not _foldable((color,), False):
+        return None
+    # the shorthand sets the parts it leaves out to these initial values
+    parts = [value for value, initial in zip(values, ('medium', 'none', 'currentcolor'))
+             if value.lower() != initial]
+    return u' '.join(parts) or u'none'
+
+
+def _border_value(values):
+    if len(set(values)) != 1:
+        return None
+    return values[0]
+
+
+def _font_value(values):
+    style, variant, weight, size, line_height, family = values
+    if not _foldable((style, variant, weight, size, line_height)) or \
+            not _foldable((family,), False):
+        return None
+    # only CSS 2.1 variants are allowed in the shorthand
+    if variant.lower() not in ('normal', 'small-caps'):
+        return None
+    parts = [value for value in (style, variant, weight) if value.lower() != 'normal']
+    if line_height.lower() == 'normal':
+        parts.append(size)
+    else:
+        parts.append(u'%s/%s' % (size, line_height))
+    parts.append(family)
+    return u' '.join(parts)
+
+
+def _fold(declarations, longhands, shorthand, value_function):
+    """Replaces `longhands` with one `shorthand` declaration at the position
+    of the last of them, when all of them are declared and no other
+    declaration setting any of them comes between or after them
+    """
+    positions = dict((name, i) for i, (name, _) in enumerate(declarations))
+    if not all(name in positions for name in longhands):
+        return declarations
+    first = min(positions[name] for name in longhands)
+    last = max(positions[name] for name in longhands)
+    longhand_set = frozenset(longhands)
+    for i, (name, _) in enumerate(declarations):
+        if i > first and name not in longhand_set and \
+                longhand_set & OVERRIDES.get(name, frozenset()):
+            return declarations
+    value = value_function([declarations[positions[name]][1] for name in longhands])
+    if value is None:
+        return declarations
+
+    folded = []
+    for i, (name, existing_value) in enumerate(declarations):
+        if i == last:
+            folded.append((shorthand, value))
+        elif name not in longhand_set and name != shorthand:
+            folded.append((name, existing_value))
+    return tuple(folded)
+
+
+def _sets_font(name):
+    return name in ('font', 'line-height') or name.startswith('font-')
+
+
+def fold_shorthands(declarations, declared_properties=frozenset(),
+                    inline_properties=frozenset()):
+    """Folds complete sets of longhand declarations into shorthands, leaving
+    out the parts the shorthand sets to their initial value anyway. Returns
+    a tuple of (name, value) pairs with the same computed style.
+
+    `declared_properties` holds every property declared by the stylesheets
+    and `inline_properties` every property declared by the @style
+    attributes of the document. Font is not folded when the former contains
+    inherited properties the font shorthand would reset, or when the latter
+    contains any font property, as the inline styles of ancestors are not
+    known when declarations are serialized.
+    """
+    for side in _SIDES:
+        declarations = _fold(
+            declarations,
+            tuple('border-%s-%s' % (side, part) for part in ('width', 'style', 'color')),
+            'border-' + side, _border_side_value)
+    names = frozenset(name for name, _ in declarations)
+    if not names & BORDER_RESETS:
+        declarations = _fold(declarations, tuple('border-' + side for side in _SIDES),
+                             'border', _border_value)
+    for shorthand, longhand in _BOX_SHORTHANDS:
+        declarations = _fold(declarations, tuple(longhand % side for side in _SIDES),
+                             shorthand, _box_value)
+    if not (names | declared_properties) & FONT_RESETS and \
+            not any(_sets_font(name) for name in inline_properties):
+        declarations = _fold(declarations, ('font-style', 'font-variant', 'font-weight',
+                                            'font-size', 'line-height', 'font-family'),
+                             'font', _font_value)
+    return declarations
+
+
+# an attribute selector, left alone, or a pseudo-class or pseudo-element
+# with its argument
+_pseudo_regex = re.compile(r'(\[[^\]]*\])|::?([\w-]+)(?:\([^)]*\))?')
+
+
+def _widen(selector):
+    """Removes the pseudo-classes soupselect does not evaluate, such as
+    those that depend on the state of the user agent or :not(), and
+    pseudo-elements from a selector, so that it matches every element that
+    could match it
+    """
+    def replace(match):
+        if match.group(1) or match.group(2).lower() in EVALUATED_PSEUDO_CLASSES:
+            return match.group(0)
+        # keep a compound selector that is left empty
+        if match.start() == 0 or selector[match.start() - 1] in ' >+~':
+            return '*'
+        return ''
+    return _pseudo_regex.sub(replace, selector)
+
+
+def _rule_matches(rule, select):
+    for text, _, _ in compile_selectors(rule):
+        try:
+            steps = parse_selector(_widen(text))
+        except SelectorNotSupportedException:
+            # may match
+            return True
+        if select(steps):
+            return True
+    return False
+
+
+def prune_media_rule(media_rule, select):
+    """Deletes the style rules of a cssutils @media rule that match no
+    element. `select` returns the elements that parsed selector steps match.
+    Selectors are matched without state dependent pseudo-classes and
+    pseudo-elements; rules with selectors that can not be matched are kept.
+    Returns the number of rules deleted.
+    """
+    deleted = 0
+    for rule in list(media_rule.cssRules):
+        if rule.type == cssutils.css.CSSRule.STYLE_RULE and \
+                not _rule_matches(rule, select):
+            media_rule.deleteRule(rule)
+            deleted += 1
+    return deleted
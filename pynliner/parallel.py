@@ -0,0 +1,250 @@
+"""Inlining one large document with several processes.
+
+The element that holds most of the document (the <body>, or the wrapper
+table most emails nest everything in) has its children split into
+contiguous partitions that are matched and cascaded in a process pool.
+Each partition is sent with its ancestors and a skeleton of their siblings:
+the name and attributes of every other element and a marker for every
+other text node, but none of their descendants. A selector only ever looks
+at an element's ancestors and preceding siblings, and positional
+pseudo-classes at the element's siblings, so every element of a partition
+matches exactly what it would in the whole document. The ancestors and
+everything outside the partitioned element are styled as one more
+partition. Workers return the @style of each element of their partition,
+which is set on the original document in order.
+
+The pool of a Pynliner is started by its first run of a document with at
+least MIN_ELEMENTS elements, kept for its later runs and stopped by
+`Pynliner.close`. Smaller documents are styled in the calling process, as
+sending them to the workers costs more than it saves.
+"""
+
+import hashlib
+from soupselect import is_white_space
+from compiled import CompiledStylesheet
+from optimize import inline_properties
+from _lazy import LazyModule
+
+bs = LazyModule('BeautifulSoup')
+multiprocessing = LazyModule('multiprocessing')
+
+# partitions per process, so that uneven partitions even out
+_PARTITIONS_PER_PROCESS = 4
+
+# documents with fewer elements are styled in the calling process
+MIN_ELEMENTS = 2000
+
+# the rules of the last run a worker styled a partition of, and their key
+_worker = {}
+
+
+def worth_splitting(soup):
+    """Returns True when `soup` is large enough to be styled by a pool"""
+    return len(soup.findAll(True)) >= MIN_ELEMENTS
+
+
+def create_pool(processes):
+    """Starts a pool of `processes` workers for apply_styles"""
+    return multiprocessing.Pool(processes, _init_worker)
+
+
+def _partition_root(soup):
+    """Returns the element whose children are partitioned: <body>, or the
+    first descendant of it with more than one element child
+    """
+    root = soup.find('body') or soup
+    while True:
+        children = [child for child in root.contents
+                    if isinstance(child, bs.Tag)]
+        if len(children) != 1:
+            return root
+        root = children[0]
+
+
+def _path(root):
+    """Returns the elements from the outermost one down to `root`, which is
+    empty when `root` is the soup itself
+    """
+    path = []
+    while root.parent is not None:
+        path.append(root)
+        root = root.parent
+    path.reverse()
+    return path
+
+
+def _encode_text(node):
+    # the content of text only matters to :first-child and :last-child,
+    # which skip white space and comments
+    if is_white_space(node):
+        return ()
+    return (None,)
+
+
+def _encode_full(el, elements):
+    """Encodes an element and its descendants, all of them styled"""
+    elements.append(el)
+    children = []
+    for child in el.contents:
+        if isinstance(child, bs.Tag):
+            children.append(_encode_full(child, elements))
+        else:
+            children.extend(_encode_text(child))
+    return (el.name, el.attrs, True, children)
+
+
+def _encode_skeleton(el):
+    """Encodes an element without its descendants, not styled"""
+    return (el.name, el.attrs, False, [])
+
+
+def _encode_level(parent, path, depth, encode_sibling, encode_root_child,
+                  elements, in_frame):
+    """Encodes the children of `parent`, the soup for depth 0 and
+    `path[depth - 1]` below it
+    """
+    if depth == len(path):
+        return [encoded for i, child in enumerate(parent.contents)
+                for encoded in encode_root_child(i, child)]
+    children = []
+    for child in parent.contents:
+        if not isinstance(child, bs.Tag):
+            children.extend(_encode_text(child))
+        elif child is path[depth]:
+            if in_frame:
+                elements.append(child)
+            grandchildren = _encode_level(child, path, depth + 1, encode_sibling,
+                                          encode_root_child, elements, in_frame)
+            children.append((child.name, child.attrs, in_frame, grandchildren))
+        else:
+            children.append(encode_sibling(child))
+    return children
+
+
+def encode_frame(soup, root):
+    """Encodes everything but the children of `root`. Returns the encoded
+    tree and the elements it styles in document order.
+    """
+    elements = []
+    encode_sibling = lambda el: _encode_full(el, elements)
+    encode_root_child = lambda index, child: ()
+    tree = _encode_level(soup, _path(root), 0, encode_sibling, encode_root_child,
+                         elements, True)
+    return tree, elements
+
+
+def encode_partition(soup, root, start, end):
+    """Encodes the children of `root` from index `start` up to `end` of its
+    contents, with skeletons of the rest of the document. Returns the
+    encoded tree and the elements it styles in document order.
+    """
+    elements = []
+
+    def encode_root_child(index, child):
+        if not isinstance(child, bs.Tag):
+            return _encode_text(child)
+        if start <= index < end:
+            return (_encode_full(child, elements),)
+        return (_encode_skeleton(child),)
+
+    tree = _encode_level(soup, _path(root), 0, _encode_skeleton,
+                         encode_root_child, elements, False)
+    return tree, elements
+
+
+def partitions(root, count):
+    """Splits the contents of `root` into at most `count` (start, end)
+    ranges holding about the same number of elements
+    """
+    weights = [len(child.findAll(True)) + 1 if isinstance(child, bs.Tag) else 0
+               for child in root.contents]
+    total = sum(weights)
+    ranges = []
+    start = 0
+    size = 0
+    for i, weight in enumerate(weights):
+        size += weight
+        if size * count >= total * (len(ranges) + 1) and i + 1 < len(weights):
+            ranges.append((start, i + 1))
+            start = i + 1
+    ranges.append((start, len(weights)))
+    return [(start, end) for start, end in ranges
+            if any(weights[start:end])]
+
+
+def decode(tree):
+    """Builds a soup from an encoded tree. Returns the soup and its styled
+    elements in document order.
+    """
+    soup = bs.BeautifulSoup('')
+    elements = []
+    _decode_children(soup, soup, tree, elements)
+    return soup, elements
+
+
+def _decode_children(soup, parent, children, elements):
+    for child in children:
+        if child is None:
+            node = bs.NavigableString(u'x')
+        else:
+            name, attrs, styled, grandchildren = child
+            node = bs.Tag(soup, name, list(attrs))
+            if styled:
+                elements.append(node)
+        parent.insert(len(parent.contents), node)
+        if child is not None:
+            _decode_children(soup, node, grandchildren, elements)
+
+
+def _init_worker():
+    import cssutils
+    # serialize declarations as Pynliner.run() does
+    cssutils.ser.prefs.propertyNameSpacer = u''
+
+
+def _style_partition(task):
+    """Matches and cascades an encoded partition in a worker. Returns the
+    resulting @style of each of its styled elements, or None, and the bytes
+    the output optimizations saved.
+    """
+    from pynliner import Pynliner
+    key, compiled_data, options, inline_names, tree = task
+    if _worker.get('key') != key:
+        # the first partition of a run this worker sees
+        _worker['rules'] = CompiledStylesheet.loads(compiled_data).rules
+        _worker['key'] = key
+    inliner = Pynliner(**options)
+    inliner.soup, elements = decode(tree)
+    inliner._apply_styles(_worker['rules'], inline_names)
+    return [el.get('style') for el in elements], inliner.bytes_saved
+
+
+def apply_styles(inliner, rules, pool):
+    """Applies `rules` to the soup of `inliner` with a `pool` of
+    `inliner.processes` workers started by create_pool
+    """
+    soup = inliner.soup
+    root = _partition_root(soup)
+    tasks = [encode_frame(soup, root)]
+    for start, end in partitions(root, inliner.processes * _PARTITIONS_PER_PROCESS):
+        tasks.append(encode_partition(soup, root, start, end))
+
+    options = {
+        'ingore_unsupported_selectors': inliner.ingore_unsupported_selectors,
+        'matcher': inliner.matcher,
+        'optimize_output': inliner.optimize_output,
+        'fold_shorthands': inliner.fold_shorthands,
+    }
+    # fold shorthands as if the whole document was styled in one process
+    inline_names = inline_properties(soup) if inliner.fold_shorthands else None
+    compiled_data = CompiledStylesheet(rules).dumps()
+    key = hashlib.sha1(compiled_data).hexdigest()
+    styles = pool.imap(_style_partition,
+                       [(key, compiled_data, options, inline_names, tree)
+                        for tree, _ in tasks])
+    for (_, elements), (partition_styles, bytes_saved) in zip(tasks, styles):
+        inliner._checkpoint()
+        inliner.bytes_saved += bytes_saved
+        for el, style in zip(elements, partition_styles):
+            if style is not None:
+                el['style'] = style
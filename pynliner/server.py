@@ -0,0 +1,357 @@
+"""Local HTTP inlining service.
+
+    python -m pynliner.server --css email=email.css --css news=news.css -j 4
+
+Keeps named compiled stylesheets in memory and inlines documents in a pool
+of worker processes, so callers in any language pay for neither starting
+an interpreter nor parsing the shared CSS per document:
+
+    POST /inline?css=email,news   HTML body in the charset of its
+                                  Content-Type, UTF-8 by default, answered
+                                  with the inlined HTML in UTF-8; the named
+                                  stylesheets cascade after the document's
+                                  own CSS
+    GET /health                   {"status": "ok", ...}
+    GET /metrics                  request counts and inlining latencies
+
+Connections are HTTP/1.1 and kept alive between requests; pipelined
+requests on a connection are answered in order. Each connection is served
+by a thread that waits for a worker while its document is inlined. With
+`-j 0` documents are inlined one at a time in the server process, so every
+request waits for those before it.
+
+The <link rel="stylesheet"> elements of posted documents are refused, as
+fetching them would let any client make the server request internal hosts
+or local files. `--fetch-links` fetches them over HTTP(S).
+"""
+
+import argparse
+import BaseHTTPServer
+import collections
+import json
+import multiprocessing
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+
+from pynliner import Pynliner, CompiledStylesheet, compile_css, warmup, __version__
+from pynliner.fetchers import ResolverFetcher, PooledHTTPFetcher
+
+# documents whose latency /metrics reports percentiles of
+_LATENCY_WINDOW = 1000
+
+# set in each worker by _init_worker
+_worker = {}
+
+
+def _init_worker(stylesheet_data, options):
+    _worker['stylesheets'] = dict(
+        (name, CompiledStylesheet.loads(data)) for name, data in stylesheet_data.items())
+    _worker['options'] = options
+
+
+def _inline_document(stylesheets, options, html, names):
+    """Inlines `html` with the stylesheets `names` refers to. Returns the
+    output and None, or None and the error.
+    """
+    try:
+        inliner = Pynliner(**options).from_string(html)
+        for name in names:
+            inliner.with_compiled(stylesheets[name])
+        return inliner.run(), None
+    except Exception, ex:
+        # not every exception can be sent back from a worker
+        return None, '%s: %s' % (type(ex).__name__, ex)
+
+
+def _inline(html, names):
+    return _inline_document(_worker['stylesheets'], _worker['options'], html, names)
+
+
+class Metrics(object):
+    """Counts of the documents a server inlined and the latencies of the
+    last `window` of them
+    """
+
+    def __init__(self, window=_LATENCY_WINDOW):
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self._latencies = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def finish(self, seconds, failed=False):
+        with self._lock:
+            self.in_flight -= 1
+            self.requests += 1
+            if failed:
+                self.errors += 1
+            self._latencies.append(seconds)
+
+    def snapshot(self):
+        """Returns the metrics as a dictionary that serializes to JSON"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            snapshot = {
+                'uptime_seconds': round(time.time() - self.started, 3),
+                'requests': self.requests,
+                'errors': self.errors,
+                'in_flight': self.in_flight,
+            }
+        if latencies:
+            percentile = lambda q: latencies[min(len(latencies) - 1, int(len(latencies) * q))]
+            snapshot['latency_seconds'] = dict(
+                (name, round(value, 6)) for name, value in (
+                    ('mean', sum(latencies) / len(latencies)),
+                    ('p50', percentile(0.5)),
+                    ('p90', percentile(0.9)),
+                    ('p99', percentile(0.99)),
+                    ('max', latencies[-1])))
+        return snapshot
+
+
+class InliningHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers the requests of one connection"""
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'pynliner/%s' % __version__
+    # seconds an idle connection is kept open
+    timeout = 60
+
+    def do_GET(self):
+        path = urlparse.urlparse(self.path).path
+        if path == '/health':
+            self._send_json(200, {
+                'status': 'ok',
+                'processes': self.server.processes,
+                'stylesheets': sorted(self.server.stylesheets),
+            })
+        elif path == '/metrics':
+            self._send_json(200, self.server.metrics.snapshot())
+        else:
+            self._send_text(404, 'not found')
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != '/inline':
+            # the body is left unread
+            return self._send_text(404, 'not found', close=True)
+        html = self._read_body()
+        if html is None:
+            return
+
+        names = []
+        for value in urlparse.parse_qs(url.query).get('css', []):
+            names.extend(name for name in value.split(',') if name)
+        unknown = [name for name in names if name not in self.server.stylesheets]
+        if unknown:
+            return self._send_text(400, 'unknown stylesheet: %s' % ', '.join(unknown))
+
+        metrics = self.server.metrics
+        metrics.start()
+        start = time.time()
+        output, error = self.server.inline(html, names)
+        metrics.finish(time.time() - start, error is not None)
+        if error is not None:
+            return self._send_text(500, error)
+        self._send(200, output.encode('utf-8'), 'text/html; charset=utf-8')
+
+    def _read_body(self):
+        """Returns the request body, or None after answering a request
+        without a usable one
+        """
+        length = self.headers.getheader('content-length')
+        if length is None:
+            self._send_text(411, 'Content-Length required', close=True)
+            return None
+        try:
+            length = int(length)
+        except ValueError:
+            self._send_text(400, 'invalid Content-Length', close=True)
+            return None
+        if length < 0 or length > self.server.max_body_bytes:
+            self._send_text(413, 'body larger than %d bytes' % self.server.max_body_bytes,
+                            close=True)
+            return None
+        if self.headers.getheader('expect', '').lower() == '100-continue':
+            self.wfile.write('%s 100 Continue\r\n\r\n' % self.protocol_version)
+        body = self.rfile.read(length)
+        charset = self.headers.getparam('charset') or 'utf-8'
+        try:
+            return body.decode(charset)
+        except (LookupError, UnicodeDecodeError), ex:
+            self._send_text(400, 'body is not %s: %s' % (charset, ex))
+            return None
+
+    def _send(self, status, body, content_type, close=False):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if close:
+            self.send_header('Connection', 'close')
+            self.close_connection = 1
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_text(self, status, text, close=False):
+        self._send(status, text + '\n', 'text/plain; charset=utf-8', close)
+
+    def _send_json(self, status, data):
+        self._send(status, json.dumps(data, sort_keys=True) + '\n', 'application/json')
+
+    def log_message(self, format, *args):
+        if self.server.log_requests:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class InliningServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server inlining documents with named stylesheets.
+
+    `stylesheets` maps names to CompiledStylesheets and `options` are
+    keyword arguments for Pynliner that can be sent to a worker process.
+    Documents are inlined by a pool of `processes` workers, or with None
+    one at a time in the serving process, every request waiting for the
+    runs of those before it.
+
+    Linked stylesheets are fetched with the `fetcher` of `options`. Without
+    one every link is refused with FetchError, so that clients can not make
+    the server request internal hosts or `file://` URLs; pass a
+    ResolverFetcher or a PooledHTTPFetcher to allow them.
+
+    >>> server = InliningServer(('127.0.0.1', 8025), {'email': compiled}, processes=4)
+    >>> server.serve_forever()
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, stylesheets, options=None, processes=None,
+                 max_body_bytes=16 * 1024 * 1024, log_requests=False):
+        self.stylesheets = dict(stylesheets)
+        self.options = dict(options or {})
+        self.options.setdefault('fetcher', ResolverFetcher({}))
+        self.processes = processes
+        self.max_body_bytes = max_body_bytes
+        self.log_requests = log_requests
+        self.metrics = Metrics()
+        self._lock = threading.Lock()
+        self.pool = None
+        if processes:
+            # workers are forked with the modules and caches a run needs
+            warmup(**self.options)
+            data = dict((name, compiled.dumps()) for name, compiled in self.stylesheets.items())
+            self.pool = multiprocessing.Pool(processes, _init_worker, (data, self.options))
+        try:
+            BaseHTTPServer.HTTPServer.__init__(self, address, InliningHandler)
+        except Exception:
+            self._close_pool()
+            raise
+
+    def inline(self, html, names):
+        """Inlines `html` with the stylesheets `names` refers to. Returns the
+        output and None, or None and the error.
+        """
+        if self.pool is not None:
+            return self.pool.apply(_inline, (html, names))
+        # runs change the global cssutils serializer preferences
+        with self._lock:
+            return _inline_document(self.stylesheets, self.options, html, names)
+
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        self._close_pool()
+
+    def _close_pool(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m pynliner.server',
+        description='Serve CSS inlining over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=8025,
+                        help='port to listen on (default: %(default)s)')
+    parser.add_argument('--css', action='append', default=[], metavar='NAME=FILE',
+                        help='CSS file requests can apply as NAME, may be repeated')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='worker processes, 0 to inline in the server process '
+                             '(default: %(default)s)')
+    parser.add_argument('--max-body-bytes', type=int, default=16 * 1024 * 1024)
+    parser.add_argument('--log-requests', action='store_true',
+                        help='log every request to stderr')
+    parser.add_argument('--fetch-links', action='store_true',
+                        help='fetch the linked stylesheets of documents over '
+                             'HTTP(S) rather than refusing them')
+
+    options = parser.add_argument_group('Pynliner options')
+    options.add_argument('--allow-conditional-comments', action='store_true')
+    options.add_argument('--preserve-media-queries', action='store_true')
+    options.add_argument('--preserve-unknown-rules', action='store_true')
+    options.add_argument('--prune-media-queries', action='store_true')
+    options.add_argument('--ignore-unsupported-selectors', action='store_true')
+    options.add_argument('--matcher', choices=('python', 'numpy'), default='python')
+    options.add_argument('--optimize-output', action='store_true')
+    options.add_argument('--fold-shorthands', action='store_true')
+    options.add_argument('--css-parser', choices=('cssutils', 'fast'), default='cssutils')
+    options.add_argument('--low-memory', action='store_true',
+                         help='drop parsed documents as soon as they are inlined')
+    return parser
+
+
+def main(argv=None):
+    parser = _parser()
+    args = parser.parse_args(argv)
+    if args.jobs < 0:
+        parser.error('--jobs must not be negative')
+
+    stylesheets = {}
+    for spec in args.css:
+        name, sep, path = spec.partition('=')
+        if not sep or not name:
+            parser.error('--css takes NAME=FILE, not %r' % spec)
+        with open(path, 'rb') as f:
+            stylesheets[name] = compile_css(f.read(),
+                                            preserve_unknown_rules=args.preserve_unknown_rules)
+    options = {
+        'allow_conditional_comments': args.allow_conditional_comments,
+        'preserve_media_queries': args.preserve_media_queries,
+        'preserve_unknown_rules': args.preserve_unknown_rules,
+        'prune_media_queries': args.prune_media_queries,
+        'ingore_unsupported_selectors': args.ignore_unsupported_selectors,
+        'matcher': args.matcher,
+        'optimize_output': args.optimize_output,
+        'fold_shorthands': args.fold_shorthands,
+        'css_parser': args.css_parser,
+        'low_memory': args.low_memory,
+    }
+    if args.fetch_links:
+        options['fetcher'] = PooledHTTPFetcher()
+
+    server = InliningServer((args.host, args.port), stylesheets, options,
+                            processes=args.jobs or None,
+                            max_body_bytes=args.max_body_bytes,
+                            log_requests=args.log_requests)
+    sys.stderr.write('pynliner serving on http://%s:%d/\n' % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
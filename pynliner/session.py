@@ -0,0 +1,227 @@
+"""Incremental re-inlining for documents whose CSS is edited repeatedly.
+
+A session parses the document once and remembers which elements every rule
+matches and what inline style each element started with. Inserting,
+deleting or replacing a rule then only recomputes the @style of the
+elements that rule matches, before or after the edit:
+
+>>> session = Pynliner().from_string(html).with_cssString(css).session()
+>>> session.output()
+>>> session.replace_rule(2, 'h1 { color: navy; }')
+>>> session.output()
+"""
+
+from collections import OrderedDict
+from soupselect import select_steps, SelectorNotSupportedException, SiblingIndex
+from compiled import compile_css
+from optimize import collapse_block_white_space, inline_properties
+from _lazy import LazyModule
+
+cssutils = LazyModule('cssutils')
+
+
+class _SessionRule(object):
+    """A compiled rule and the elements it matches, each with the
+    specificity of its most specific matching selector
+    """
+    __slots__ = ('rule', 'matches')
+
+    def __init__(self, rule, matches):
+        self.rule = rule
+        self.matches = matches
+
+
+class InliningSession(object):
+    """Keeps a document inlined while its style rules change. Create one
+    with `Pynliner.session()`.
+
+    Rules are addressed by their position in the cascade, like the CSSOM
+    `insertRule` and `deleteRule`: the style rules of the document come
+    first, then those added with `with_cssString` and `with_compiled`.
+    """
+
+    def __init__(self, inliner):
+        self.inliner = inliner
+        if not inliner.soup:
+            inliner._get_soup()
+        if not inliner.stylesheet:
+            inliner._get_styles()
+        self.soup = inliner.soup
+        self._sibling_index = SiblingIndex()
+        # element -> its @style before any rule was applied, or None
+        self._original_styles = {}
+        # element -> set of _SessionRule matching it
+        self._element_rules = {}
+        self._style_strings = {}
+        self._optimized_styles = {}
+        # element -> bytes optimize_output saved on its @style
+        self._bytes_saved = {}
+        self._collapsed = False
+        self._rules = []
+        if inliner.fold_shorthands:
+            inliner._inline_properties = inline_properties(self.soup)
+
+        affected = set()
+        for rule in inliner._get_compiled_rules():
+            session_rule = self._match(rule)
+            self._rules.append(session_rule)
+            affected.update(session_rule.matches)
+        self._restyle(affected)
+
+    @property
+    def rules(self):
+        """The compiled rules in cascade order"""
+        return [session_rule.rule for session_rule in self._rules]
+
+    def insert_rule(self, css_text, index=None):
+        """Parses a single style rule and inserts it at `index`, or after
+        all other rules. Returns the index of the new rule.
+        """
+        if index is None:
+            index = len(self._rules)
+        session_rule = self._match(self._compile(css_text))
+        self._rules.insert(index, session_rule)
+        self._restyle(session_rule.matches)
+        return index
+
+    def delete_rule(self, index):
+        """Removes the rule at `index`"""
+        session_rule = self._rules.pop(index)
+        self._unmatch(session_rule)
+        self._restyle(session_rule.matches)
+
+    def replace_rule(self, index, css_text):
+        """Replaces the rule at `index` with a single parsed style rule"""
+        new_rule = self._match(self._compile(css_text))
+        old_rule = self._rules[index]
+        self._rules[index] = new_rule
+        self._unmatch(old_rule)
+        affected = set(old_rule.matches)
+        affected.update(new_rule.matches)
+        self._restyle(affected)
+
+    def output(self):
+        """Returns the Unicode output of the document in its current state"""
+        if self.inliner.optimize_output and not self._collapsed:
+            self.inliner.bytes_saved += collapse_block_white_space(self.soup)
+            self._collapsed = True
+        self.inliner._serialize_output()
+        self.inliner._clean_output()
+        return self.inliner.output
+
+    def _compile(self, css_text):
+        rules = compile_css(css_text, log=self.inliner.log).rules
+        if len(rules) != 1:
+            raise ValueError('expected a single style rule, got %d' % len(rules))
+        return rules[0]
+
+    def _match(self, rule):
+        """Selects the elements of a compiled rule and records them"""
+        matches = {}
+        for selector, specificity, steps in rule.selectors:
+            if steps is None:
+                if self.inliner.ingore_unsupported_selectors:
+                    continue
+                raise SelectorNotSupportedException(selector)
+            for elem in self._select(steps):
+                previous = matches.get(elem)
+                if previous is None or previous < specificity:
+                    matches[elem] = specificity
+
+        session_rule = _SessionRule(rule, matches)
+        for elem in matches:
+            if elem not in self._original_styles:
+                self._original_styles[elem] = elem.get('style')
+            self._element_rules.setdefault(elem, set()).add(session_rule)
+        return session_rule
+
+    def _select(self, steps):
+        """Selects elements as run() would, against the original @style of
+        already styled elements
+        """
+        uses_style = any(attribute == 'style'
+                         for _, compound in steps
+                         for _, attribute, _ in compound.attributes)
+        if not uses_style:
+            return select_steps(self.soup, steps, self._sibling_index)
+        current = [(elem, elem.get('style')) for elem in self._original_styles]
+        for elem, _ in current:
+            self._set_style(elem, self._original_styles[elem])
+        try:
+            return select_steps(self.soup, steps, self._sibling_index)
+        finally:
+            for elem, style in current:
+                self._set_style(elem, style)
+
+    def _unmatch(self, session_rule):
+        for elem in session_rule.matches:
+            self._element_rules[elem].discard(session_rule)
+
+    def _restyle(self, elements):
+        """Recomputes the @style of `elements` from the rules matching them
+        and their original inline style
+        """
+        positions = dict((id(session_rule), i)
+                         for i, session_rule in enumerate(self._rules))
+        if self.inliner.fold_shorthands:
+            declared = frozenset(name for session_rule in self._rules
+                                 for name, _ in session_rule.rule.properties)
+            if declared != self.inliner._declared_properties:
+                # which shorthands fold depends on every declared property
+                self.inliner._declared_properties = declared
+                self._style_strings.clear()
+                self._optimized_styles.clear()
+                elements = list(self._element_rules)
+        previous_spacer = cssutils.ser.prefs.propertyNameSpacer
+        cssutils.ser.prefs.propertyNameSpacer = u''
+        try:
+            for elem in elements:
+                self._restyle_element(elem, positions)
+        finally:
+            cssutils.ser.prefs.propertyNameSpacer = previous_spacer
+
+    def _restyle_element(self, elem, positions):
+        original = self._original_styles[elem]
+        session_rules = self._element_rules[elem]
+        if not session_rules:
+            self._set_style(elem, original)
+            self._count_saved(elem, 0)
+            return
+
+        # ascending sort of matches on specificity, then source order
+        matches = sorted((session_rule.matches[elem], positions[id(session_rule)],
+                          session_rule.rule) for session_rule in session_rules)
+        declarations = OrderedDict()
+        for _, _, rule in matches:
+            for name, value in rule.properties:
+                declarations[name] = value
+        declarations = tuple(declarations.iteritems())
+
+        style_string = self._style_strings.get(declarations)
+        if style_string is None:
+            style_string = self.inliner._serialize_declarations(declarations)
+            self._style_strings[declarations] = style_string
+        if self.inliner.optimize_output:
+            before = self.inliner.bytes_saved
+            style_string = self.inliner._optimize_style(
+                declarations, style_string, original, self._optimized_styles)
+            saved = self.inliner.bytes_saved - before
+            self.inliner.bytes_saved = before
+            self._count_saved(elem, saved)
+        elif original is not None:
+            style_string = u'%s;%s' % (style_string, original)
+        self._set_style(elem, style_string)
+
+    def _count_saved(self, elem, saved):
+        """Keeps `bytes_saved` of the inliner counting the current @style of
+        `elem` only
+        """
+        self.inliner.bytes_saved += saved - self._bytes_saved.get(elem, 0)
+        self._bytes_saved[elem] = saved
+
+    @staticmethod
+    def _set_style(elem, style):
+        if style is not None:
+            elem['style'] = style
+        elif elem.has_key('style'):
+            del elem['style']
@@ -0,0 +1,377 @@
+"""Shadow runs validating a new matching or cascade engine.
+
+With `Pynliner(shadow=ShadowMode(candidate, sample_rate, callback))` a
+sample of runs are repeated with the `candidate` Pynliner options, such as
+`{'matcher': 'numpy'}` or `{'css_parser': 'fast'}`, after the normal run
+has produced its output, which is returned unchanged:
+
+>>> def report(report):
+...     if not report.matches:
+...         log.warning('candidate differs: %r', report.selector_mismatches)
+...     stats.timing('pynliner.candidate_ratio', report.ratio)
+>>> shadow = ShadowMode({'matcher': 'numpy'}, sample_rate=0.01, callback=report)
+>>> Pynliner(shadow=shadow).from_string(html).run()
+
+For every selector the elements soupselect selects are compared with those
+the candidate matcher selects, and the @style attribute of every element
+with the one the candidate gives it. Each mismatching selector is reported
+with the smallest selector and document found that still show it, within
+the time and document size limits of the ShadowMode.
+
+The candidate runs, and the callback is called with a ShadowReport, in the
+inlining thread before `run` returns, so a shadowed run takes as long as
+both runs and the comparison together. The linked stylesheets the run
+fetched are passed to the candidate rather than fetched again.
+"""
+
+import random
+import sys
+import time
+import traceback
+from soupselect import select_steps, SiblingIndex
+from fetchers import ResolverFetcher
+import parallel
+from _lazy import LazyModule
+
+cssutils = LazyModule('cssutils')
+bs = LazyModule('BeautifulSoup')
+
+# mismatching selectors that are minimized per run; minimizing takes a
+# number of matches in the order of the size of the document
+_MAX_MINIMIZED = 5
+
+
+class SelectorMismatch(object):
+    """A selector soupselect and the candidate matcher select different
+    elements for. `expected` and `selected` are the numbers of elements
+    they select in the document; `minimized_selector` and
+    `minimized_document` are the smallest found that still show a
+    difference, None if it was not minimized. `minimized_complete` is False
+    when minimizing ran out of time, leaving them larger than they could be.
+    """
+
+    def __init__(self, selector, expected, selected,
+                 minimized_selector=None, minimized_document=None):
+        self.selector = selector
+        self.expected = expected
+        self.selected = selected
+        self.minimized_selector = minimized_selector
+        self.minimized_document = minimized_document
+        self.minimized_complete = None
+
+    def __repr__(self):
+        return '<SelectorMismatch %r expected %d selected %d minimized %r>' % (
+            self.selector, self.expected, self.selected, self.minimized_selector)
+
+
+class StyleMismatch(object):
+    """An element whose @style differs. `index` is its position among all
+    elements in document order.
+    """
+
+    def __init__(self, index, name, expected, styled):
+        self.index = index
+        self.name = name
+        self.expected = expected
+        self.styled = styled
+
+    def __repr__(self):
+        return '<StyleMismatch <%s> #%d expected %r styled %r>' % (
+            self.name, self.index, self.expected, self.styled)
+
+
+class ShadowReport(object):
+    """The comparison of one run with its candidate run.
+
+    `seconds` and `candidate_seconds` are the durations of both runs,
+    `select_seconds` and `candidate_select_seconds` the time soupselect and
+    the candidate matcher took to select the elements of every selector.
+    `error` is the traceback of an exception raised by the candidate.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.candidate_seconds = None
+        self.select_seconds = 0.0
+        self.candidate_select_seconds = 0.0
+        self.selector_mismatches = []
+        self.style_mismatches = []
+        self.same_output = None
+        self.error = None
+
+    @property
+    def matches(self):
+        """True when the candidate gave the same result"""
+        return self.error is None and not self.selector_mismatches and \
+            not self.style_mismatches and bool(self.same_output)
+
+    @property
+    def ratio(self):
+        """Duration of the candidate run relative to the normal run"""
+        if self.candidate_seconds is None or not self.seconds:
+            return None
+        return self.candidate_seconds / self.seconds
+
+
+class ShadowMode(object):
+    """Repeats a `sample_rate` fraction of runs with the `candidate`
+    Pynliner options, which override those of the run, and passes a
+    ShadowReport to `callback`.
+
+    Mismatching selectors are minimized for at most `minimize_seconds` per
+    run, and only in documents of up to `max_minimized_elements` elements;
+    a `minimize_seconds` of 0 turns minimizing off.
+    """
+
+    def __init__(self, candidate, sample_rate=1.0, callback=None,
+                 minimize_seconds=1.0, max_minimized_elements=2000):
+        self.candidate = dict(candidate)
+        self.sample_rate = sample_rate
+        self.callback = callback
+        self.minimize_seconds = minimize_seconds
+        self.max_minimized_elements = max_minimized_elements
+
+    def start(self):
+        """Returns the start time of a run that is to be shadowed, or None"""
+        if random.random() >= self.sample_rate:
+            return None
+        return time.time()
+
+    def finish(self, inliner, started):
+        """Runs the candidate for a finished run of `inliner` started at
+        `started` and reports the comparison
+        """
+        report = ShadowReport(time.time() - started)
+        try:
+            _compare(inliner, self, report)
+        except Exception:
+            report.error = ''.join(traceback.format_exception(*sys.exc_info()))
+        if self.callback is not None:
+            self.callback(report)
+        return report
+
+
+def _candidate(inliner, candidate_options):
+    """Builds a Pynliner for the same input as `inliner` with its options
+    overridden by `candidate_options`
+    """
+    from pynliner import Pynliner
+    options = dict((name, getattr(inliner, name)) for name in inliner._OUTPUT_OPTIONS)
+    # serve the linked stylesheets the run fetched from memory
+    fetched = ResolverFetcher(dict((url, {'': content})
+                                   for url, content in inliner._linked_contents),
+                              fallback=inliner.fetcher)
+    options.update(log=inliner.log, fetcher=fetched, matcher=inliner.matcher,
+                   processes=inliner.processes, css_parser=inliner.css_parser)
+    options.update(candidate_options)
+    candidate = Pynliner(**options)
+    candidate.source_string = inliner.source_string
+    candidate.fragment_ancestors = inliner.fragment_ancestors
+    candidate.root_url = inliner.root_url
+    candidate.relative_url = inliner.relative_url
+    candidate.extra_style_strings = list(inliner.extra_style_strings)
+    candidate.compiled_stylesheets = list(inliner.compiled_stylesheets)
+    return candidate
+
+
+def _soupselect(soup):
+    sibling_index = SiblingIndex()
+    return lambda steps: select_steps(soup, steps, sibling_index)
+
+
+def _candidate_select(candidate, soup):
+    """Returns the candidate's function selecting the elements of `soup`"""
+    from pynliner import Pynliner
+    matcher = Pynliner(matcher=candidate.matcher)
+    matcher.soup = soup
+    return matcher._selector_function()
+
+
+def _element_ids(elements):
+    return set(id(el) for el in elements)
+
+
+def _compare(inliner, shadow, report):
+    candidate = _candidate(inliner, shadow.candidate)
+    start = time.time()
+    candidate._get_soup()
+    candidate._get_styles()
+    rules = candidate._get_compiled_rules()
+    seconds = time.time() - start
+
+    if candidate.matcher != 'python':
+        _compare_selections(candidate, rules, report, shadow)
+
+    start = time.time()
+    previous_spacer = cssutils.ser.prefs.propertyNameSpacer
+    cssutils.ser.prefs.propertyNameSpacer = u''
+    try:
+        if candidate.processes > 1 and parallel.worth_splitting(candidate.soup):
+            if inliner.processes > 1:
+                # the rules go with every task, so the run's workers serve
+                parallel.apply_styles(candidate, rules, inliner._get_pool())
+            else:
+                try:
+                    parallel.apply_styles(candidate, rules, candidate._get_pool())
+                finally:
+                    candidate.close()
+        else:
+            candidate._apply_styles(rules)
+    finally:
+        cssutils.ser.prefs.propertyNameSpacer = previous_spacer
+    candidate._get_output()
+    candidate._clean_output()
+    report.candidate_seconds = seconds + time.time() - start
+
+    expected = inliner.soup.findAll(True)
+    styled = candidate.soup.findAll(True)
+    for index, (el, candidate_el) in enumerate(zip(expected, styled)):
+        if el.get('style') != candidate_el.get('style'):
+            report.style_mismatches.append(StyleMismatch(
+                index, el.name, el.get('style'), candidate_el.get('style')))
+    report.same_output = inliner.output == candidate.output
+
+
+def _compare_selections(candidate, rules, report, shadow):
+    """Compares the elements soupselect and the candidate matcher select
+    for every selector of `rules` in the candidate's document
+    """
+    soup = candidate.soup
+    expected_select = _soupselect(soup)
+    candidate_select = _candidate_select(candidate, soup)
+    compared = set()
+    minimize = shadow.minimize_seconds > 0 and \
+        len(soup.findAll(True)) <= shadow.max_minimized_elements
+    deadline = None
+    for rule in rules:
+        for text, _, steps in rule.selectors:
+            if steps is None or text in compared:
+                continue
+            compared.add(text)
+            start = time.time()
+            expected = expected_select(steps)
+            middle = time.time()
+            selected = candidate_select(steps)
+            report.candidate_select_seconds += time.time() - middle
+            report.select_seconds += middle - start
+            if _element_ids(expected) == _element_ids(selected):
+                continue
+            mismatch = SelectorMismatch(text, len(expected), len(selected))
+            if minimize and len(report.selector_mismatches) < _MAX_MINIMIZED:
+                if deadline is None:
+                    deadline = time.time() + shadow.minimize_seconds
+                _minimize(candidate, soup, steps, mismatch, deadline)
+            report.selector_mismatches.append(mismatch)
+
+
+def _differs(candidate, soup, steps):
+    expected = _soupselect(soup)(steps)
+    return _element_ids(expected) != _element_ids(_candidate_select(candidate, soup)(steps))
+
+
+def _minimize(candidate, soup, steps, mismatch, deadline):
+    """Shrinks the selector and a copy of the document while the engines
+    still disagree, until `deadline`, and records them on `mismatch`
+    """
+    if time.time() >= deadline:
+        return
+    copy = bs.BeautifulSoup(unicode(soup))
+    if not _differs(candidate, copy, steps):
+        # the document does not survive serializing
+        return
+    out_of_time = []
+
+    def differs(steps):
+        # once out of time every smaller case is taken to agree, so the
+        # remaining steps finish without matching
+        if out_of_time or time.time() >= deadline:
+            out_of_time.append(True)
+            return False
+        return _differs(candidate, copy, steps)
+
+    steps = _minimize_selector(steps, differs)
+    _minimize_document(copy, lambda: differs(steps))
+    mismatch.minimized_selector = selector_text(steps)
+    mismatch.minimized_document = unicode(copy)
+    mismatch.minimized_complete = not out_of_time
+
+
+def _without_part(compound):
+    """Yields copies of a compound selector with one part left out"""
+    if compound.tag is not True:
+        yield compound._replace(tag=True)
+    for field in ('ids', 'classes', 'attributes', 'pseudo_classes'):
+        parts = getattr(compound, field)
+        for i in range(len(parts)):
+            yield compound._replace(**{field: parts[:i] + parts[i + 1:]})
+
+
+def _minimize_selector(steps, differs):
+    """Drops leading compound selectors and parts of compound selectors
+    while `differs` holds
+    """
+    while len(steps) > 1:
+        shorter = ((None, steps[1][1]),) + steps[2:]
+        if not differs(shorter):
+            break
+        steps = shorter
+    changed = True
+    while changed:
+        changed = False
+        for i, (operator, compound) in enumerate(steps):
+            for smaller in _without_part(compound):
+                shorter = steps[:i] + ((operator, smaller),) + steps[i + 1:]
+                if differs(shorter):
+                    steps = shorter
+                    changed = True
+                    break
+            if changed:
+                break
+    return steps
+
+
+def _minimize_document(soup, differs):
+    """Removes subtrees, largest first, and then attributes from `soup`
+    while `differs` holds
+    """
+    def visit(parent):
+        for child in list(parent.contents):
+            index = parent.index(child)
+            child.extract()
+            if differs():
+                continue
+            parent.insert(index, child)
+            if isinstance(child, bs.Tag):
+                visit(child)
+    visit(soup)
+    for el in soup.findAll(True):
+        for name, value in list(el.attrs):
+            del el[name]
+            if not differs():
+                el[name] = value
+
+
+def selector_text(steps):
+    """Serializes parsed selector steps"""
+    text = []
+    for operator, compound in steps:
+        if operator is not None:
+            text.append(u' ' if operator == ' ' else u' %s ' % operator)
+        text.append(_compound_text(compound))
+    return u''.join(text)
+
+
+def _compound_text(compound):
+    text = [u'*' if compound.tag is True else compound.tag]
+    text.extend(u'#' + id_ for id_ in compound.ids)
+    text.extend(u'.' + class_ for class_ in compound.classes)
+    for operator, attribute, value in compound.attributes:
+        if not operator:
+            text.append(u'[%s]' % attribute)
+        else:
+            text.append(u'[%s%s="%s"]' % (attribute, operator.rstrip('=') + '=', value))
+    for name, argument in compound.pseudo_classes:
+        text.append(u':%s(%s)' % (name, argument) if argument else u':' + name)
+    if len(text) > 1 and text[0] == u'*':
+        del text[0]
+    return u''.join(text)
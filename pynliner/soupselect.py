@@ -15,21 +15,38 @@ select(soup, 'div#main ul a')
 patched to support multiple class selectors here http://code.google.com/p/soupselect/issues/detail?id=4#c0
 """
 import re
-import BeautifulSoup
+from collections import namedtuple
+from _lazy import LazyModule
+from _memo import BoundedDict
+
+# imported on first use, parsing selectors does not need it
+BeautifulSoup = LazyModule('BeautifulSoup')
 
 class SelectorNotSupportedException(Exception):
     pass
 
-attribute_regex = re.compile('\[(?P<attribute>\w+)(?P<operator>[=~\|\^\$\*]?)=?["\']?(?P<value>[^\]"]*)["\']?\]')
+attribute_regex = re.compile('\[(?P<attribute>[\w-]+)(?P<operator>[=~\|\^\$\*]?)=?["\']?(?P<value>[^\]"]*)["\']?\]')
 
 # Taken from http://www.w3.org/TR/CSS2/grammar.html#scanner and
 # http://stackoverflow.com/questions/9329552/explain-regex-that-finds-css-comments
 single_line_comment_regex = re.compile('\/\*[^*]*\*+([^/*][^*]*\*+)*\/')
 
-pseudo_classes_regexes = (
-    re.compile(':(first-child)'),
-    re.compile(':(last-child)')
-)
+# The rightmost compound selector of a selector string. Attribute selectors
+# and pseudo-class arguments are matched as a whole so they may contain
+# combinator characters and whitespace.
+token_regex = re.compile('((?:[_0-9a-zA-Z#.:*-]|\[[^\]]*\]|\([^)]*\))+)$')
+combinator_regex = re.compile('([>~+])$')
+bracket_regex = re.compile('\[[^\]]*\]')
+pseudo_class_regex = re.compile(':{1,2}([a-zA-Z-]+)(?:\(([^)]*)\))?')
+nth_regex = re.compile('^(?:(?P<a>[+-]?\d*)n(?:(?P<sign>[+-])(?P<b>\d+))?|(?P<only_b>[+-]?\d+))$')
+
+# A compound selector such as `div#main.a.b[title]:first-child`
+Compound = namedtuple('Compound', 'tag ids classes attributes pseudo_classes')
+
+# selector string -> parsed steps of up to 10000 selectors, see
+# parse_selector
+_parsed_selectors = BoundedDict(10000)
+
 
 def get_attribute_checker(operator, attribute, value=''):
     """
@@ -52,38 +69,122 @@ def get_attribute_checker(operator, attribute, value=''):
     }.get(operator, lambda el: el.has_key(attribute))
 
 def is_white_space(el):
-    if isinstance(el, BeautifulSoup.NavigableString) and str(el).strip() == '':
-        return True
     if isinstance(el, BeautifulSoup.Comment):
         return True
+    if isinstance(el, BeautifulSoup.NavigableString) and el.strip() == '':
+        return True
     return False
 
-def is_last_content_node(el):
-    result = False
-    if el is None:
-        result = True
-    elif is_white_space(el):
-        result = is_last_content_node(el.nextSibling)
-    return result
-
-def is_first_content_node(el):
-    result = False
-    if el is None:
-        result = True
-    if is_white_space(el):
-        result = is_first_content_node(el.previousSibling)
-    return result
-        
-def get_pseudo_class_checker(psuedo_class):
-    """
-    Takes a psuedo_class, like "first-child" or "last-child"
-    and returns a function that will check if the element satisfies
-    that psuedo class
+def parse_nth(expression):
     """
-    return {
-        'first-child': lambda el: is_first_content_node(getattr(el, 'previousSibling', None)),
-        'last-child': lambda el: is_last_content_node(getattr(el, 'nextSibling', None))
+    Takes the argument of an :nth-child() style pseudo class, like "odd",
+    "3" or "2n+1", and returns the (a, b) pair of the an+b form.
+    """
+    expression = ''.join(expression.split()).lower()
+    if expression == 'odd':
+        return 2, 1
+    if expression == 'even':
+        return 2, 0
+    match = nth_regex.match(expression)
+    if not match:
+        raise SelectorNotSupportedException(expression)
+    if match.group('only_b') is not None:
+        return 0, int(match.group('only_b'))
+    a = match.group('a')
+    a = {'': 1, '+': 1, '-': -1}.get(a) or int(a)
+    b = int(match.group('b') or 0)
+    if match.group('sign') == '-':
+        b = -b
+    return a, b
+
+def nth_matches(a, b, position):
+    """
+    Returns True if the 1-based `position` is a+b for some n >= 0
+    """
+    if a == 0:
+        return position == b
+    return (position - b) % a == 0 and (position - b) // a >= 0
+
+
+class _Position(object):
+    """Where an element sits among its parent's element children; text and
+    comments are not counted.
+    """
+    __slots__ = ('siblings', 'index', 'type_index', 'type_count')
+
+
+class SiblingIndex(object):
+    """
+    Positions of elements among their siblings, computed once per parent the
+    first time one of its children is looked up. Share one index between
+    calls to `select` on the same, unmodified document.
+    """
+
+    def __init__(self):
+        self._positions = {}
+        # keep indexed parents alive so their ids can not be reused
+        self._parents = {}
+
+    def position(self, el):
+        try:
+            return self._positions[id(el)]
+        except KeyError:
+            self._index_children(el.parent)
+            return self._positions[id(el)]
+
+    def _index_children(self, parent):
+        self._parents[id(parent)] = parent
+        siblings = []
+        positions = []
+        type_counts = {}
+        for node in parent.contents:
+            if isinstance(node, BeautifulSoup.Tag):
+                position = _Position()
+                position.siblings = siblings
+                position.index = len(siblings)
+                position.type_index = type_counts.get(node.name, 0)
+                type_counts[node.name] = position.type_index + 1
+                siblings.append(node)
+                positions.append(position)
+                self._positions[id(node)] = position
+        for node, position in zip(siblings, positions):
+            position.type_count = type_counts[node.name]
+
+    def previous_sibling(self, el):
+        """Returns the previous element sibling of `el` or None"""
+        position = self.position(el)
+        if position.index == 0:
+            return None
+        return position.siblings[position.index - 1]
+
+# pseudo-classes get_pseudo_class_checker evaluates; selectors with any
+# other raise SelectorNotSupportedException
+EVALUATED_PSEUDO_CLASSES = frozenset((
+    'first-child', 'last-child', 'first-of-type', 'last-of-type',
+    'nth-child', 'nth-last-child'))
+
+def get_pseudo_class_checker(psuedo_class, argument, index):
+    """
+    Takes a psuedo_class, like "first-child" or "nth-child", its argument
+    and a SiblingIndex and returns a function that will check if the element
+    satisfies that psuedo class. Positions count element siblings only.
+    """
+    position = index.position
+    if psuedo_class in ('nth-child', 'nth-last-child'):
+        a, b = parse_nth(argument or '')
+        if psuedo_class == 'nth-child':
+            return lambda el: nth_matches(a, b, position(el).index + 1)
+        return lambda el: nth_matches(
+            a, b, len(position(el).siblings) - position(el).index)
+    checker = {
+        'first-child': lambda el: position(el).index == 0,
+        'last-child': lambda el: position(el).index == len(position(el).siblings) - 1,
+        'first-of-type': lambda el: position(el).type_index == 0,
+        'last-of-type': lambda el: position(el).type_index == position(el).type_count - 1,
     }.get(psuedo_class)
+    if checker is None:
+        raise SelectorNotSupportedException(':' + psuedo_class)
+    return checker
 
 def get_checker(functions):
     def checker(el):
@@ -93,147 +194,226 @@ def get_checker(functions):
         return el
     return checker
 
+def parse_compound(token):
+    """
+    Takes a compound selector token, like "a.b#c[d]:first-child", and
+    returns a Compound.
+    """
+    attributes = tuple(
+        (match[1], match[0], match[2]) for match in attribute_regex.findall(token))
+    bare_token = bracket_regex.sub('', token)
+    pseudo_classes = tuple(
+        (name.lower(), argument) for name, argument in pseudo_class_regex.findall(bare_token))
+    for name, argument in pseudo_classes:
+        if name not in EVALUATED_PSEUDO_CLASSES:
+            raise SelectorNotSupportedException(token)
+        if name in ('nth-child', 'nth-last-child'):
+            parse_nth(argument)
+    bare_token = pseudo_class_regex.sub('', bare_token)
+
+    tag = re.findall('^([a-zA-Z0-9]+)', bare_token)
+    if len(tag) == 0:
+        tag = True
+    elif len(tag) == 1:
+        tag = tag[0].lower()
+    else:
+        raise Exception("Multiple tags found (invalid CSS)")
+
+    ids = re.findall('#([a-zA-Z0-9_-]+)', bare_token)
+    if len(ids) > 1:
+        raise Exception("Only single # OK")
+    classes = re.findall('\.([a-zA-Z0-9_-]+)', bare_token)
+
+    return Compound(tag, tuple(ids), tuple(classes), attributes, pseudo_classes)
 
-def select(soup, selector):
+def parse_selector(selector):
     """
-    soup should be a BeautifulSoup instance; selector is a CSS selector 
-    specifying the elements you want to retrieve.
+    Splits a selector into its compound selectors and the combinators
+    between them. Returns a tuple of (combinator, Compound) pairs from left
+    to right; the combinator of the first pair is None. Results are cached
+    per selector string.
     """
+    try:
+        return _parsed_selectors[selector]
+    except KeyError:
+        steps = _parse_selector(selector)
+        _parsed_selectors[selector] = steps
+        return steps
 
+def _parse_selector(selector):
     # Strip out any comments.
-    selector = single_line_comment_regex.sub('', selector).strip()
+    selector = original_selector = single_line_comment_regex.sub('', selector).strip()
 
-    handle_token = True
-    current_context = [(soup, [])]
-    operator = None
+    steps = []
     while selector:
-        if handle_token:
-            # Get the rightmost token
-            handle_token = False
-            match = re.search('([_0-9a-zA-Z-#.:*"\'\[\\]=]+)$', selector)
-            if not match:
-                raise SelectorNotSupportedException(selector)
-            token = match.groups(1)[0]
-
-            # remove this token from the selector
-            selector = selector.rsplit(token, 1)[0].rstrip()
-            
-            checker_functions = []
-            #
-            # Get attribute selectors from token
-            #
-            matches = attribute_regex.findall(token)
-            for match in matches:
-                checker_functions.append(get_attribute_checker(match[1], match[0], match[2]))
-
-            #
-            # Get pseudo classes from token
-            #
-            for pseudo_class_regex in pseudo_classes_regexes:
-                match = pseudo_class_regex.search(token)
-                if match:
-                    checker_functions.append(get_pseudo_class_checker(match.groups(1)[0]))
-
-            checker = get_checker(checker_functions)
-            #
-            # Get tag
-            #
-            tag = re.findall('^([a-zA-Z0-9]+)', token)
-            if len(tag) == 0:
-                tag = True
-            elif len(tag) == 1:
-                tag = tag[0]
-            else:
-                raise Exception("Multiple tags found (invalid CSS)")
-
-            #
-            # Get ID
-            #
-            ids = re.findall('#([a-zA-Z0-9_-]+)', token)
-            if len(ids) > 1:
-                raise Exception("Only single # OK")
-            #
-            # Get classes
-            #
-            classes = re.findall('\.([a-zA-Z0-9_-]+)', token)
-
-            #
-            # Search contexts for matches
-            #
-            found = []
-            find_dict = {}
-            if ids:
-                find_dict['id'] = ids
-            if classes:
-                find_dict['class'] = lambda attr: attr and set(classes).issubset(attr.split())
-            if operator is None:
-                # This is the first token: simply find all matches
-                for context in current_context:
-                    context_matches = [el for el in context[0].findAll(tag, find_dict) if checker(el)]
-                    for context_match in context_matches:
-                        found.append(
-                            (context_match, [context_match]),
-                        )
-            elif operator == ' ':
-                # for each context in current_context, ensure there
-                # exists an element somewhere above that element that
-                # matches the provided token
-                # ("descendant" selector)
-                for context in current_context:
-                    context_matches = []
-                    for el in context[1]:
-                        if checker(el.findParent(tag, find_dict)):
-                            context_matches.append(el)
-                    if context_matches:
-                        found.append(
-                            (context[0], context_matches),
-                        )
-            elif operator == '>':
-                # for each context in current_context,
-                # check if the parent satisfies the provided
-                # arguments.
-                for context in current_context:
-                    context_matches = []
-                    for el in context[1]:
-                        if checker(el.findParent(tag, find_dict)) == el.parent:
-                            context_matches.append(el.parent)
-                    if context_matches:
-                        found.append(
-                            (context[0], context_matches),
-                        )
-            elif operator == '~':
-                # for each context in current_context
-                # check 
-                raise NotImplementedError("~ operator is not implemented. Sad face :(")
-            elif operator == '+':
-                # for each context in current_context
-                # check if the preceding sibling satisfies the
-                # provided arguments
-                for context in current_context:
-                    context_matches = []
-                    for el in context[1]:
-                        if checker(el.findPreviousSibling(tag, find_dict)) == el.previousSibling:
-                            context_matches.append(el.previousSibling)
-                    if context_matches:
-                        found.append(
-                            (context[0], context_matches)
-                        )
-            current_context = found
-        else:
-            # Get the next operator (whitespace, >, ~, +)
-            handle_token = True
-            operator = None
-            match = re.search('([>~+]+)$', selector)
+        match = token_regex.search(selector)
+        if not match:
+            raise SelectorNotSupportedException(selector)
+        compound = parse_compound(match.group(1))
+        selector = selector[:match.start()].rstrip()
+
+        # Get the operator to the left of this token (whitespace, >, ~, +)
+        operator = None
+        if selector:
+            match = combinator_regex.search(selector)
             if match:
-                operator = match.groups(1)[0]
+                operator = match.group(1)
+                selector = selector[:match.start()].rstrip()
             else:
                 operator = ' '
-            selector = selector.rsplit(operator, 1)[0].rstrip()
-    return [entry[0] for entry in current_context]
+        steps.append((operator, compound))
+    if steps and steps[-1][0] is not None:
+        raise SelectorNotSupportedException(original_selector)
+    steps.reverse()
+    return tuple(steps)
+
+def get_compound_checker(compound, index):
+    """
+    Returns a function that checks an element against every part of a
+    Compound
+    """
+    checker_functions = []
+    tag, ids, classes, attributes, pseudo_classes = compound
+    if tag is not True:
+        checker_functions.append(lambda el: el.name == tag)
+    if ids:
+        checker_functions.append(lambda el: el.get('id') in ids)
+    if classes:
+        class_set = set(classes)
+        checker_functions.append(
+            lambda el: class_set.issubset(el.get('class', '').split()))
+    for operator, attribute, value in attributes:
+        checker_functions.append(get_attribute_checker(operator, attribute, value))
+    for psuedo_class, argument in pseudo_classes:
+        checker_functions.append(get_pseudo_class_checker(psuedo_class, argument, index))
+    return get_checker(checker_functions)
+
+def get_find_args(compound):
+    """
+    Returns the (name, attrs) arguments for BeautifulSoup's findAll that
+    preselect candidates for a Compound
+    """
+    find_dict = {}
+    if compound.ids:
+        find_dict['id'] = list(compound.ids)
+    if compound.classes:
+        class_set = set(compound.classes)
+        find_dict['class'] = lambda attr: attr and class_set.issubset(attr.split())
+    return compound.tag, find_dict
+
+
+# candidate elements matched between calls to the checkpoint of select_steps
+CHECKPOINT_INTERVAL = 256
+
+
+class _Matcher(object):
+    """
+    Matches elements against a parsed selector from right to left. Results
+    are memoized per (step, element), so the ancestors and preceding siblings
+    shared by many candidates are only checked once per step.
+    """
+
+    def __init__(self, steps, index):
+        self.index = index
+        self.operators = [operator for operator, compound in steps]
+        self.checkers = [get_compound_checker(compound, index)
+                         for operator, compound in steps]
+        self.memo = {}
+        self.chain_memo = {}
+        self._previous_sibling = index.previous_sibling
+
+    def match(self, el):
+        return self._match(el, len(self.checkers) - 1)
+
+    def _match(self, el, step):
+        key = (step, id(el))
+        try:
+            return self.memo[key]
+        except KeyError:
+            pass
+        result = bool(self.checkers[step](el))
+        if result and step > 0:
+            operator = self.operators[step]
+            if operator == '>':
+                parent = self._parent(el)
+                result = parent is not None and self._match(parent, step - 1)
+            elif operator == ' ':
+                result = self._match_along(el, step - 1, self._parent)
+            elif operator == '+':
+                sibling = self._previous_sibling(el)
+                result = sibling is not None and self._match(sibling, step - 1)
+            elif operator == '~':
+                result = self._match_along(el, step - 1, self._previous_sibling)
+        self.memo[key] = result
+        return result
+
+    def _match_along(self, el, step, following):
+        """
+        Returns True if any element reached from `el` by repeatedly calling
+        `following` (excluding `el` itself) matches `step`. Every element
+        visited is memoized, so walks from different starting points along
+        the same chain stop as soon as they reach a visited element.
+        """
+        visited = []
+        result = False
+        node = following(el)
+        while node is not None:
+            key = (following, step, id(node))
+            if key in self.chain_memo:
+                result = self.chain_memo[key]
+                break
+            visited.append(key)
+            if self._match(node, step):
+                result = True
+                break
+            node = following(node)
+        for key in visited:
+            self.chain_memo[key] = result
+        return result
+
+    @staticmethod
+    def _parent(el):
+        parent = el.parent
+        # the document itself is not an element
+        if parent is None or parent.parent is None:
+            return None
+        return parent
+
+
+def select(soup, selector, index=None):
+    """
+    soup should be a BeautifulSoup instance; selector is a CSS selector
+    specifying the elements you want to retrieve. index is an optional
+    SiblingIndex shared between calls on the same document.
+    """
+    return select_steps(soup, parse_selector(selector), index)
+
+def select_steps(soup, steps, index=None, checkpoint=None):
+    """
+    Like select, for a selector already split up by parse_selector.
+    `checkpoint` is called every few candidate elements and may raise to
+    stop the selection.
+    """
+    if not steps:
+        return []
+    if index is None:
+        index = SiblingIndex()
+    matcher = _Matcher(steps, index)
+    tag, find_dict = get_find_args(steps[-1][1])
+    candidates = soup.findAll(tag, find_dict)
+    if checkpoint is None:
+        return [el for el in candidates if matcher.match(el)]
+    selected = []
+    for i, el in enumerate(candidates):
+        if not i % CHECKPOINT_INTERVAL:
+            checkpoint()
+        if matcher.match(el):
+            selected.append(el)
+    return selected
 
 def monkeypatch(BeautifulSoupClass=None):
     """
-    If you don't explicitly state the class to patch, defaults to the most 
+    If you don't explicitly state the class to patch, defaults to the most
     common import location for BeautifulSoup.
     """
     if not BeautifulSoupClass:
@@ -15,4 +15,7 @@ setup(name='pynliner',
           'cssutils >=0.9.7',
           'mock'
       ],
+      extras_require={
+          'numpy': ['numpy'],
+      },
       provides=['pynliner'])
@@ -4,13 +4,66 @@
 import unittest
 import pynliner
 import StringIO
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+import os
+import sys
+import json
+import httplib
+import socket
+import subprocess
+import shutil
+import tempfile
 import logging
+import re
 import cssutils
 import mock
+from BeautifulSoup import BeautifulSoup
 from pynliner import Pynliner
-
-
-class Basic(unittest.TestCase):
+from pynliner.soupselect import select, select_steps, parse_selector, SelectorNotSupportedException
+from pynliner.bitset import BitsetMatcher
+from pynliner import fetchers
+from pynliner import cache
+from pynliner import parallel
+from pynliner import fastcss
+from pynliner import server
+
+# @style attributes, and strings holding nothing but declarations
+_style_attribute_regex = re.compile(r'style="([^"]*)"')
+_declarations_regex = re.compile(r'\s*[-\w]+\s*:[^<>{}"]*$')
+_declaration_spacing_regex = re.compile(r'\s*([:;])\s*')
+
+
+def _compact_styles(value):
+    """Drops the white space around the colons and semicolons of the
+    declarations in `value`, which cssutils versions serialize differently
+    """
+    if type(value) in (list, tuple):
+        return type(value)(_compact_styles(item) for item in value)
+    if not isinstance(value, basestring):
+        return value
+    compact = lambda declarations: _declaration_spacing_regex.sub(r'\1', declarations)
+    if _style_attribute_regex.search(value):
+        return _style_attribute_regex.sub(
+            lambda match: u'style="%s"' % compact(match.group(1)), value)
+    if _declarations_regex.match(value):
+        return compact(value)
+    return value
+
+
+class TestCase(unittest.TestCase):
+    """Compares serialized styles regardless of their spacing"""
+
+    def assertEqual(self, first, second, msg=None):
+        unittest.TestCase.assertEqual(self, _compact_styles(first),
+                                      _compact_styles(second), msg)
+
+    assertEquals = assertEqual
+
+
+class Basic(TestCase):
     def setUp(self):
         self.html = "<style>h1 { color:#ffcc00; }</style><h1>Hello World!</h1>"
         self.p = Pynliner().from_string(self.html)
@@ -137,7 +190,7 @@ class Basic(unittest.TestCase):
         self.assertEqual(output, expected)
 
 
-class ExternalStyles(unittest.TestCase):
+class ExternalStyles(TestCase):
     def setUp(self):
         self.html_template = """<link rel="stylesheet" href="{href}"></link><span class="b1">Bold</span><span class="b2 c">Bold Red</span>"""
         self.root_url = 'http://server.com'
@@ -175,7 +228,7 @@ class ExternalStyles(unittest.TestCase):
         self._test_external_url('//other.com/something/test.css', 'http://other.com/something/test.css')
 
 
-class CommaSelector(unittest.TestCase):
+class CommaSelector(TestCase):
     def setUp(self):
         self.html = """<style>.b1,.b2 { font-weight:bold; } .c {color: red}</style><span class="b1">Bold</span><span class="b2 c">Bold Red</span>"""
         self.p = Pynliner().from_string(self.html)
@@ -201,24 +254,24 @@ class CommaSelector(unittest.TestCase):
         self.p._get_soup()
         self.p._get_styles()
         self.p._apply_styles()
-        self.assertEqual(unicode(self.p.soup), u'<span class="b1" style="font-weight: bold">Bold</span><span class="b2 c" style="color: red; font-weight: bold">Bold Red</span>')
+        self.assertEqual(unicode(self.p.soup), u'<span class="b1" style="font-weight: bold">Bold</span><span class="b2 c" style="font-weight: bold; color: red">Bold Red</span>')
 
     def test_run(self):
         """Test 'run' method"""
         output = self.p.run()
-        self.assertEqual(output, u'<span class="b1" style="font-weight: bold">Bold</span><span class="b2 c" style="color: red; font-weight: bold">Bold Red</span>')
+        self.assertEqual(output, u'<span class="b1" style="font-weight: bold">Bold</span><span class="b2 c" style="font-weight: bold; color: red">Bold Red</span>')
 
     def test_with_cssString(self):
         """Test 'with_cssString' method"""
         cssString = '.b1,.b2 {font-size: 2em;}'
         self.p = Pynliner().from_string(self.html).with_cssString(cssString)
         output = self.p.run()
-        self.assertEqual(output, u'<span class="b1" style="font-weight: bold; font-size: 2em">Bold</span><span class="b2 c" style="color: red; font-weight: bold; font-size: 2em">Bold Red</span>')
+        self.assertEqual(output, u'<span class="b1" style="font-weight: bold; font-size: 2em">Bold</span><span class="b2 c" style="font-weight: bold; color: red; font-size: 2em">Bold Red</span>')
 
     def test_fromString_complete(self):
         """Test 'fromString' complete"""
         output = pynliner.fromString(self.html)
-        desired = u'<span class="b1" style="font-weight: bold">Bold</span><span class="b2 c" style="color: red; font-weight: bold">Bold Red</span>'
+        desired = u'<span class="b1" style="font-weight: bold">Bold</span><span class="b2 c" style="font-weight: bold; color: red">Bold Red</span>'
         self.assertEqual(output, desired)
 
     def test_comma_whitespace(self):
@@ -229,7 +282,7 @@ class CommaSelector(unittest.TestCase):
         self.assertEqual(output, desired_output)
 
 
-class Extended(unittest.TestCase):
+class Extended(TestCase):
     def test_overwrite(self):
         """Test overwrite inline styles"""
         html = '<style>h1 {color: #000;}</style><h1 style="color: #fff">Foo</h1>'
@@ -244,8 +297,40 @@ class Extended(unittest.TestCase):
         output = Pynliner().from_string(html).run()
         self.assertEqual(output, desired_output)
 
+    def test_shared_style_strings(self):
+        """Test identical declarations share one serialized style string"""
+        html = '<style>p {color: red} .a {margin: 0}</style><p>1</p><p>2</p><p class="a">3</p>'
+        p = Pynliner().from_string(html)
+        p._get_soup()
+        p._get_styles()
+        p._apply_styles()
+        first, second, third = p.soup.findAll('p')
+        self.assertIs(first['style'], second['style'])
+        self.assertEqual(third['style'], u'color: red;margin: 0')
+
+    def test_equal_specificity_source_order(self):
+        """Test later rules win over earlier rules of equal specificity"""
+        html = '<style>p {color: red; margin: 0} p {color: blue}</style><p>1</p><p>2</p>'
+        p = Pynliner().from_string(html)
+        p._get_soup()
+        p._get_styles()
+        p._apply_styles()
+        for elem in p.soup.findAll('p'):
+            self.assertEqual(elem['style'], u'color: blue;margin: 0')
+
+    def test_matched_selector_specificity(self):
+        """Test only the selector that matched counts towards specificity"""
+        html = '<style>#a, p {color: red} .x {color: blue}</style><p class="x">1</p><p id="a" class="x">2</p>'
+        p = Pynliner().from_string(html)
+        p._get_soup()
+        p._get_styles()
+        p._apply_styles()
+        first, second = p.soup.findAll('p')
+        self.assertEqual(first['style'], u'color: blue')
+        self.assertEqual(second['style'], u'color: red')
 
-class LogOptions(unittest.TestCase):
+
+class LogOptions(TestCase):
     def setUp(self):
         self.html = "<style>h1 { color:#ffcc00; }</style><h1>Hello World!</h1>"
 
@@ -272,7 +357,7 @@ class LogOptions(unittest.TestCase):
         self.assertIn("DEBUG", log_contents)
 
 
-class BeautifulSoupBugs(unittest.TestCase):
+class BeautifulSoupBugs(TestCase):
     def test_double_doctype(self):
         self.html = """<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN"
 "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">"""
@@ -285,7 +370,7 @@ class BeautifulSoupBugs(unittest.TestCase):
         self.assertNotIn("<!--<!--", output)
 
 
-class ComplexSelectors(unittest.TestCase):
+class ComplexSelectors(TestCase):
     def test_multiple_class_selector(self):
         html = """<h1 class="a b">Hello World!</h1>"""
         css = """h1.a.b { color: red; }"""
@@ -347,9 +432,19 @@ class ComplexSelectors(unittest.TestCase):
         html = """<h1><span>Hello World!</span><p>foo</p><div class="barclass"><span>baz</span>bar</div></h1>"""
         css = """h1 > span:css4-selector { color: red; }"""
         expected = u"""<h1><span>Hello World!</span><p>foo</p><div class="barclass"><span>baz</span>bar</div></h1>"""
-        output = Pynliner().from_string(html).with_cssString(css).run()
+        self.assertRaises(SelectorNotSupportedException,
+                          Pynliner().from_string(html).with_cssString(css).run)
+        output = Pynliner(ingore_unsupported_selectors=True).from_string(html).with_cssString(css).run()
         self.assertEqual(output, expected)
 
+    def test_not_pseudo_selector(self):
+        html = """<p><a>x</a></p>"""
+        css = """p:not(.x) { color: red; }"""
+        self.assertRaises(SelectorNotSupportedException,
+                          Pynliner().from_string(html).with_cssString(css).run)
+        output = Pynliner(ingore_unsupported_selectors=True).from_string(html).with_cssString(css).run()
+        self.assertEqual(output, u"""<p><a>x</a></p>""")
+
     def test_child_follow_by_adjacent_selector_complex_dom(self):
         html = """<h1><span>Hello World!</span><p>foo</p><div class="barclass"><span>baz</span>bar</div></h1>"""
         css = """h1 > span + p { color: red; }"""
@@ -501,7 +596,7 @@ class ComplexSelectors(unittest.TestCase):
         self.assertEqual(output, expected)
 
 
-class MediaQueries(unittest.TestCase):
+class MediaQueries(TestCase):
 
     def test_media_queries_left_alone(self):
         html = """<html><head><title>Example</title>
@@ -513,11 +608,7 @@ class MediaQueries(unittest.TestCase):
 
         self.assertEqual(output, """<html><head><title>Example</title>
 <style type="text/css">
-@media screen and (min-device-width: 480) {
-    #content {
-        width: 480px
-        }
-    }
+@media screen and (min-device-width: 480) { #content { width: 480px; } }
 </style></head><body><div id="content" style="border: 1px solid black"><h1>Hello world</h1></div></body></html>""")
 
     def test_media_queries_stripped(self):
@@ -544,14 +635,1186 @@ class MediaQueries(unittest.TestCase):
 
         self.assertEqual(output, """<html><head><title>Example</title>
 <style type="text/css">
-@media screen and (min-device-width: 480) {
-    #content {
-        width: 480px
-        }
-    }
+@media screen and (min-device-width: 480) { #content { width: 480px; } }
 </style>
 </head><body><div id="content" style="border: 1px solid black; color: blue"><h1>Hello world</h1></div></body></html>""")
 
+    def test_preserved_rules_written_from_source(self):
+        html = """<html><head><style type="text/css">
+/* layout */ @media print { .x { color: red; } p { color: red; } }
+p { color: blue } @media screen { p { color: red; } }
+</style></head><body><p>Hello</p></body></html>"""
+        output = (Pynliner(preserve_media_queries=True, prune_media_queries=True)
+                  .from_string(html).with_cssString('p { margin: 0 }').run())
+        self.assertEqual(output, u"""<html><head><style type="text/css">
+@media print {
+    p {
+        color: red
+        }
+    }
+@media screen { p { color: red; } }
+</style></head><body><p style="color:blue;margin:0">Hello</p></body></html>""")
+
+    def test_prune_media_queries(self):
+        html = """<html><head><style type="text/css">
+@media screen and (max-width: 600px) { #content { width: 100%; } .unused, p.x { color: red; } a:hover span { color: blue; } }
+@media print { .sidebar { display: none; } }
+p { margin: 0 }
+</style></head><body><div id="content"><p>Hello</p><a><span>world</span></a></div></body></html>"""
+        output = Pynliner(preserve_media_queries=True, prune_media_queries=True).from_string(html).run()
+        self.assertIn(u'#content {', output)
+        self.assertIn(u'a:hover span {', output)
+        self.assertNotIn(u'.unused', output)
+        self.assertNotIn(u'@media print', output)
+        self.assertIn(u'<p style="margin:0">Hello</p>', output)
+
+    def test_prune_keeps_unevaluated_pseudo_classes(self):
+        html = """<html><head><style type="text/css">
+@media screen and (max-width:600px) { td:only-child { color: red } p:not(.x) { margin: 0 } div:empty { color: blue } }
+</style></head><body><table><tr><td>1</td></tr></table><p>Hello</p></body></html>"""
+        output = Pynliner(preserve_media_queries=True, prune_media_queries=True).from_string(html).run()
+        self.assertIn(u'td:only-child', output)
+        self.assertIn(u'p:not(.x)', output)
+        self.assertNotIn(u'div:empty', output)
+
+    def test_prune_drops_empty_style_element(self):
+        html = """<html><head><style type="text/css">
+@media print { .sidebar { display: none; } }
+</style></head><body><p>Hello</p></body></html>"""
+        output = Pynliner(preserve_media_queries=True, prune_media_queries=True).from_string(html).run()
+        self.assertEqual(output, u'<html><head></head><body><p>Hello</p></body></html>')
+
+
+class _StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves a page with linked stylesheets for the background run tests"""
+    pages = {
+        '/page.html': '<link rel="stylesheet" href="a.css"><link rel="stylesheet" href="b.css">'
+                      '<h1>Hello</h1><p>World</p>',
+        '/slow.html': '<link rel="stylesheet" href="slow.css"><h1>Hello</h1>',
+        '/a.css': 'h1 {color: red}',
+        '/b.css': 'p {color: blue}',
+        '/slow.css': 'h1 {color: red}',
+    }
+
+    def do_GET(self):
+        if self.path == '/slow.css':
+            time.sleep(0.5)
+        body = self.pages[self.path]
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class AsyncRun(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), _StandInHandler)
+        cls.base_url = 'http://127.0.0.1:%d/' % cls.server.server_address[1]
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_fromURLAsync(self):
+        result = pynliner.fromURLAsync(self.base_url + 'page.html')
+        self.assertEqual(result.result(timeout=5),
+                         u'<h1 style="color:red">Hello</h1><p style="color:blue">World</p>')
+        self.assertTrue(result.done())
+
+    def test_fromStringAsync_with_executor(self):
+        class Executor(object):
+            submitted = []
+            def submit(self, fn):
+                self.submitted.append(fn)
+                fn()
+        html = '<style>h1 {color: red}</style><h1>Hello</h1>'
+        result = pynliner.fromStringAsync(html, executor=Executor())
+        self.assertEqual(len(Executor.submitted), 1)
+        self.assertEqual(result.result(), u'<h1 style="color:red">Hello</h1>')
+
+    def test_timeout_leaves_run_going(self):
+        result = pynliner.fromURLAsync(self.base_url + 'slow.html')
+        self.assertRaises(pynliner.InliningTimeout, result.result, 0.05)
+        self.assertFalse(result.cancelled())
+        self.assertEqual(result.result(timeout=5), u'<h1 style="color:red">Hello</h1>')
+
+    def test_cancel(self):
+        result = pynliner.fromURLAsync(self.base_url + 'slow.html')
+        self.assertTrue(result.cancel())
+        result._done.wait(5)
+        self.assertRaises(pynliner.InliningCancelled, result.result)
+
+    def test_reuse_after_cancel(self):
+        p = Pynliner()
+        result = p.from_url(self.base_url + 'slow.html').run_async()
+        time.sleep(0.05)
+        result.cancel()
+        result._done.wait(5)
+        self.assertEqual(p.from_string('<style>h1 {color: red}</style><h1>Hi</h1>').run(),
+                         u'<h1 style="color:red">Hi</h1>')
+
+    def test_linked_stylesheets_fetched_by_few_threads(self):
+        class Fetcher(fetchers.Fetcher):
+            def __init__(self):
+                self.lock = threading.Lock()
+                self.running = self.most = self.fetched = 0
+
+            def fetch(self, url):
+                with self.lock:
+                    self.running += 1
+                    self.most = max(self.most, self.running)
+                time.sleep(0.1)
+                with self.lock:
+                    self.running -= 1
+                    self.fetched += 1
+                return 'h1 {color: red}'
+        html = '<link rel="stylesheet" href="http://example.com/a.css">' * 12 + '<h1>Hi</h1>'
+        fetcher = Fetcher()
+        Pynliner(fetcher=fetcher).from_string(html).run()
+        self.assertEqual(fetcher.fetched, 12)
+        self.assertTrue(fetcher.most <= pynliner._FETCH_THREADS)
+
+        fetcher = Fetcher()
+        result = Pynliner(fetcher=fetcher).from_string(html).run_async()
+        time.sleep(0.05)
+        result.cancel()
+        result._done.wait(5)
+        self.assertRaises(pynliner.InliningCancelled, result.result)
+        self.assertTrue(fetcher.fetched <= pynliner._FETCH_THREADS)
+
+    def test_done_callback(self):
+        finished = []
+        called = threading.Event()
+        def callback(result):
+            finished.append(result)
+            called.set()
+        result = Pynliner().from_string('<h1>Hello</h1>').run_async()
+        result.add_done_callback(callback)
+        self.assertEqual(result.result(timeout=5), u'<h1>Hello</h1>')
+        called.wait(5)
+        self.assertEqual(finished, [result])
+
+
+class _KeepAliveHandler(_StandInHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = []
+
+    def setup(self):
+        _StandInHandler.setup(self)
+        self.connections.append(self.client_address)
+
+
+class _ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class Fetchers(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmpdir, 'css'))
+        with open(os.path.join(self.tmpdir, 'css', 'site.css'), 'w') as f:
+            f.write('p {color: blue}')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_resolver_directory_and_dict(self):
+        fetcher = fetchers.ResolverFetcher({
+            'http://cdn.example.com/': self.tmpdir,
+            'http://example.com/': {'page.html': '<link rel="stylesheet" href="http://cdn.example.com/css/site.css"><p>Hi</p>'},
+        })
+        output = Pynliner(fetcher=fetcher).from_url('http://example.com/page.html').run()
+        self.assertEqual(output, u'<p style="color:blue">Hi</p>')
+        self.assertRaises(fetchers.FetchError, fetcher.fetch, 'http://other.com/x.css')
+        self.assertRaises(fetchers.FetchError, fetcher.fetch, 'http://cdn.example.com/../etc/passwd')
+
+    def test_resolver_fallback(self):
+        fallback = mock.Mock()
+        fallback.fetch.return_value = 'h1 {color: red}'
+        fetcher = fetchers.ResolverFetcher({'http://example.com/': {}}, fallback=fallback)
+        self.assertEqual(fetcher.fetch('http://other.com/a.css'), 'h1 {color: red}')
+        fallback.fetch.assert_called_once_with('http://other.com/a.css')
+
+    def test_read_limited(self):
+        self.assertEqual(fetchers.read_limited(StringIO.StringIO('abc'), 3), 'abc')
+        self.assertRaises(fetchers.FetchTimeout, fetchers.read_limited,
+                          StringIO.StringIO('abc'), deadline=time.time() - 1)
+        self.assertRaises(fetchers.ResponseTooLarge, fetchers.read_limited,
+                          StringIO.StringIO('abcd'), 3)
+        fetcher = fetchers.ResolverFetcher({'http://cdn.example.com/': self.tmpdir}, max_bytes=4)
+        self.assertRaises(fetchers.ResponseTooLarge, fetcher.fetch,
+                          'http://cdn.example.com/css/site.css')
+
+    def test_pooled_fetcher_reuses_connections(self):
+        server = _ThreadingServer(('127.0.0.1', 0), _KeepAliveHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        del _KeepAliveHandler.connections[:]
+        base_url = 'http://127.0.0.1:%d/' % server.server_address[1]
+        fetcher = fetchers.PooledHTTPFetcher(timeout=5, max_bytes=1024)
+        try:
+            output = Pynliner(fetcher=fetcher).from_url(base_url + 'page.html').run()
+            self.assertEqual(output, u'<h1 style="color:red">Hello</h1><p style="color:blue">World</p>')
+            self.assertEqual(fetcher.fetch(base_url + 'a.css'), 'h1 {color: red}')
+            self.assertTrue(len(_KeepAliveHandler.connections) <= 2)
+        finally:
+            fetcher.close()
+            server.shutdown()
+            server.server_close()
+
+    def test_pooled_fetcher_closes_failed_retry(self):
+        fetcher = fetchers.PooledHTTPFetcher()
+        stale, fresh = mock.Mock(sock=None), mock.Mock(sock=None)
+        fetcher._idle[('http', 'example.com', None)] = [stale]
+        with mock.patch.object(fetcher, '_connect', return_value=fresh), \
+                mock.patch.object(fetcher, '_send', side_effect=IOError('reset')):
+            self.assertRaises(IOError, fetcher.fetch, 'http://example.com/a.css')
+        self.assertTrue(stale.close.called)
+        self.assertTrue(fresh.close.called)
+
+
+class ResultCache(TestCase):
+    html = '<style>h1 {color: red}</style><h1>Hello</h1>'
+    expected = u'<h1 style="color:red">Hello</h1>'
+
+    def test_memory_cache_hit_skips_parsing(self):
+        result_cache = cache.MemoryCache()
+        self.assertEqual(Pynliner(cache=result_cache).from_string(self.html).run(), self.expected)
+        with mock.patch.object(Pynliner, '_get_soup') as get_soup:
+            output = Pynliner(cache=result_cache).from_string(self.html).run()
+        self.assertEqual(output, self.expected)
+        self.assertFalse(get_soup.called)
+        self.assertEqual(result_cache.stats.hits, 1)
+        self.assertEqual(result_cache.stats.misses, 1)
+        self.assertEqual(result_cache.stats.hit_rate, 0.5)
+
+    def test_key_includes_css_and_options(self):
+        result_cache = cache.MemoryCache()
+        Pynliner(cache=result_cache).from_string(self.html).run()
+        output = Pynliner(cache=result_cache).from_string(self.html).with_cssString('h1 {color: blue}').run()
+        self.assertEqual(output, u'<h1 style="color:blue">Hello</h1>')
+        Pynliner(cache=result_cache, preserve_media_queries=True).from_string(self.html).run()
+        self.assertEqual(result_cache.stats.hits, 0)
+        self.assertEqual(result_cache.stats.misses, 3)
+
+    def test_key_includes_linked_stylesheets(self):
+        html = '<link rel="stylesheet" href="http://example.com/site.css"><h1>Hello</h1>'
+        result_cache = cache.MemoryCache()
+        fetcher = _StaticFetcher('h1 {color: red}')
+        inline = lambda: Pynliner(cache=result_cache, fetcher=fetcher).from_string(html).run()
+        self.assertEqual(inline(), self.expected)
+        self.assertEqual(inline(), self.expected)
+        self.assertEqual(result_cache.stats.hits, 1)
+        fetcher.content = 'h1 {color: blue}'
+        self.assertEqual(inline(), u'<h1 style="color:blue">Hello</h1>')
+        self.assertEqual(result_cache.stats.hits, 1)
+        self.assertEqual(result_cache.stats.misses, 2)
+
+    def test_memory_cache_evicts_by_bytes(self):
+        result_cache = cache.MemoryCache(max_bytes=10)
+        result_cache.set('a', u'12345')
+        result_cache.set('b', u'12345')
+        result_cache.get('a')
+        result_cache.set('c', u'12345')
+        self.assertEqual(result_cache.get('b'), None)
+        self.assertEqual(result_cache.get('a'), u'12345')
+        self.assertEqual(result_cache.size, 10)
+        self.assertEqual(result_cache.stats.evictions, 1)
+
+    def test_disk_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            Pynliner(cache=cache.DiskCache(directory)).from_string(self.html).run()
+            result_cache = cache.DiskCache(directory, max_bytes=100)
+            self.assertEqual(Pynliner(cache=result_cache).from_string(self.html).run(), self.expected)
+            self.assertEqual(result_cache.stats.hits, 1)
+            result_cache.set('big', u'x' * 90)
+            self.assertEqual(len(os.listdir(directory)), 1)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_disk_cache_lists_directory_when_full(self):
+        directory = tempfile.mkdtemp()
+        try:
+            result_cache = cache.DiskCache(directory, max_bytes=100)
+            result_cache.set('a', u'x' * 10)
+            with mock.patch('os.listdir', side_effect=os.listdir) as listdir:
+                for key in 'bcdefghi':
+                    result_cache.set(key, u'x' * 10)
+                self.assertFalse(listdir.called)
+                result_cache.set('j', u'x' * 30)
+                self.assertEqual(listdir.call_count, 1)
+            self.assertTrue(result_cache.stats.evictions)
+            result_cache.clear()
+            result_cache.set('k', u'y')
+            with mock.patch('os.utime', side_effect=OSError('read-only')):
+                self.assertEqual(result_cache.get('k'), u'y')
+        finally:
+            shutil.rmtree(directory)
+
+
+class CompiledStylesheets(TestCase):
+    css = """@media screen { .a { color: green } }
+h1 > span, .a:first-child { color: red; margin: 0 }
+p { color: blue }"""
+    html = '<h1><span class="a">Hello</span></h1><p>World</p>'
+    expected = u'<h1><span class="a" style="color:red;margin:0">Hello</span></h1><p style="color:blue">World</p>'
+
+    def test_with_compiled(self):
+        compiled = pynliner.compile_css(self.css)
+        self.assertEqual(len(compiled.rules), 2)
+        self.assertEqual(compiled.rules[0].selectors[0][:2], (u'h1 > span', (0, 0, 0, 2)))
+        output = Pynliner().from_string(self.html).with_compiled(compiled).run()
+        self.assertEqual(output, self.expected)
+
+    def test_save_and_load(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'site.pynliner')
+            compiled = pynliner.compile_css(self.css)
+            compiled.save(path)
+            loaded = pynliner.CompiledStylesheet.load(path)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(loaded.fingerprint, compiled.fingerprint)
+        self.assertEqual(loaded.preserved, compiled.preserved)
+        output = Pynliner().from_string(self.html).with_compiled(loaded).run()
+        self.assertEqual(output, self.expected)
+
+    def test_load_rejects_other_versions(self):
+        data = pynliner.compile_css(self.css).dumps()
+        other = data.replace('pynliner %s ' % pynliner.__version__, 'pynliner 0.0.1 ', 1)
+        self.assertRaises(pynliner.CompiledStylesheetVersionError,
+                          pynliner.CompiledStylesheet.loads, other)
+        self.assertRaises(pynliner.CompiledStylesheetVersionError,
+                          pynliner.CompiledStylesheet.loads, 'garbage')
+
+    def test_split_selector_list(self):
+        from pynliner.compiled import _split_selector_list
+        self.assertEqual(_split_selector_list(u'a[title="x, y"], b:nth-child(2n, 1) , i[x=\'\\\',\']'),
+                         [u'a[title="x, y"]', u' b:nth-child(2n, 1) ', u' i[x=\'\\\',\']'])
+        self.assertEqual(_split_selector_list(u'.a' + u', .a' * 20000), [u'.a'] + [u' .a'] * 20000)
+
+    def test_preserved_rules(self):
+        compiled = pynliner.compile_css(self.css)
+        html = '<html><head></head><body><p>World</p></body></html>'
+        output = Pynliner(preserve_media_queries=True).from_string(html).with_compiled(compiled).run()
+        self.assertIn(u'<style type="text/css">\n@media screen {', output)
+        output = Pynliner().from_string(html).with_compiled(compiled).run()
+        self.assertNotIn(u'@media', output)
+
+
+class Fragments(TestCase):
+    css = """table.order td { padding: 4px }
+.lines > tr > td { color: red }
+tr td:first-child { font-weight: bold }
+#main p { margin: 0 }"""
+
+    def test_descendant_and_child_selectors_see_ancestors(self):
+        compiled = pynliner.compile_css(self.css)
+        output = compiled.inline_fragment(
+            u'<td>Mug</td><td>9.99</td>',
+            ['div#main', 'table.order', ('tbody', {'class': 'lines'}), 'tr'])
+        self.assertEqual(output, u'<td style="font-weight:bold;padding:4px;color:red">Mug</td>'
+                                 u'<td style="padding:4px;color:red">9.99</td>')
+
+    def test_only_fragment_is_styled(self):
+        compiled = pynliner.compile_css(self.css)
+        output = compiled.inline_fragment(u'<p>Hi</p>', ['div#main', 'p.intro'])
+        self.assertEqual(output, u'<p style="margin:0">Hi</p>')
+
+    def test_ancestor_attributes(self):
+        output = Pynliner().from_fragment(u'<b>x</b>', ['div[data-role=price]']).with_cssString(
+            u'[data-role=price] b { color: red }').run()
+        self.assertEqual(output, u'<b style="color:red">x</b>')
+
+    def test_without_ancestors(self):
+        compiled = pynliner.compile_css(self.css)
+        self.assertEqual(compiled.inline_fragment(u'<td>x</td>'), u'<td>x</td>')
+
+    def test_ancestor_needs_tag_name(self):
+        compiled = pynliner.compile_css(self.css)
+        self.assertRaises(ValueError, compiled.inline_fragment, u'<td>x</td>', ['.order'])
+
+
+# Imports pynliner with every import timed, like `python -X importtime`, and
+# prints {"module": [self ms, cumulative ms]} as JSON
+_IMPORT_TIME_SCRIPT = """
+import sys, time, json, __builtin__
+original_import = __builtin__.__import__
+times = {}
+stack = []
+def timed_import(name, *args, **kwargs):
+    before = name in sys.modules
+    start = time.time()
+    stack.append(0.0)
+    try:
+        return original_import(name, *args, **kwargs)
+    finally:
+        elapsed = time.time() - start
+        nested = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        if not before and name in sys.modules:
+            times[name] = [(elapsed - nested) * 1000, elapsed * 1000]
+__builtin__.__import__ = timed_import
+import pynliner
+times['loaded'] = sorted(sys.modules)
+print json.dumps(times)
+"""
+
+
+class ImportTime(TestCase):
+    heavy_modules = ('cssutils', 'BeautifulSoup', 'urllib2', 'httplib', 'urlparse')
+    # generous, but an eager import of cssutils alone costs several times this
+    budget_ms = 150
+
+    def _import_times(self):
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, '-c', _IMPORT_TIME_SCRIPT], env=env)
+        return json.loads(output)
+
+    def test_heavy_dependencies_are_lazy(self):
+        loaded = self._import_times()['loaded']
+        for name in self.heavy_modules:
+            self.assertNotIn(name, loaded)
+
+    def test_lazy_attributes_can_be_patched(self):
+        from pynliner._lazy import LazyModule
+        urllib2 = LazyModule('urllib2')
+        original = urllib2.urlopen
+        with mock.patch('urllib2.urlopen') as urlopen:
+            self.assertIs(urllib2.urlopen, urlopen)
+        self.assertIs(urllib2.urlopen, original)
+
+    # wall-clock timings depend on the machine, so they are only checked
+    # when asked for
+    @unittest.skipUnless(os.environ.get('PYNLINER_TIMING_TESTS'),
+                         'set PYNLINER_TIMING_TESTS=1 to check the import time')
+    def test_import_time(self):
+        times = self._import_times()
+        total = times['pynliner'][1]
+        slowest = sorted((v[1], k) for k, v in times.items() if k != 'loaded')[-5:]
+        self.assertTrue(total < self.budget_ms,
+                        'import pynliner took %.1fms (slowest: %s)' % (total, slowest))
+
+    def test_first_use_loads_dependencies(self):
+        self.assertEqual(Pynliner().from_string('<p>x</p>').with_cssString('p {color: red}').run(),
+                         u'<p style="color:red">x</p>')
+
+
+class IncrementalSession(TestCase):
+    html = (u'<html><head><style>p {color: red} .a {font-weight: bold}</style></head>'
+            u'<body><p class="a" style="margin: 0">one</p><p>two</p><span>three</span></body></html>')
+
+    def assertMatchesFullRun(self, session, css_rules):
+        expected = Pynliner().from_string(self.html.replace(
+            u'p {color: red} .a {font-weight: bold}', u' '.join(css_rules))).run()
+        self.assertEqual(session.output(), expected)
+
+    def test_initial_output_matches_run(self):
+        session = Pynliner().from_string(self.html).session()
+        self.assertEqual(session.output(), Pynliner().from_string(self.html).run())
+
+    def test_insert_rule(self):
+        session = Pynliner().from_string(self.html).session()
+        self.assertEqual(session.insert_rule(u'span, .a {color: blue}'), 2)
+        self.assertMatchesFullRun(session, [u'p {color: red}', u'.a {font-weight: bold}',
+                                            u'span, .a {color: blue}'])
+        session.insert_rule(u'p {text-align: left}', 0)
+        self.assertMatchesFullRun(session, [u'p {text-align: left}', u'p {color: red}',
+                                            u'.a {font-weight: bold}', u'span, .a {color: blue}'])
+
+    def test_delete_rule_restores_original_style(self):
+        session = Pynliner().from_string(self.html).session()
+        session.delete_rule(0)
+        session.delete_rule(0)
+        self.assertEqual(session.rules, [])
+        self.assertTrue(u'<p class="a" style="margin: 0">one</p><p>two</p>' in session.output())
+
+    def test_replace_rule(self):
+        session = Pynliner().from_string(self.html).session()
+        session.replace_rule(0, u'span {color: green}')
+        self.assertMatchesFullRun(session, [u'span {color: green}', u'.a {font-weight: bold}'])
+
+    def test_only_affected_elements_are_restyled(self):
+        session = Pynliner().from_string(self.html).session()
+        restyled = []
+        restyle_element = session._restyle_element
+        session._restyle_element = lambda elem, positions: (
+            restyled.append(elem.name), restyle_element(elem, positions))
+        session.replace_rule(1, u'span {font-weight: bold}')
+        self.assertEqual(sorted(restyled), [u'p', u'span'])
+
+    def test_style_attribute_selectors_see_original_styles(self):
+        session = Pynliner().from_string(self.html).session()
+        session.insert_rule(u'p[style] {color: blue}')
+        self.assertMatchesFullRun(session, [u'p {color: red}', u'.a {font-weight: bold}',
+                                            u'p[style] {color: blue}'])
+
+    def test_output_options(self):
+        html = (u'<html><body>\n<div>\n  <p style="color: blue">Hi</p>\n</div>\n</body></html>')
+        css = u'p { color: red; margin-top: 0; margin-bottom: 0; margin-left: 0 }'
+        options = dict(optimize_output=True, fold_shorthands=True)
+        session = Pynliner(**options).from_string(html).with_cssString(css).session()
+        session.insert_rule(u'p { margin-right: 0 }')
+        full = Pynliner(**options).from_string(html).with_cssString(
+            css + u' p { margin-right: 0 }')
+        self.assertEqual(session.output(), full.run())
+        self.assertEqual(session.output(), full.output)
+        self.assertEqual(session.inliner.bytes_saved, full.bytes_saved)
+
+    def test_rule_must_be_single_style_rule(self):
+        session = Pynliner().from_string(self.html).session()
+        self.assertRaises(ValueError, session.insert_rule, u'p {color: red} b {color: red}')
+
+
+class MultiProcess(TestCase):
+    css = u"""li + li { margin: 0 } li ~ .b em { color: red } li:first-child { a: 1 }
+li:last-child { b: 2 } li:nth-last-child(3n+1) { c: 3 } html body ul > li.b { d: 4 }
+head + body li { e: 5 } div ~ ul li { f: 6 } ul { g: 7 } em:first-of-type { h: 8 }"""
+
+    def assertSameAsSingleProcess(self, html):
+        expected = Pynliner().from_string(html).with_cssString(self.css).run()
+        p = Pynliner(processes=2).with_cssString(self.css)
+        try:
+            with mock.patch.object(parallel, 'MIN_ELEMENTS', 0):
+                output = p.from_string(html).run()
+            self.assertIsNot(p._pool, None)
+        finally:
+            p.close()
+        self.assertEqual(output, expected)
+        return output
+
+    def test_pool_kept_between_runs(self):
+        html = u'<ul>%s</ul>' % (u'<li class="b"><em>x</em></li>' * 10)
+        expected = Pynliner().from_string(html).with_cssString(self.css).run()
+        p = Pynliner(processes=2).with_cssString(self.css)
+        try:
+            with mock.patch.object(parallel, 'MIN_ELEMENTS', 0):
+                self.assertEqual(p.from_string(html).run(), expected)
+                pool = p._pool
+                self.assertEqual(p.from_string(html).run(), expected)
+                self.assertIs(p._pool, pool)
+        finally:
+            p.close()
+        self.assertIs(p._pool, None)
+
+    def test_small_documents_stay_in_process(self):
+        p = Pynliner(processes=2).with_cssString(self.css)
+        p.from_string(u'<ul><li>1</li></ul>').run()
+        self.assertIs(p._pool, None)
+
+    def test_partitions_see_siblings_and_ancestors(self):
+        items = u''.join(u'<li class="%s">%d <em>x</em><em>y</em></li> text ' % ('ab'[i % 2], i)
+                         for i in range(20))
+        html = u'<html><head></head><body><div><ul><li>0</li></ul></div><ul>%s</ul></body></html>' % items
+        output = self.assertSameAsSingleProcess(html)
+        self.assertIn(u'style="a:1;e:5;f:6"', output)
+
+    def test_partitions_below_wrapper(self):
+        rows = u''.join(u'<li class="b"><em>%d</em></li>' % i for i in range(30))
+        html = u'<html><head></head><body><ul><li>first</li>%s<li>last</li></ul></body></html>' % rows
+        self.assertSameAsSingleProcess(html)
+
+    def test_document_without_body(self):
+        self.assertSameAsSingleProcess(u'<li>1</li><li class="b"><em>2</em></li><ul></ul>')
+
+    def test_partitions(self):
+        soup = BeautifulSoup(u'<ul>%s</ul>' % (u'<li>x</li>' * 10))
+        ranges = parallel.partitions(soup.ul, 4)
+        self.assertEqual(len(ranges), 4)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], 10)
+
+
+class OptimizeOutput(TestCase):
+
+    def _run(self, html, **options):
+        p = Pynliner(optimize_output=True, **options).from_string(html)
+        return p.run(), p.bytes_saved
+
+    def test_merges_inline_style(self):
+        html = u'<style>p {color: red; margin: 0}</style><p style="color: blue">x</p>'
+        output, saved = self._run(html)
+        self.assertEqual(output, u'<p style="margin:0;color:blue">x</p>')
+        self.assertEqual(saved, len(u'color:red;;'))
+
+    def test_drops_overridden_declarations(self):
+        html = u'<style>p {margin-top: 1px; border-left-color: red} .a {margin: 0; border: 0}</style><p class="a">x</p>'
+        output, _ = self._run(html)
+        self.assertEqual(output, u'<p class="a" style="margin:0;border:0">x</p>')
+
+    def test_unsafe_inline_style_is_appended(self):
+        html = u'<style>p {color: red}</style><p style="color: blue !important">x</p>'
+        output, _ = self._run(html)
+        self.assertEqual(output, u'<p style="color:red;color: blue !important">x</p>')
+
+    def test_collapses_white_space_between_blocks(self):
+        html = u'<div>\n  <p>a</p>\n  <p>b <b>c</b> <i>d</i></p>\n</div>\n<pre>\n <p>e</p>\n</pre>'
+        output, saved = self._run(html)
+        self.assertEqual(output, u'<div><p>a</p><p>b <b>c</b> <i>d</i></p></div><pre>\n <p>e</p>\n</pre>')
+        self.assertEqual(saved, 4)
+
+    def test_off_by_default(self):
+        html = u'<style>p {color: red}</style><div>\n<p style="color: blue">x</p>\n</div>'
+        p = Pynliner().from_string(html)
+        self.assertEqual(p.run(), u'<div>\n<p style="color:red;color: blue">x</p>\n</div>')
+        self.assertEqual(p.bytes_saved, 0)
+
+
+class FoldShorthands(TestCase):
+
+    def _run(self, css, html=u'<td>x</td>'):
+        return Pynliner(fold_shorthands=True).from_string(
+            u'<style>%s</style>%s' % (css, html)).run()
+
+    def test_box_sides(self):
+        self.assertEqual(self._run(u'td {margin-top: 0; margin-right: 1px; margin-bottom: 0; margin-left: 1px}'),
+                         u'<td style="margin:0 1px">x</td>')
+        self.assertEqual(self._run(u'td {padding: 4px} td {padding-left: 2px; padding-top: 1px;'
+                                   u' padding-right: 2px; padding-bottom: 3px}'),
+                         u'<td style="padding:1px 2px 3px">x</td>')
+
+    def test_border_drops_initial_values(self):
+        css = u'td {border-top-width: medium; border-top-style: solid; border-top-color: red}'
+        self.assertEqual(self._run(css), u'<td style="border-top:solid red">x</td>')
+
+    def test_border_sides_fold_into_border(self):
+        css = u' '.join(u'td {border-%s-width: 1px; border-%s-style: solid; border-%s-color: #000}'
+                        % (side, side, side) for side in (u'top', u'right', u'bottom', u'left'))
+        self.assertEqual(self._run(css), u'<td style="border:1px solid #000">x</td>')
+
+    def test_font(self):
+        css = (u'td {font-style: normal; font-variant: normal; font-weight: bold; font-size: 12px;'
+               u' line-height: 1.5; font-family: Arial, sans-serif}')
+        self.assertEqual(self._run(css), u'<td style="font:bold 12px/1.5 Arial, sans-serif">x</td>')
+        self.assertNotIn(u'font:', self._run(css + u' p {font-stretch: condensed}'))
+
+    def test_font_with_inline_font_properties(self):
+        css = (u'td {font-style: normal; font-variant: normal; font-weight: bold; font-size: 12px;'
+               u' line-height: 1.5; font-family: Arial, sans-serif}')
+        html = u'<table style="line-height: 2"><tr><td>x</td></tr></table>'
+        self.assertNotIn(u'font:', self._run(css, html))
+        html = u'<table style="font-stretch: condensed"><tr><td>x</td></tr></table>'
+        self.assertNotIn(u'font:', self._run(css, html))
+        html = u'<table style="color: red"><tr><td>x</td></tr></table>'
+        self.assertIn(u'font:', self._run(css, html))
+
+    def test_incomplete_or_interleaved_sets_are_kept(self):
+        self.assertEqual(self._run(u'td {margin-top: 0; margin-left: 0}'),
+                         u'<td style="margin-top:0;margin-left:0">x</td>')
+        css = u'td {margin-top: 0} td {margin: 2px} td {margin-right: 0; margin-bottom: 0; margin-left: 0}'
+        self.assertEqual(self._run(css),
+                         u'<td style="margin-top:0;margin:2px;margin-right:0;margin-bottom:0;margin-left:0">x</td>')
+        self.assertEqual(self._run(u'td {margin-top: inherit; margin-right: 0; margin-bottom: 0; margin-left: 0}'),
+                         u'<td style="margin-top:inherit;margin-right:0;margin-bottom:0;margin-left:0">x</td>')
+
+
+class FastCSSParser(TestCase):
+    css = u"""<!-- /* email styles */
+H1 > span.A:first-child, p+i ~ b, [type='t'], li:nth-child(2n+1), p::before { COLOR: #FFCC00; }
+td { padding: 1px 2px !important; /* inline */ padding: 0; margin:0px  auto;; }
+a:hover, .x[data-a="b c"] { font-family: 'Arial', "Helvetica Neue"; background: url( 'a.png' ) }
+@import url("other.css") screen;
+@media screen and (max-width: 600px) { td { padding: 0 } }
+.empty {} -->"""
+
+    def _rules(self, css):
+        return [(rule.selectors, rule.properties)
+                for rule in pynliner.compile_stylesheet(cssutils.parseString(css)).rules]
+
+    def test_same_rules_as_cssutils(self):
+        rules, skipped = fastcss.parse_stylesheet(self.css)
+        self.assertEqual([(rule.selectors, rule.properties) for rule in rules],
+                         self._rules(self.css))
+        self.assertEqual(skipped, 2)
+
+    def test_falls_back_to_cssutils(self):
+        for css in (u'h1 { color: red', u'h1, { color: red }', u'h1 { *zoom: 1 }',
+                    u'h1 { filter: progid:DX.Alpha(opacity=50) }', u'h1 { color: r\\65 d }',
+                    u'@namespace x url(y); x|h1 { color: red }', u'h1 { a/**/b: c }'):
+            self.assertEqual(fastcss.parse_stylesheet(css), None, css)
+        html = u'<style>h1 { *zoom: 1; color: red }</style><h1>Hi</h1>'
+        self.assertEqual(Pynliner(css_parser='fast').from_string(html).run(),
+                         Pynliner().from_string(html).run())
+
+    def test_pynliner_option(self):
+        html = u"""<style>%s</style><table><tr><td>1</td></tr></table>
+<h1><span class="A">Hi</span></h1><p>a<b>b</b></p>""" % self.css
+        p = Pynliner(css_parser='fast', ingore_unsupported_selectors=True).from_string(html)
+        self.assertEqual(p.run(), Pynliner(ingore_unsupported_selectors=True).from_string(html).run())
+        self.assertIsInstance(p.stylesheet, pynliner.CompiledStylesheet)
+        self.assertRaises(ValueError, Pynliner, css_parser='tinycss')
+
+
+class Warmup(TestCase):
+
+    def test_warmup(self):
+        from pynliner.soupselect import _parsed_selectors
+        precompiled = pynliner.compile_css(u'p { color: blue }')
+        compiled = pynliner.warmup([u'h1 > span { color: red }', precompiled],
+                                   [u'div > p.warm'], css_parser='fast')
+        self.assertEqual(len(compiled), 2)
+        self.assertIs(compiled[1], precompiled)
+        self.assertIn(u'div > p.warm', _parsed_selectors)
+        self.assertIn('cssutils', sys.modules)
+        p = Pynliner().from_string(u'<h1><span>Hi</span></h1><p>x</p>')
+        for stylesheet in compiled:
+            p.with_compiled(stylesheet)
+        self.assertEqual(p.run(), u'<h1><span style="color:red">Hi</span></h1><p style="color:blue">x</p>')
+
+    def test_memo_caches_are_bounded(self):
+        from pynliner import soupselect, _memo
+        memo = _memo.BoundedDict(2)
+        with mock.patch.object(soupselect, '_parsed_selectors', memo):
+            for selector in (u'a', u'b', u'c'):
+                parse_selector(selector)
+            self.assertEqual(memo.keys(), [u'c'])
+            parse_selector(u'c')
+            self.assertEqual(len(memo), 1)
+
+
+class _StaticFetcher(fetchers.Fetcher):
+    def __init__(self, content):
+        self.content = content
+
+    def fetch(self, url):
+        return self.content
+
+
+class Budgets(TestCase):
+    html = u'<style>p { color: red } b, i { margin: 0 }</style><p>1</p><p><b>2</b></p>'
+
+    def _run(self, html=None, **limits):
+        budget = pynliner.Budget(**limits)
+        return Pynliner(budget=budget).from_string(html or self.html).run()
+
+    def _exceeded(self, **limits):
+        with self.assertRaises(pynliner.BudgetExceeded) as context:
+            self._run(**limits)
+        return context.exception
+
+    def test_within_budget(self):
+        self.assertEqual(self._run(seconds=60, elements=4, css_bytes=100, fetch_bytes=0,
+                                   selector_evaluations=3),
+                         Pynliner().from_string(self.html).run())
+
+    def test_exceeded(self):
+        ex = self._exceeded(elements=3)
+        self.assertEqual((ex.resource, ex.limit, ex.used), ('elements', 3, 4))
+        self.assertEqual(self._exceeded(css_bytes=10).resource, 'css_bytes')
+        self.assertEqual(self._exceeded(selector_evaluations=2).resource, 'selector_evaluations')
+        self.assertEqual(self._exceeded(seconds=0).resource, 'seconds')
+
+    def test_fetch_bytes(self):
+        html = u'<link rel="stylesheet" href="http://example.com/a.css"><p>1</p>'
+        p = Pynliner(budget=pynliner.Budget(fetch_bytes=10),
+                     fetcher=_StaticFetcher('p { color: red }')).from_string(html)
+        self.assertRaises(pynliner.BudgetExceeded, p.run)
+
+    def test_fetch_limited_by_what_is_left(self):
+        html = u'<link rel="stylesheet" href="http://example.com/a.css"><p>1</p>'
+        css = 'p { color: red }' + ' ' * 1000
+        limits = []
+        class LimitedFetcher(fetchers.ResolverFetcher):
+            def fetch_limited(self, url, max_bytes=None, timeout=None):
+                limits.append((max_bytes, timeout))
+                return fetchers.ResolverFetcher.fetch_limited(self, url, max_bytes, timeout)
+        fetcher = LimitedFetcher({'http://example.com/': {'a.css': css}})
+        p = Pynliner(budget=pynliner.Budget(seconds=30, fetch_bytes=100), fetcher=fetcher)
+        with self.assertRaises(pynliner.BudgetExceeded) as context:
+            p.from_string(html).run()
+        self.assertEqual(context.exception.resource, 'fetch_bytes')
+        (max_bytes, timeout), = limits
+        self.assertEqual(max_bytes, 100)
+        self.assertTrue(0 < timeout <= 30)
+
+    def test_time_checked_while_selecting(self):
+        soup = BeautifulSoup('<p></p>' * 600)
+        calls = []
+        select_steps(soup, parse_selector('p'), checkpoint=lambda: calls.append(1))
+        self.assertEqual(len(calls), 3)
+        for matcher in ('python', 'numpy'):
+            p = Pynliner(matcher=matcher)
+            p.soup = soup
+            with mock.patch.object(Pynliner, '_checkpoint') as checkpoint:
+                self.assertEqual(len(p._selector_function()(parse_selector('p'))), 600)
+            self.assertTrue(checkpoint.called)
+
+    def test_degrade(self):
+        p = Pynliner(budget=pynliner.Budget(selector_evaluations=1, degrade=True))
+        self.assertEqual(p.from_string(self.html).run(), self.html)
+        self.assertEqual(p.budget_exceeded.resource, 'selector_evaluations')
+
+
+class CommandLine(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.css = os.path.join(self.directory, 'site.css')
+        with open(self.css, 'w') as f:
+            f.write('p { color: red }')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _main(self, argv, stdin=u''):
+        from pynliner.__main__ import main
+        stdout = StringIO.StringIO()
+        status = main(argv, StringIO.StringIO(stdin), stdout)
+        return status, [json.loads(line) for line in stdout.getvalue().splitlines()]
+
+    def test_jsonl(self):
+        stdin = u'{"id": "a", "html": "<p>1</p>"}\n\n{"html": "<b>2</b>"}\nnot json\n'
+        for jobs in ('1', '2'):
+            status, records = self._main(['--jsonl', '--css', self.css, '-j', jobs], stdin)
+            self.assertEqual(status, 1)
+            self.assertEqual([r['id'] for r in records], ['a', 3, 4])
+            self.assertEqual(records[0]['html'], u'<p style="color:red">1</p>')
+            self.assertEqual(records[1]['html'], u'<b>2</b>')
+            self.assertIn('invalid record', records[2]['error'])
+            self.assertIn('seconds', records[0])
+
+    def test_directory_to_output_dir(self):
+        source = os.path.join(self.directory, 'in')
+        os.makedirs(os.path.join(source, 'sub'))
+        for name in ('a.html', os.path.join('sub', 'b.htm'), 'notes.txt'):
+            with open(os.path.join(source, name), 'w') as f:
+                f.write('<p>x</p>')
+        output = os.path.join(self.directory, 'out')
+        status, records = self._main([source, '--css', self.css, '--output-dir', output,
+                                      '--optimize-output', '-j', '2'])
+        self.assertEqual(status, 0)
+        self.assertEqual(len(records), 2)
+        with open(os.path.join(output, 'sub', 'b.htm')) as f:
+            self.assertEqual(f.read(), '<p style="color:red">x</p>')
+
+    def test_output_names_are_unique(self):
+        paths = []
+        for name in ('a', 'b'):
+            os.makedirs(os.path.join(self.directory, name))
+            paths.append(os.path.join(self.directory, name, 'x.html'))
+            with open(paths[-1], 'w') as f:
+                f.write('<p>%s</p>' % name)
+        output = os.path.join(self.directory, 'out')
+        status, records = self._main(paths + ['--output-dir', output])
+        self.assertEqual(status, 1)
+        self.assertNotIn('error', records[0])
+        self.assertIn('already written for %s' % paths[0], records[1]['error'])
+        with open(os.path.join(output, 'x.html')) as f:
+            self.assertEqual(f.read(), '<p>a</p>')
+
+        stdin = u'{"id": "a b", "html": "<p>1</p>"}\n{"id": "a_b", "html": "<p>2</p>"}\n'
+        status, records = self._main(['--jsonl', '--output-dir', output], stdin)
+        self.assertEqual(status, 1)
+        self.assertIn('error', records[1])
+
+    def test_css_preserves_unknown_rules(self):
+        with open(self.css, 'w') as f:
+            f.write('@-ms-viewport { width: device-width }\np { color: red }')
+        html = json.dumps({'html': '<html><head></head><p>x</p></html>'})
+        status, records = self._main(['--jsonl', '--css', self.css, '--preserve-media-queries',
+                                      '--preserve-unknown-rules'], html)
+        self.assertIn(u'@-ms-viewport', records[0]['html'])
+
+    def test_non_ascii_files(self):
+        path = os.path.join(self.directory, 'a.html')
+        html = u'<p>caf\xe9 \u2014 na\xefve</p>'
+        with open(path, 'wb') as f:
+            f.write(html.encode('utf-8'))
+        status, records = self._main([path])
+        self.assertEqual(status, 0)
+        self.assertEqual(records[0]['html'], html)
+        with open(path, 'wb') as f:
+            f.write(u'<p>caf\xe9</p>'.encode('latin-1'))
+        status, records = self._main([path, '--encoding', 'latin-1'])
+        self.assertEqual(records[0]['html'], u'<p>caf\xe9</p>')
+        status, records = self._main([path])
+        self.assertIn('UnicodeDecodeError', records[0]['error'])
+
+    def test_errors_are_records(self):
+        status, records = self._main([os.path.join(self.directory, 'missing.html')])
+        self.assertEqual(status, 1)
+        self.assertIn('IOError', records[0]['error'])
+
+
+class SoupSelect(TestCase):
+    def setUp(self):
+        self.soup = BeautifulSoup("""<div id="list">
+<h2>Title</h2> <!-- items -->
+<p class="a">1</p><p>2</p><span>3</span><p class="a">4</p><p>5</p>
+</div><div><p>6</p>text<em>7</em></div>""")
+
+    def _select(self, selector):
+        return [el.string for el in select(self.soup, selector)]
+
+    def test_general_sibling_selector(self):
+        self.assertEqual(self._select('h2 ~ p'), ['1', '2', '4', '5'])
+        self.assertEqual(self._select('span ~ p.a'), ['4'])
+
+    def test_adjacent_selector_skips_white_space(self):
+        self.assertEqual(self._select('h2 + p'), ['1'])
+        self.assertEqual(self._select('p + span'), ['3'])
+
+    def test_nth_child(self):
+        self.assertEqual(self._select('#list > :nth-child(2n+1)'), ['Title', '2', '4'])
+        self.assertEqual(self._select('#list > :nth-child(even)'), ['1', '3', '5'])
+        self.assertEqual(self._select('p:nth-child(3)'), ['2'])
+        self.assertEqual(self._select('#list p:nth-child(-n+3)'), ['1', '2'])
+
+    def test_nth_last_child(self):
+        self.assertEqual(self._select('#list > :nth-last-child(1)'), ['5'])
+        self.assertEqual(self._select('#list > :nth-last-child(odd)'), ['1', '3', '5'])
+
+    def test_of_type(self):
+        self.assertEqual(self._select('p:first-of-type'), ['1', '6'])
+        self.assertEqual(self._select('p:last-of-type'), ['5', '6'])
+
+    def test_first_and_last_child_with_text(self):
+        self.assertEqual(self._select('div > :first-child'), ['Title', '6'])
+        self.assertEqual(self._select('div > :last-child'), ['5', '7'])
+        soup = BeautifulSoup('<div> text <b>1</b><i>2</i> more text </div>')
+        for selector in (':first-child', ':nth-child(1)', ':last-child', ':nth-last-child(1)'):
+            matched = [el.string for el in select(soup, 'div > ' + selector)]
+            self.assertEqual(matched, ['2'] if 'last' in selector else ['1'], selector)
+
+    def test_descendant_then_child(self):
+        soup = BeautifulSoup('<div><h1><span>a</span></h1></div><h1><span>b</span></h1>')
+        self.assertEqual([el.string for el in select(soup, 'div h1 > span')], ['a'])
+        self.assertEqual([el.string for el in select(soup, 'div > h1 span')], ['a'])
+
+    def test_unknown_pseudo_class(self):
+        for selector in ('p:hover', 'p:not(.a)', 'p::before'):
+            self.assertRaises(SelectorNotSupportedException, self._select, selector)
+
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class BitsetMatching(SoupSelect):
+    """Runs the SoupSelect tests against the numpy matcher"""
+
+    def _select(self, selector):
+        return [el.string for el in BitsetMatcher(self.soup).select(selector)]
+
+    def test_same_matches_as_soupselect(self):
+        matcher = BitsetMatcher(self.soup)
+        for selector in ('div p', 'div > *', 'h2 ~ p.a', 'p + p', '* ~ :nth-child(odd)',
+                         'div#list p:last-of-type', '[id^=""] > p', '[id|=list] ~ div em'):
+            self.assertEqual(matcher.select(selector), select(self.soup, selector), selector)
+
+    def test_pynliner_option(self):
+        html = '<div><p class="a">1</p><p>2</p></div>'
+        css = 'div > p:first-child, .a { color: red } p + p { color: blue }'
+        self.assertEqual(Pynliner(matcher='numpy').from_string(html).with_cssString(css).run(),
+                         Pynliner().from_string(html).with_cssString(css).run())
+
+    def test_unknown_matcher(self):
+        self.assertRaises(ValueError, Pynliner, matcher='lxml')
+
+
+class Shadow(TestCase):
+    html = u"""<style>ul li.a, li + li { color: red } li:first-child { margin: 0 }</style>
+<ul><li class="a">1</li><li>2</li><li class="a" title="x">3</li></ul>"""
+
+    def _run(self, candidate, sample_rate=1.0, **options):
+        reports = []
+        shadow = pynliner.ShadowMode(candidate, sample_rate, reports.append, **options)
+        output = Pynliner(shadow=shadow).from_string(self.html).run()
+        self.assertEqual(output, Pynliner().from_string(self.html).run())
+        return reports
+
+    def test_same_result(self):
+        report, = self._run({'css_parser': 'fast'})
+        self.assertTrue(report.matches)
+        self.assertTrue(report.ratio > 0)
+        self.assertEqual(self._run({'css_parser': 'fast'}, sample_rate=0), [])
+
+    def _run_broken(self, **options):
+        select_steps = BitsetMatcher.select_steps
+        def broken(matcher, steps, checkpoint=None):
+            # drops elements with a title
+            return [el for el in select_steps(matcher, steps) if not el.get('title')]
+        with mock.patch.object(BitsetMatcher, 'select_steps', broken):
+            report, = self._run({'matcher': 'numpy'}, **options)
+        return report
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_mismatch_is_minimized(self):
+        report = self._run_broken()
+        self.assertFalse(report.matches)
+        mismatch = report.selector_mismatches[0]
+        self.assertEqual((mismatch.selector, mismatch.expected, mismatch.selected),
+                         (u'ul li.a', 2, 1))
+        self.assertEqual(mismatch.minimized_selector, u'*')
+        self.assertEqual(mismatch.minimized_document, u'<ul><li title="x"></li></ul>')
+        self.assertTrue(mismatch.minimized_complete)
+        self.assertEqual([(m.name, m.expected, m.styled) for m in report.style_mismatches],
+                         [(u'li', u'color:red', None)])
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_minimizing_is_limited(self):
+        for options in ({'minimize_seconds': 0}, {'max_minimized_elements': 3}):
+            mismatch = self._run_broken(**options).selector_mismatches[0]
+            self.assertEqual(mismatch.minimized_selector, None)
+        clock = iter(xrange(1000)).next
+        with mock.patch('pynliner.shadow.time.time', clock):
+            mismatch = self._run_broken(minimize_seconds=10).selector_mismatches[0]
+        self.assertFalse(mismatch.minimized_complete)
+        self.assertTrue(mismatch.minimized_selector)
+        self.assertNotEqual(mismatch.minimized_document, u'<ul><li title="x"></li></ul>')
+
+    def test_candidate_error_is_reported(self):
+        report, = self._run({'matcher': 'lxml'})
+        self.assertIn('ValueError', report.error)
+        self.assertFalse(report.matches)
+
+    def test_linked_stylesheets_fetched_once(self):
+        reports = []
+        fetcher = _StaticFetcher(u'li { color: red }')
+        fetcher.fetch = mock.Mock(side_effect=fetcher.fetch)
+        shadow = pynliner.ShadowMode({'css_parser': 'fast'}, 1.0, reports.append)
+        html = u'<link rel="stylesheet" href="http://example.com/a.css"><ul><li>1</li></ul>'
+        output = Pynliner(fetcher=fetcher, shadow=shadow).from_string(html).run()
+        self.assertEqual(output, u'<ul><li style="color:red">1</li></ul>')
+        self.assertTrue(reports[0].matches)
+        self.assertEqual(fetcher.fetch.call_count, 1)
+
+
+class Reuse(TestCase):
+
+    def test_from_string_resets(self):
+        p = Pynliner().with_compiled(pynliner.compile_css('p {color: red}'))
+        p.with_cssString('p {margin: 0}')
+        output = p.from_string('<style>h1 {color: blue}</style><h1>Hi</h1><p>there</p>').run()
+        self.assertEqual(output, u'<h1 style="color:blue">Hi</h1><p style="margin:0;color:red">there</p>')
+        parser = p._css_parser
+        self.assertEqual(p.from_string('<h1>Hi</h1><p>again</p>').run(),
+                         u'<h1>Hi</h1><p style="margin:0;color:red">again</p>')
+        self.assertIs(p._css_parser, parser)
+
+    def test_reset(self):
+        p = Pynliner().from_fragment('<p>Hi</p>', ['div'])
+        p.run()
+        p.reset()
+        self.assertFalse(p.soup)
+        self.assertFalse(p.output)
+        self.assertIsNone(p.source_string)
+        self.assertIsNone(p.fragment_ancestors)
+
+    def test_low_memory(self):
+        html = '<style>h1 {color: blue}</style><h1>Hi</h1>'
+        p = Pynliner(low_memory=True).from_string(html)
+        self.assertEqual(p.run(), Pynliner().from_string(html).run())
+        self.assertFalse(p.soup)
+        self.assertFalse(p.stylesheet)
+        self.assertFalse(p.style_string)
+        self.assertEqual(p.output, u'<h1 style="color:blue">Hi</h1>')
+
+
+class Server(TestCase):
+    html = '<style>h1 {font-size: 2em}</style><h1>Hi</h1><p>there</p>'
+
+    def _start(self, processes=None, options=None):
+        stylesheets = {'base': pynliner.compile_css('p {color: red}'),
+                       'print': pynliner.compile_css('p {margin: 0}')}
+        self.server = server.InliningServer(('127.0.0.1', 0), stylesheets, options,
+                                            processes=processes)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        return httplib.HTTPConnection(*self.server.server_address)
+
+    def _request(self, connection, method, path, body=None):
+        connection.request(method, path, body)
+        response = connection.getresponse()
+        return response.status, response.read()
+
+    def test_inline_keeps_connection_alive(self):
+        connection = self._start()
+        status, body = self._request(connection, 'POST', '/inline?css=base,print', self.html)
+        self.assertEqual(status, 200)
+        self.assertEqual(body, '<h1 style="font-size:2em">Hi</h1><p style="color:red;margin:0">there</p>')
+        sock = connection.sock
+        status, body = self._request(connection, 'POST', '/inline', self.html)
+        self.assertEqual(body, '<h1 style="font-size:2em">Hi</h1><p>there</p>')
+        self.assertIs(connection.sock, sock)
+
+    def test_pipelined_requests(self):
+        self._start()
+        sock = socket.create_connection(self.server.server_address)
+        self.addCleanup(sock.close)
+        request = 'POST /inline?css=%%s HTTP/1.1\r\nHost: x\r\nContent-Length: %d\r\n\r\n%s' % (
+            len(self.html), self.html)
+        sock.sendall(request % 'base' + request % 'print')
+        bodies = []
+        for _ in range(2):
+            response = httplib.HTTPResponse(sock)
+            response.begin()
+            bodies.append(response.read())
+        self.assertIn('<p style="color:red">', bodies[0])
+        self.assertIn('<p style="margin:0">', bodies[1])
+
+    def test_non_ascii_round_trip(self):
+        connection = self._start()
+        html = u'<p>caf\xe9 \u2014 na\xefve</p>'
+        status, body = self._request(connection, 'POST', '/inline', html.encode('utf-8'))
+        self.assertEqual(status, 200)
+        self.assertEqual(body.decode('utf-8'), html)
+        connection.request('POST', '/inline', u'<p>caf\xe9</p>'.encode('latin-1'),
+                           {'Content-Type': 'text/html; charset=iso-8859-1'})
+        self.assertEqual(connection.getresponse().read(), u'<p>caf\xe9</p>'.encode('utf-8'))
+        status, body = self._request(connection, 'POST', '/inline', '<p>caf\xe9</p>')
+        self.assertEqual(status, 400)
+
+    def test_errors(self):
+        connection = self._start()
+        status, body = self._request(connection, 'POST', '/inline?css=missing', self.html)
+        self.assertEqual(status, 400)
+        self.assertIn('missing', body)
+        status, _ = self._request(connection, 'GET', '/nowhere')
+        self.assertEqual(status, 404)
+
+    def test_linked_stylesheets_refused_by_default(self):
+        html = '<link rel="stylesheet" href="file:///etc/passwd"><p>there</p>'
+        with mock.patch('urllib2.urlopen') as urlopen:
+            status, body = self._request(self._start(), 'POST', '/inline', html)
+        self.assertEqual(status, 500)
+        self.assertIn('FetchError', body)
+        self.assertFalse(urlopen.called)
+        options = {'fetcher': _StaticFetcher('p {color: red}')}
+        status, body = self._request(self._start(options=options), 'POST', '/inline', html)
+        self.assertEqual(body, '<p style="color:red">there</p>')
+
+    def test_health_and_metrics(self):
+        connection = self._start(processes=2)
+        status, body = self._request(connection, 'GET', '/health')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body)['stylesheets'], ['base', 'print'])
+        status, body = self._request(connection, 'POST', '/inline?css=base', self.html)
+        self.assertIn('<p style="color:red">', body)
+        metrics = json.loads(self._request(connection, 'GET', '/metrics')[1])
+        self.assertEqual(metrics['requests'], 1)
+        self.assertEqual(metrics['errors'], 0)
+        self.assertEqual(metrics['in_flight'], 0)
+        self.assertIn('p99', metrics['latency_seconds'])
+
 
 if __name__ == '__main__':
     unittest.main()